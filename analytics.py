@@ -0,0 +1,211 @@
+# ---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+#   Desc.:      Portfolio analytics
+#   Purpose:    Cost basis, profit and loss, returns and volatility for one
+#               user, computed over their whole ledger with NumPy
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Licensing Info:
+#   ?
+# ---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+
+# Imports:
+import math
+import numpy as np
+
+# 'Constants'
+TRADING_DAYS = 252      # for annualising volatility
+EPSILON = 1e-9          # holdings smaller than this count as none
+
+# ---------------------------------------------------------------------------
+#   Desc.:      costbasis(symbols, units, prices)
+#   Purpose:    Average cost and realized profit per symbol
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - inputs are the stock legs of the ledger in id order (no cash rows)
+#   - average cost method: a buy adds units * price to the cost of the
+#     holding; a sell removes units at the current average cost and
+#     realizes (price - average) * units
+#   - that makes the cost a running recurrence, cost[k] = a[k] * cost[k-1]
+#     + b[k], with a = 1, b = units * price for buys and a = remaining /
+#     held, b = 0 for sells. It is solved for every row at once as
+#     cost[k] = exp(L[k]) * sum(b[j] * exp(-L[j])) with L the running sum
+#     of log(a), the sum done in log space by logaddexp.accumulate so
+#     small ratios can't underflow.
+#   - a 'holding episode' runs from a buy on an empty holding until it is
+#     sold down to nothing; each episode starts from zero cost, so both
+#     running sums restart at every episode (see _segmented)
+#   - rows without a price (trades made before prices were recorded) make
+#     the cost of that symbol unknown (NaN)
+#   - returns {symbol: (units held, cost of units held, realized profit)}
+# ---------------------------------------------------------------------------
+def costbasis(symbols, units, prices):
+    """Per-symbol holdings, cost and realized P&L from ledger columns."""
+    if len(symbols) == 0:
+        return {}
+
+    # --- Section 010: Group the rows by symbol, keeping ledger order
+    names, codes = np.unique(np.asarray(symbols, dtype = str), return_inverse = True)
+    order = np.argsort(codes, kind = "stable")
+    codes = codes[order]
+    units = np.asarray(units, dtype = float)[order]
+    prices = np.asarray(prices, dtype = float)[order]
+    firsts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+
+    # --- Section 020: Running holdings and holding episodes
+    total = np.cumsum(units)
+    held = total - np.repeat((total - units)[firsts], np.diff(np.r_[firsts, len(units)]))
+    before = held - units
+    starts = np.abs(before) < EPSILON
+    starts[firsts] = True
+    episodes = np.flatnonzero(starts)
+    closes = (units < 0) & (np.abs(held) < EPSILON)
+
+    # --- Section 030: Solve the cost recurrence for every row
+    buys = units > 0
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        ratios = np.where(buys | starts | closes, 1.0, held / before)
+        logs = _segmented(np.add, np.log(ratios), episodes)
+        added = np.where(buys, units * prices, 0.0)
+        terms = np.where(added > 0, np.log(added), -np.inf)
+        sums = _segmented(np.logaddexp, terms - logs, episodes)
+        cost = np.where(closes, 0.0, np.exp(logs + sums))
+
+        # a buy with no recorded price leaves the rest of its episode unknown
+        missing = _segmented(np.add, np.isnan(added).astype(float), episodes)
+        cost[(missing > 0) & ~closes] = np.nan
+
+    # --- Section 040: Profit realized by each sell at the average cost
+    previous = np.r_[0.0, cost[:-1]]
+    previousheld = np.r_[0.0, held[:-1]]
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        average = np.where(starts, np.nan, previous / previousheld)
+        realized = np.where(buys, 0.0, (prices - average) * -units)
+
+    # --- Section 050: Totals per symbol
+    lasts = np.r_[firsts[1:], len(units)] - 1
+    realizedsums = np.add.reduceat(realized, firsts)
+    return {str(names[i]) : (float(held[last]), float(cost[last]), float(realizedsums[i]))
+            for i, last in enumerate(lasts)}
+
+# ---------------------------------------------------------------------------
+#   Desc.:      _segmented(ufunc, values, starts)
+#   Purpose:    ufunc.accumulate restarted at the start of every segment
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - 'starts' are the sorted indexes the segments begin at, 0 among them
+#   - segments of about the same length (within a power of two) are laid
+#     out as the rows of one 2-D block and accumulated along axis 1, so
+#     there are at most log2(len(values)) + 1 accumulate calls and each
+#     segment is summed from zero; the padding past a segment's end is
+#     never read back
+# ---------------------------------------------------------------------------
+def _segmented(ufunc, values, starts):
+    """Accumulates 'values' separately within each segment."""
+    lengths = np.diff(np.r_[starts, len(values)])
+    buckets = np.ceil(np.log2(lengths)).astype(int)
+    result = np.empty_like(values)
+    for bucket in np.unique(buckets):
+        chosen = np.flatnonzero(buckets == bucket)
+        width = lengths[chosen].max()
+        index = starts[chosen][:, None] + np.arange(width)
+        inside = np.arange(width) < lengths[chosen][:, None]
+        block = values[np.minimum(index, len(values) - 1)]
+        result[index[inside]] = ufunc.accumulate(block, axis = 1)[inside]
+    return result
+
+# ---------------------------------------------------------------------------
+#   Desc.:      dailyreturns(taken, values)
+#   Purpose:    Day on day returns of the account and their volatility
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - takes the portfolio_snapshots series (seconds, total value), keeps
+#     the last snapshot of each UTC day and returns ([days], [returns],
+#     volatility) with days as day numbers since 1970-01-01
+#   - volatility is the sample standard deviation of the daily returns,
+#     annualised by sqrt(TRADING_DAYS); None with fewer than two returns
+# ---------------------------------------------------------------------------
+def dailyreturns(taken, values):
+    """Daily returns and annualised volatility from account snapshots."""
+    taken = np.asarray(taken, dtype = np.int64)
+    values = np.asarray(values, dtype = float)
+    if len(taken) < 2:
+        return [], [], None
+
+    days = taken // 86400
+    closing = np.flatnonzero(np.r_[days[1:] != days[:-1], True])
+    days, values = days[closing], values[closing]
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        returns = np.diff(values) / values[:-1]
+
+    volatility = None
+    if len(returns) >= 2:
+        volatility = float(np.std(returns, ddof = 1) * math.sqrt(TRADING_DAYS))
+    return days[1:].tolist(), returns.tolist(), volatility
+
+# ---------------------------------------------------------------------------
+#   Desc.:      portfolioanalytics(ledger, quotes, snapshots)
+#   Purpose:    Everything the /analytics endpoint reports, as plain data
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - ledger: (symbol, units, price) stock legs in id order
+#   - quotes: {symbol: quote or None} for the symbols still held
+#   - snapshots: (taken, total value) rows, oldest first
+#   - unknown numbers (no price recorded, no quote) come back as None
+# ---------------------------------------------------------------------------
+def portfolioanalytics(ledger, quotes, snapshots):
+    """Per-symbol P&L plus account returns, ready for JSON."""
+
+    # --- Section 010: Cost basis and P&L per symbol
+    if len(ledger) != 0:
+        symbols, units, prices = zip(*ledger)
+        prices = [np.nan if price == None else price for price in prices]
+        basis = costbasis(symbols, units, prices)
+    else:
+        basis = {}
+
+    rows = []
+    for symbol, (held, cost, realized) in sorted(basis.items()):
+        quote = quotes.get(symbol)
+        price = quote["price"] if quote != None else math.nan
+        value = held * price if abs(held) >= EPSILON else 0.0
+        rows.append({
+            "symbol" : symbol,
+            "units" : held,
+            "average_cost" : cost / held if abs(held) >= EPSILON else math.nan,
+            "cost_basis" : cost,
+            "price" : price,
+            "value" : value,
+            "realized" : realized,
+            "unrealized" : value - cost
+        })
+
+    # --- Section 020: Account level returns
+    days, returns, volatility = dailyreturns([row[0] for row in snapshots],
+                                             [row[1] for row in snapshots])
+
+    totals = {key : float(np.sum([row[key] for row in rows]))
+                for key in ["cost_basis", "value", "realized", "unrealized"]}
+    return {
+        "symbols" : [{key : _finite(value) for key, value in row.items()} for row in rows],
+        "totals" : {key : _finite(value) for key, value in totals.items()},
+        "daily_returns" : [{"day" : day, "return" : _finite(value)}
+                            for day, value in zip(days, returns)],
+        "volatility" : volatility
+    }
+
+def _finite(value):
+    """Rounds off float noise; NaN and infinities become None for JSON."""
+    if isinstance(value, float):
+        return round(value, 6) if math.isfinite(value) else None
+    return value
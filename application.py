@@ -11,54 +11,449 @@
 # ---------------------------------------------------------------------------
 
 # Imports:
-from cs50 import SQL
-from flask import Flask, flash, redirect, render_template, request, session, url_for
-from flask_session import Session
-from passlib.apps import custom_app_context as pwd_context
-from tempfile import gettempdir
+import click
+import instrument
+import os
+import pagecache
+import passwords
+import sessions
+import threading
+import time
 
-from helpers import *
-
-# 'Constants'
-USD_sentinel = "cash_USD"
+from database import Database
+from flask import Flask, Response, current_app, flash, jsonify, redirect, render_template, request, session, url_for
+from flask.cli import with_appcontext
+from helpers import (EXPORT_FORMATS, HISTORY_NEWEST, HISTORY_PAGE, HISTORY_PAGE_MAX,
+                     LEADERBOARD_SIZE, LEADERBOARD_SIZE_MAX, LEADERBOARD_TTL,
+                     LIMIT_ORDERS_LISTED, LOOKUP_TIMEOUT, ORDERS_MAX, PERFORMANCE_DAYS,
+                     PRICE_HISTORY_DAYS, PRICE_HISTORY_POINTS, QUOTE_CACHE_NEGATIVE_TTL,
+                     QUOTE_CACHE_SIZE, QUOTE_CACHE_STALE_TTL, QUOTE_CACHE_TTL,
+                     SNAPSHOT_INTERVAL, USD_sentinel, Quotes, apology, compactledger,
+                     executeorders, executetrade, listedsymbol, login_required,
+                     lookup, lookup_many, makeprovider, markettotals, openhistory,
+                     quotes, repriceleaderboard, settlefills, snapshotportfolios,
+                     stockbalance, stockmove, usd)
+from matching import MATCHING_INTERVAL, ORDER_KINDS, ORDER_SIDES, MatchingEngine
+from pagecache import staticpage, userpage
+from passwords import PasswordBusy, PasswordHasher, checkpassword, hashpassword
+from pricestream import (STREAM_INTERVAL, STREAM_KEEPALIVE, STREAM_SUBSCRIBERS,
+                         PriceStream, events)
+from quotecache import MemoryBackend, QuoteCache, SQLiteBackend
+from schema import checkplans, migrate
+from symbols import SYMBOL_FILE, SymbolDirectory
+from werkzeug.local import LocalProxy
 
 # Functions:
 
 # ---------------------------------------------------------------------------
-#   Desc.:      APPLICATION INITIALIZE
-#   Purpose:    Initializes the finance application object
-#   Author:     CS50
+#   Desc.:      APPLICATION INITIALIZE - create_app(config)
+#   Purpose:    Builds and configures a finance application object
+#   Author:     CS50 / Joel Tannas
 #   Date:       ?
 #
 #   Bugs, Limitations, and Other Notes:
-#   - 
+#   - nothing is configured at import any more, so importing this module
+#     is cheap and each worker (or test) builds its own app:
+#       flask run / flask <command>  find create_app() on their own
+#       gunicorn 'application:create_app()'
+#   - everything an app is configured with lives in app.extensions (the
+#     quote provider, cache and symbol directory in "quotes", password
+#     hashing in "passwords", the page cache in "pages", the rest in
+#     "finance"), so several apps can live in one process; only the
+#     /metrics counters and the thread running provider requests are
+#     shared by the whole process
+#   - 'config' overrides the defaults below, which still read the
+#     FINANCE_* environment variables
+#   - the database (and its migrations), the price stream, the matching
+#     engine, password hashing, NumPy and the price history files are all
+#     set up the first time something uses them, not here; see Services
+# ---------------------------------------------------------------------------
+def create_app(config=None):
+    """Returns a new, configured finance app."""
+    
+    # configure application
+    # aka. Initialize the application object
+    app = Flask(__name__)
+    defaults(app)
+    app.config.update(config or {})
+    
+    # ensure responses aren't cached
+    # aka. Do not pull webpages from the cache - always get them from the server
+    if app.config["DEBUG"]:
+        app.after_request(nocache)
+    
+    # the pieces configured from app.config (see defaults() for each), all
+    # kept on the app itself so that apps made side by side stay separate
+    instrument.init_app(app, extra = quotecachemetrics)
+    app.extensions["passwords"] = PasswordHasher(rounds = app.config["PASSWORD_ROUNDS"],
+                                                 workers = app.config["PASSWORD_WORKERS"])
+    app.register_error_handler(PasswordBusy, passwordbusy)
+    app.jinja_env.filters["usd"] = usd # usd is a helper function
+    pagecache.init_app(app)
+    sessions.init_app(app, app.config["SESSION_BACKEND"])
+    
+    if app.config["QUOTE_PROVIDER"] == "local":
+        provider = makeprovider("local", path = app.config["QUOTE_FILE"])
+    else:
+        provider = makeprovider(app.config["QUOTE_PROVIDER"])
+    
+    if app.config["QUOTE_CACHE_BACKEND"] == "sqlite":
+        quotebackend = SQLiteBackend(os.path.join(app.instance_path, "quotecache.db"))
+    else:
+        quotebackend = MemoryBackend()
+    cache = QuoteCache(ttl = app.config["QUOTE_CACHE_TTL"],
+                       maxsize = app.config["QUOTE_CACHE_SIZE"],
+                       negative_ttl = app.config["QUOTE_CACHE_NEGATIVE_TTL"],
+                       stale_ttl = app.config["QUOTE_CACHE_STALE_TTL"],
+                       backend = quotebackend,
+                       lease = LOOKUP_TIMEOUT * 2)
+    
+    app.extensions["quotes"] = Quotes(provider, cache, 
+                        SymbolDirectory(app.config["SYMBOL_FILE"].split(os.pathsep)),
+                        strict = app.config["SYMBOL_CHECK"],
+                        history = app.config["PRICE_HISTORY_DIR"])
+    
+    # the database, price stream and matching engine, made on first use
+    app.extensions["finance"] = Services(app.config, app.extensions["quotes"])
+    app.before_request(startmatching)
+    
+    # the routes and 'flask' commands defined below
+    for rule, function, options in ROUTES:
+        app.add_url_rule(rule, view_func = function, **options)
+    for command in COMMANDS:
+        app.cli.add_command(command)
+    return app
+
+# ---------------------------------------------------------------------------
+#   Desc.:      defaults(app)
+#   Purpose:    The settings create_app() starts from
+#   Author:     CS50 / Joel Tannas
+#   Date:       ?
+# ---------------------------------------------------------------------------
+def defaults(app):
+    """Fills app.config with the default settings."""
+    
+    # time the database, quote lookups, password hashing and rendering in every
+    # request: Server-Timing headers, /metrics, and (if PROFILE_SAMPLE_RATE > 0)
+    # cProfile dumps of the slowest sampled requests in instance/profiles
+    app.config["SERVER_TIMING"] = True
+    app.config["PROFILE_SAMPLE_RATE"] = 0.0
+    app.config["PROFILE_KEEP"] = 20
+    
+    # configure password hashing: the cost (rounds) of each new hash, and how
+    # many can run at once; older hashes are upgraded as their users log in
+    app.config["PASSWORD_ROUNDS"] = int(os.environ.get("FINANCE_PASSWORD_ROUNDS",
+                                                       passwords.PASSWORD_ROUNDS))
+    app.config["PASSWORD_WORKERS"] = passwords.PASSWORD_WORKERS
+    
+    # configure where sessions are kept (see sessions.py): 'filesystem' temp
+    # files, a 'sqlite' table in the instance folder, or a signed 'cookie'
+    app.config["SESSION_PERMANENT"] = False
+    app.config["SESSION_BACKEND"] = os.environ.get("FINANCE_SESSION_BACKEND", "sqlite")
+    
+    # configure where quotes come from: 'yahoo', or 'local' for made-up prices
+    # that need no network (from FINANCE_QUOTE_FILE if set, else a random walk)
+    app.config["QUOTE_PROVIDER"] = os.environ.get("FINANCE_QUOTE_PROVIDER", "yahoo")
+    app.config["QUOTE_FILE"] = os.environ.get("FINANCE_QUOTE_FILE")
+    
+    # configure the symbol directory: which listing files (separated by
+    # os.pathsep) name the symbols that exist, and whether new buys and
+    # quotes of symbols missing from them are refused without asking the
+    # quote provider. The bundled listing is only a sample, so that is on
+    # only when a full listing is given; stocks already held are always
+    # looked up and can always be sold.
+    app.config["SYMBOL_FILE"] = os.environ.get("FINANCE_SYMBOL_FILE", SYMBOL_FILE)
+    app.config["SYMBOL_CHECK"] = "FINANCE_SYMBOL_FILE" in os.environ
+    
+    # configure the quote cache in front of lookup() (defaults in helpers.py)
+    # 'sqlite' shares one cache between all worker processes via a file in the
+    # instance folder; 'memory' keeps a private cache per process
+    app.config["QUOTE_CACHE_BACKEND"] = "sqlite"
+    app.config["QUOTE_CACHE_TTL"] = QUOTE_CACHE_TTL
+    app.config["QUOTE_CACHE_SIZE"] = QUOTE_CACHE_SIZE
+    app.config["QUOTE_CACHE_NEGATIVE_TTL"] = QUOTE_CACHE_NEGATIVE_TTL
+    app.config["QUOTE_CACHE_STALE_TTL"] = QUOTE_CACHE_STALE_TTL
+    
+    # keep every fetched price in per-symbol files for /history/<symbol>
+    # (None turns the recording off)
+    app.config["PRICE_HISTORY_DIR"] = os.environ.get("FINANCE_PRICE_HISTORY_DIR",
+                                        os.path.join(app.instance_path, "prices"))
+    
+    # configure how often 'flask snapshot' buckets account values
+    app.config["SNAPSHOT_INTERVAL"] = SNAPSHOT_INTERVAL
+    
+    # push live prices to the index page over /stream: off by default, since
+    # every open index page then holds a server thread (with gunicorn's sync
+    # workers, a whole worker); turn it on ('on') only with a threaded or
+    # async server. One poller per process feeds at most STREAM_SUBSCRIBERS
+    # open streams; pages beyond that keep the prices they were drawn with.
+    # A stream notices its browser has gone at its next keep-alive.
+    app.config["LIVE_PRICES"] = os.environ.get("FINANCE_LIVE_PRICES", "off") == "on"
+    app.config["STREAM_INTERVAL"] = STREAM_INTERVAL
+    app.config["STREAM_KEEPALIVE"] = STREAM_KEEPALIVE
+    app.config["STREAM_SUBSCRIBERS"] = STREAM_SUBSCRIBERS
+    
+    # the database, and the archive that 'flask compact' moves old ledger
+    # rows into
+    app.config["DATABASE"] = os.environ.get("FINANCE_DATABASE", "finance.db")
+    app.config["ARCHIVE_DATABASE"] = os.environ.get("FINANCE_ARCHIVE_DATABASE",
+                                        os.path.join(app.instance_path, "archive.db"))
+    
+    # fill resting limit and stop orders as prices reach them (see matching.py):
+    # 'thread' runs the engine in each web process, 'off' leaves it to a
+    # single 'flask matcher' process
+    app.config["MATCHING_ENGINE"] = os.environ.get("FINANCE_MATCHING_ENGINE", "thread")
+    app.config["MATCHING_INTERVAL"] = MATCHING_INTERVAL
+
+# ---------------------------------------------------------------------------
+#   Desc.:      Services(config, quotes)
+#   Purpose:    One app's database, price stream and matching engine
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - each is made the first time it is used: the database is migrated
+#     and opened by the first request (or command) that reads it, not
+#     when a worker starts
+#   - kept in app.extensions["finance"]; the routes reach them through
+#     the db, pricestream and matchingengine proxies below
+#   - the price stream and matching engine run on threads of their own,
+#     outside any app context, so they are given this app's quote lookup
+#     (Quotes.lookup_many) rather than helpers.lookup_many
+# ---------------------------------------------------------------------------
+class Services:
+    """The per-app objects that are expensive to set up."""
+    
+    def __init__(self, config, quotes):
+        self.config = config
+        self.quotes = quotes
+        self._db = None
+        self._pricestream = None
+        self._matchingengine = None
+        self._lock = threading.RLock()
+    
+    @property
+    def db(self):
+        """Creates or upgrades the database, then opens it."""
+        if self._db == None:
+            with self._lock:
+                if self._db == None:
+                    migrate(self.config["DATABASE"])
+                    self._db = Database(self.config["DATABASE"], 
+                                        archive = self.config["ARCHIVE_DATABASE"])
+        return self._db
+    
+    @property
+    def pricestream(self):
+        if self._pricestream == None:
+            with self._lock:
+                if self._pricestream == None:
+                    self._pricestream = PriceStream(self.quotes.lookup_many, 
+                                                    self.config["STREAM_INTERVAL"],
+                                                    self.config["STREAM_SUBSCRIBERS"])
+        return self._pricestream
+    
+    @property
+    def matchingengine(self):
+        if self._matchingengine == None:
+            with self._lock:
+                if self._matchingengine == None:
+                    database = self.db
+                    self._matchingengine = MatchingEngine(
+                            database.openorders, self.quotes.lookup_many,
+                            lambda fills: settlefills(database, fills),
+                            self.config["MATCHING_INTERVAL"])
+        return self._matchingengine
+
+db = LocalProxy(lambda: current_app.extensions["finance"].db)
+pricestream = LocalProxy(lambda: current_app.extensions["finance"].pricestream)
+matchingengine = LocalProxy(lambda: current_app.extensions["finance"].matchingengine)
+
+# ---------------------------------------------------------------------------
+#   Desc.:      route(rule, **options) / command(name)
+#   Purpose:    app.route and app.cli.command for a module without an app
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - record the view in ROUTES (or the command in COMMANDS) for
+#     create_app() to add; the endpoints keep their plain names
+#     (url_for("index")), unlike a blueprint's
+#   - commands run inside the app's context, as app.cli's do
 # ---------------------------------------------------------------------------
+ROUTES = []
+COMMANDS = []
 
-# configure application
-# aka. Initialize the application object
-app = Flask(__name__)
+def route(rule, **options):
+    """Decorator registering a view with every app create_app() makes."""
+    def decorator(function):
+        ROUTES.append((rule, function, options))
+        return function
+    return decorator
 
-# ensure responses aren't cached
-# aka. Do not pull webpages from the cache - always get them from the server
-if app.config["DEBUG"]:
-    @app.after_request
-    def after_request(response):
-        response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-        response.headers["Expires"] = 0
-        response.headers["Pragma"] = "no-cache"
+def command(name):
+    """Decorator registering a 'flask' command with every app."""
+    def decorator(function):
+        cli = click.command(name)(with_appcontext(function))
+        COMMANDS.append(cli)
+        return cli
+    return decorator
+
+# ---------------------------------------------------------------------------
+#   Desc.:      Application hooks
+#   Purpose:    The handlers create_app() installs
+#   Author:     CS50 / Joel Tannas
+#   Date:       ?
+#
+#   Bugs, Limitations, and Other Notes:
+#   - nocache leaves pages with an ETag alone: they are always revalidated
+#     anyway
+#   - startmatching starts the engine's thread with the first request;
+#     after that it is two attribute reads, and it never waits on a tick
+# ---------------------------------------------------------------------------
+def nocache(response):
+    if response.get_etag()[0] != None:
         return response
-        
-# custom filter
-app.jinja_env.filters["usd"] = usd # usd is a helper function
+    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+    response.headers["Expires"] = 0
+    response.headers["Pragma"] = "no-cache"
+    return response
+
+def quotecachemetrics():
+    return [
+        ("finance_quote_cache_events_total", "counter", "Quote cache events.",
+            [({"event" : event}, count) for event, count in quotes().cache.stats().items()
+                if isinstance(count, int) and event not in ["size", "maxsize"]]),
+        ("finance_quote_cache_entries", "gauge", "Quotes held in the cache.",
+            [({}, quotes().cache.stats()["size"])]),
+        ]
+
+def passwordbusy(error):
+    return apology("too many log ins at once", "please try again"), 503
+
+def startmatching():
+    if current_app.config["MATCHING_ENGINE"] == "thread":
+        matchingengine.start()
+
+# ---------------------------------------------------------------------------
+#   Desc.:      flask positions [--rebuild]
+#   Purpose:    Checks the positions table against the transactions ledger
+#   Author:     Joel Tannas
+#   Date:       
+#
+#   Bugs, Limitations, and Other Notes:
+#   - prints each holding that has drifted; --rebuild then recomputes the
+#     whole table from the ledger
+# ---------------------------------------------------------------------------
+@command("positions")
+@click.option("--rebuild", is_flag = True, help = "Recompute positions from the ledger.")
+def positionscommand(rebuild):
+    """Verify (and optionally rebuild) the positions table."""
+    drift = db.positionsdrift()
+    for row in drift:
+        click.echo("user {user_id} {symbol}: ledger {ledger}, positions {position}"
+                    .format(**dict(row)))
+    click.echo("{} holding(s) drifted".format(len(drift)))
+    
+    if rebuild:
+        db.rebuildpositions()
+        click.echo("positions rebuilt, {} holding(s) drifted afterwards"
+                    .format(len(db.positionsdrift())))
 
-# configure session to use filesystem (instead of signed cookies)
-app.config["SESSION_FILE_DIR"] = gettempdir()
-app.config["SESSION_PERMANENT"] = False
-app.config["SESSION_TYPE"] = "filesystem"
-Session(app)
+# ---------------------------------------------------------------------------
+#   Desc.:      flask schema
+#   Purpose:    Migrates the database and checks the hot query plans
+#   Author:     Joel Tannas
+#   Date:       
+#
+#   Bugs, Limitations, and Other Notes:
+#   - exits with status 1 if any hot query would scan a whole table, so it
+#     can gate a deploy or CI run
+# ---------------------------------------------------------------------------
+@command("schema")
+def schemacommand():
+    """Migrate finance.db and verify its query plans use indexes."""
+    click.echo("schema at version {}".format(migrate(current_app.config["DATABASE"])))
+    problems = checkplans(current_app.config["DATABASE"])
+    for problem in problems:
+        click.echo(problem)
+    if len(problems) != 0:
+        raise SystemExit(1)
+    click.echo("all hot queries use their indexes")
 
-# configure CS50 Library to use SQLite database
-db = SQL("sqlite:///finance.db")
+# ---------------------------------------------------------------------------
+#   Desc.:      flask compact --before DATE
+#   Purpose:    Archives the ledger before a date, leaving checkpoint rows
+#   Author:     Joel Tannas
+#   Date:       
+#
+#   Bugs, Limitations, and Other Notes:
+#   - see compactledger(); balances are unchanged and history pages and
+#     exports still show every archived row, read from ARCHIVE_DATABASE
+#   - DATE is 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS' in UTC, as the ledger
+#     timestamps are
+# ---------------------------------------------------------------------------
+@command("compact")
+@click.option("--before", required = True,
+              type = click.DateTime(["%Y-%m-%d", "%Y-%m-%d %H:%M:%S"]),
+              help = "Archive the ledger rows older than this (UTC).")
+def compactcommand(before):
+    """Roll old ledger rows into checkpoints and move them to the archive."""
+    try:
+        archived, checkpoints = compactledger(db, before.strftime("%Y-%m-%d %H:%M:%S"))
+    except RuntimeError as error:
+        click.echo(str(error))
+        raise SystemExit(1)
+    click.echo("{} row(s) archived, {} checkpoint(s) written".format(archived, checkpoints))
+
+# ---------------------------------------------------------------------------
+#   Desc.:      flask snapshot [--every SECONDS]
+#   Purpose:    Records the value of every account for /performance
+#   Author:     Joel Tannas
+#   Date:       
+#
+#   Bugs, Limitations, and Other Notes:
+#   - without --every it takes one snapshot and exits (for cron); with it,
+#     it keeps taking one every SECONDS until stopped
+#   - snapshots are bucketed by SNAPSHOT_INTERVAL, so extra runs within
+#     one interval just overwrite that interval's values
+# ---------------------------------------------------------------------------
+@command("snapshot")
+@click.option("--every", type = float, default = None,
+              help = "Keep running, taking a snapshot every SECONDS.")
+def snapshotcommand(every):
+    """Value every account and store it in portfolio_snapshots."""
+    while True:
+        started = time.time()
+        count = snapshotportfolios(db, current_app.config["SNAPSHOT_INTERVAL"], started)
+        click.echo("{} account(s) snapshotted".format(count))
+        if every == None:
+            break
+        time.sleep(max(0, every - (time.time() - started)))
+
+# ---------------------------------------------------------------------------
+#   Desc.:      flask matcher [--once]
+#   Purpose:    Runs the matching engine on its own
+#   Author:     Joel Tannas
+#   Date:       
+#
+#   Bugs, Limitations, and Other Notes:
+#   - for running one engine beside several web workers started with
+#     FINANCE_MATCHING_ENGINE=off; --once runs a single tick and exits
+# ---------------------------------------------------------------------------
+@command("matcher")
+@click.option("--once", is_flag = True, help = "Run one tick and exit.")
+def matchercommand(once):
+    """Fill limit and stop orders every MATCHING_INTERVAL seconds."""
+    while True:
+        started = time.time()
+        outcomes = matchingengine.tick()
+        filled = len([outcome for outcome in outcomes if outcome["status"] == "filled"])
+        click.echo("{} open order(s), {} filled, {} rejected".format(
+                    len(matchingengine), filled, len(outcomes) - filled))
+        if once:
+            break
+        time.sleep(max(0, current_app.config["MATCHING_INTERVAL"] - (time.time() - started)))
 
 # ---------------------------------------------------------------------------
 #   Desc.:      {MyWebsite} Index Page
@@ -68,23 +463,46 @@ db = SQL("sqlite:///finance.db")
 #
 #   Bugs, Limitations, and Other Notes:
 #   - http://docs.cs50.net/problems/finance/finance.html#code-index-code
+#   - the ETag changes with the user's newest transaction and with each
+#     quote cache period, so a reload within one answers 304 after a
+#     single indexed lookup
 # ---------------------------------------------------------------------------
-@app.route("/", methods=["GET"])
+@route("/", methods=["GET"])
 @login_required
+@userpage(lambda: indexversion(db.latesttransaction(session["user_id"])))
 def index():
     
     # --- Section 010: Retrieve a summary of the users stocks
-    rows = db.execute("SELECT symbol, SUM(amount) AS amount "
-                        + "FROM transactions "
-                        + "WHERE user_id=:user_id "
-                        + "GROUP BY symbol "
-                        + "HAVING SUM(amount) != 0 ",
-                        user_id = session["user_id"])
+    rows = db.portfolio(session["user_id"])
                             
     if len(rows) == 0:
         return render_template("index.html")
     
     # --- Section 020: Lookup the stock information and make a dict
+    # Fetch every quote in one go rather than one round trip per stock
+    quotes = lookup_many([row["symbol"] for row in rows 
+                            if row["symbol"] != USD_sentinel])
+    return portfoliopage(rows, quotes)
+
+# ---------------------------------------------------------------------------
+#   Desc.:      indexversion(latest) / portfoliopage(rows, quotes)
+#   Purpose:    The halves of the index page that don't wait on anything
+#   Author:     Joel Tannas
+#   Date:       
+#
+#   Bugs, Limitations, and Other Notes:
+#   - shared with the async index in asgi.py, which gets 'latest' (the
+#     user's newest transaction id), the rows and the quotes its own way
+#   - the version also turns over every QUOTE_CACHE_TTL seconds of the
+#     app's config, as that is how long its quotes are cached for
+# ---------------------------------------------------------------------------
+def indexversion(latest):
+    """The index page's version for userpage()."""
+    return "{} {} {}".format(session["user_id"], latest,
+                             int(time.time() // current_app.config["QUOTE_CACHE_TTL"]))
+
+def portfoliopage(rows, quotes):
+    """Renders the index page from the portfolio rows and their quotes."""
     total = 0
     stocks = {}
     
@@ -98,9 +516,9 @@ def index():
                     "price" : 1.00,
                     "symbol" : "$"
                     }
-        # Else, use lookup to retrieve the stock info
+        # Else, use the batched lookup to retrieve the stock info
         else:
-            quote = lookup(row["symbol"])
+            quote = quotes[row["symbol"]]
             if quote == None:
                 quote = {
                         "name" : "Unknown Stock",
@@ -113,6 +531,8 @@ def index():
         total += stockval
         
         stocks[row["symbol"]] = {
+                                "units" : row["amount"],
+                                "unitprice" : quote["price"],
                                 "symbol" : quote["symbol"],
                                 "name" : quote["name"],
                                 "price" : usd(quote["price"]),
@@ -134,51 +554,86 @@ def index():
 #   Bugs, Limitations, and Other Notes:
 #   - http://docs.cs50.net/problems/finance/finance.html#code-buy-code
 # ---------------------------------------------------------------------------
-@app.route("/buy", methods=["GET", "POST"])
+@route("/buy", methods=["GET", "POST"])
 @login_required
+@staticpage
 def buy():
     """Buy shares of stock."""
     if request.method == "POST":
         
         # --- Section 010: Pre-transaction validation
-        symbol = request.form.get("symbol")
-        try:
-            units = int(request.form.get("units"))
-            if units < 0:
-                return apology("Use the sell webpage to sell stocks")
-        except ValueError:
-            return apology("That is not a valid cash amount")
-        
-        if not symbol or not units:
-            return apology("Please provide a stock symbol and cash value")
+        symbol, units, problem = buyform()
+        if problem != None:
+            return problem
         
         # --- Section 020: Lookup the current information on the stock
         quote = lookup(symbol)
         if quote == None:
             return apology("Unable to find stock: {}".format(symbol))
             
-        # --- Section 025: Check for sufficient cash to purchase
-        balance = stockbalance(db, session["user_id"], USD_sentinel)
-        if balance == None:
-            return apology("Error getting your USD balance")
-            
-        value = units * quote["price"]
-        if balance < value:
-            return apology("Insufficient funds to complete this transaction")
-        
-        # --- Section 030: Remove the money and add the stock
-        stockmove(db, session["user_id"], USD_sentinel, -1 * value)
-        stockmove(db, session["user_id"], quote["symbol"], units)
-        
-        flash("Transaction Complete")    
-        return render_template("confirmation.html",
-                                action = "bought",
-                                quote = quote, 
-                                amount = "{:,.2f}".format(units))
+        # --- Section 030: Check the cash, remove it and add the stock
+        trade = executetrade(db, session["user_id"], quote["symbol"], 
+                                units, quote["price"])
+        return tradepage(trade, quote)
             
     else:
         return render_template("buy.html")
 
+# ---------------------------------------------------------------------------
+#   Desc.:      buyform() / sellform() / tradepage(trade, quote)
+#   Purpose:    Reads a trade form, and renders a trade's outcome
+#   Author:     Joel Tannas
+#   Date:       
+#
+#   Bugs, Limitations, and Other Notes:
+#   - the forms give (symbol, units, None), or (.., .., apology) when the
+#     form can't be traded; sellform's units may be "Sell All"
+#   - shared with the async buy and sell in asgi.py
+# ---------------------------------------------------------------------------
+def buyform():
+    """Validates the buy form."""
+    symbol = request.form.get("symbol")
+    try:
+        units = int(request.form.get("units"))
+        if units < 0:
+            return symbol, None, apology("Use the sell webpage to sell stocks")
+    except ValueError:
+        return symbol, None, apology("That is not a valid cash amount")
+    
+    if not symbol or not units:
+        return symbol, units, apology("Please provide a stock symbol and cash value")
+    if not listedsymbol(symbol):
+        return symbol, units, apology("Unable to find stock: {}".format(symbol))
+    return symbol, units, None
+
+def sellform():
+    """Validates the sell form."""
+    # Ensure a stock and # of stocks has been provided
+    symbol = request.form.get("symbol")
+    units = request.form.get("units")
+    if units != "Sell All":
+        try:
+            units = int(request.form.get("units"))
+            if units < 0:
+                return symbol, None, apology("Use the buy webpage to buy stocks")
+        except ValueError:
+            return symbol, None, apology("That is not a valid stock amount")
+    
+    if not symbol or not units:
+        return symbol, units, apology("Please provide a stock symbol and number of stocks")
+    return symbol, units, None
+
+def tradepage(trade, quote):
+    """The confirmation page for a trade, or the apology if it failed."""
+    if not trade["ok"]:
+        return apology(trade["error"])
+    
+    flash("Transaction Complete")    
+    return render_template("confirmation.html",
+                            action = trade["action"],
+                            quote = quote, 
+                            amount = "{:,.2f}".format(trade["units"]))
+
 # ---------------------------------------------------------------------------
 #   Desc.:      {MyWebsite}/CHANGEPASSWORD
 #   Purpose:    Allows the user to change their password
@@ -188,47 +643,39 @@ def buy():
 #   Bugs, Limitations, and Other Notes:
 #   - 
 # ---------------------------------------------------------------------------
-@app.route("/changepassword", methods=["GET", "POST"])
+@route("/changepassword", methods=["GET", "POST"])
 @login_required
+@staticpage
 def changepassword():
     """Allows the user to change their password."""
     if request.method == "POST":
         
         # --- Section 010: Validate the inputs
         # get the inputs
-        oldword = pwd_context.encrypt(request.form.get("oldword"))
-        password1 = pwd_context.encrypt(request.form.get("password"))
-        password2 = pwd_context.encrypt(request.form.get("password2"))
+        oldword = request.form.get("oldword")
+        password1 = request.form.get("password")
+        password2 = request.form.get("password2")
         
         # ensure all passwords are submitted
         if not oldword:
-            apology("You must provide your old password for confirmation")
+            return apology("You must provide your old password for confirmation")
         elif not password1 or not password2:
             return apology("must provide a new password in both fields")
             
         # ensure that the passwords match
-        elif not pwd_context.verify(request.form.get("password"), password2):
+        elif password1 != password2:
             return apology("new passwords do not match each other")
             
         # --- Section 020: Verify the old password against the db
         # query database for username
-        rows = db.execute("SELECT * "
-                        + "FROM users "
-                        + "WHERE id = :user_id " 
-                        , user_id=session["user_id"]
-                        )
+        user = db.user_by_id(session["user_id"])
         
         # check the old password
-        if not pwd_context.verify(request.form.get("oldword"), rows[0]["password"]):
+        if not checkpassword(oldword, user["password"])[0]:
             return apology("Invalid old password")
             
-        # --- Section 030: Update the password
-        db.execute("UPDATE users "
-                + "SET password=:newpw "
-                + "WHERE :user_id=:user_id "
-                , newpw = password1
-                , user_id = session["user_id"]
-                )
+        # --- Section 030: Update the password (for this user only)
+        db.set_password(session["user_id"], hashpassword(password1))
                         
         flash("Password changed")
         return redirect(url_for("index"))
@@ -244,8 +691,9 @@ def changepassword():
 #   Bugs, Limitations, and Other Notes:
 #   - http://docs.cs50.net/problems/finance/finance.html#code-buy-code
 # ---------------------------------------------------------------------------
-@app.route("/confirmation", methods=["GET", "POST"])
+@route("/confirmation", methods=["GET", "POST"])
 @login_required
+@staticpage
 def confirmation():
     """Confirms a successful stock buy or sell."""
     if request.method == "POST":
@@ -261,20 +709,113 @@ def confirmation():
 #
 #   Bugs, Limitations, and Other Notes:
 #   - http://docs.cs50.net/problems/finance/finance.html#code-history-code
+#   - paged by transaction id (?before=<id>&limit=N) rather than OFFSET, so
+#     every page is a short walk down the (user_id, id DESC) index
+#   - the ETag changes with the user's newest transaction, so revisiting
+#     an unchanged page answers 304
 # ---------------------------------------------------------------------------
-@app.route("/history")
+@route("/history")
 @login_required
+@userpage(lambda: "{} {}".format(session["user_id"], 
+                                 db.latesttransaction(session["user_id"])))
 def history():
     """Show history of transactions."""
+    
+    # --- Section 010: Read the page position from the query string
+    before = request.args.get("before", HISTORY_NEWEST, type = int)
+    limit = request.args.get("limit", HISTORY_PAGE, type = int)
+    limit = max(1, min(limit, HISTORY_PAGE_MAX))
 
-    # Rerieve the user transactions
-    rows = db.execute("SELECT * FROM transactions "
-                    + "WHERE user_id=:user_id "
-                    + "ORDER BY id DESC",
-                    user_id=session["user_id"])
+    # --- Section 020: Rerieve one page of user transactions
+    # (one extra row tells us whether there is an older page)
+    rows = db.history(session["user_id"], before, limit + 1)
+    
+    older = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        older = rows[-1]["id"]
         
     # Pass them to the history page
-    return render_template("history.html", rows = rows)
+    return render_template("history.html", 
+                            rows = rows, 
+                            older = older,
+                            newest = before != HISTORY_NEWEST,
+                            limit = limit)
+
+# ---------------------------------------------------------------------------
+#   Desc.:      {MyWebsite}/HISTORY/<symbol>
+#   Purpose:    Returns the recorded prices of one stock as JSON
+#   Author:     Joel Tannas
+#   Date:       
+#
+#   Bugs, Limitations, and Other Notes:
+#   - only prices this app has fetched are known (see pricehistory.py);
+#     nothing is asked of the quote provider
+#   - ?start=&end= are seconds since the epoch, defaulting to the last
+#     PRICE_HISTORY_DAYS days
+#   - ?interval=minute, hour or day returns open/high/low/close bars;
+#     ?interval=raw (the default) returns [time, price] pairs, the newest
+#     PRICE_HISTORY_POINTS of them if there are more
+# ---------------------------------------------------------------------------
+@route("/history/<symbol>", methods=["GET"])
+@login_required
+def pricehistoryjson(symbol):
+    """Return one symbol's price history as JSON."""
+    from pricehistory import INTERVALS
+    
+    # --- Section 010: Check the request
+    symbol = symbol.upper()
+    pricehistory = openhistory()
+    if pricehistory == None:
+        return jsonify(error = "price history is not being recorded"), 404
+    if not pricehistory.SYMBOL.match(symbol):
+        return jsonify(error = "not a symbol: {}".format(symbol)), 400
+    interval = request.args.get("interval", "raw")
+    if interval != "raw" and interval not in INTERVALS:
+        return jsonify(error = "interval must be raw, {}".format(
+                        ", ".join(INTERVALS))), 400
+    end = request.args.get("end", time.time(), type = float)
+    start = request.args.get("start", end - PRICE_HISTORY_DAYS * 86400, 
+                             type = float)
+    
+    # --- Section 020: Read the range, as bars or as it was recorded
+    if interval == "raw":
+        records = pricehistory.range(symbol, start, end)
+        truncated = len(records) > PRICE_HISTORY_POINTS
+        records = records[-PRICE_HISTORY_POINTS:]
+        return jsonify(symbol = symbol, interval = interval, 
+                       start = start, end = end, truncated = truncated,
+                       prices = list(zip(records["time"].tolist(), 
+                                         records["price"].tolist())))
+    return jsonify(symbol = symbol, interval = interval, start = start, end = end,
+                   bars = pricehistory.ohlc(symbol, start, end, INTERVALS[interval]))
+
+# ---------------------------------------------------------------------------
+#   Desc.:      {MyWebsite}/EXPORT
+#   Purpose:    Downloads the user's whole transaction history
+#   Author:     Joel Tannas
+#   Date:       
+#
+#   Bugs, Limitations, and Other Notes:
+#   - ?format=csv (default) or ?format=ndjson
+#   - rows are streamed from a database cursor as they are written out,
+#     so memory use does not depend on the size of the ledger
+# ---------------------------------------------------------------------------
+@route("/export", methods=["GET"])
+@login_required
+def export():
+    """Stream the transaction history as CSV or NDJSON."""
+    
+    fmt = request.args.get("format", "csv")
+    if fmt not in EXPORT_FORMATS:
+        return apology("Unknown export format: {}".format(fmt))
+    
+    rows = db.iterhistory(session["user_id"])
+    mimetype, render = EXPORT_FORMATS[fmt]
+    return Response(render(rows), 
+                    mimetype = mimetype,
+                    headers = {"Content-Disposition": 
+                            "attachment; filename=history.{}".format(fmt)})
 
 # ---------------------------------------------------------------------------
 #   Desc.:      {MyWebsite}/INTRO
@@ -285,11 +826,286 @@ def history():
 #   Bugs, Limitations, and Other Notes:
 #   - 
 # ---------------------------------------------------------------------------
-@app.route("/intro", methods=["GET", "POST"])
+@route("/intro", methods=["GET", "POST"])
 @login_required
+@staticpage
 def intro():
     return render_template("intro.html")
 
+# ---------------------------------------------------------------------------
+#   Desc.:      {MyWebsite}/STREAM
+#   Purpose:    Pushes live prices for the user's stocks to the index page
+#   Author:     Joel Tannas
+#   Date:       
+#
+#   Bugs, Limitations, and Other Notes:
+#   - Server-Sent Events: {symbol: price} JSON whenever a price changes,
+#     from the shared poller in pricestream.py
+#   - the symbols are the ones held when the stream opens; the page
+#     reconnects (and so picks up new holdings) when it is reloaded
+#   - each open stream holds a server thread, so it needs a threaded (or
+#     async) server: it answers 404 unless LIVE_PRICES is on, and 503
+#     once STREAM_SUBSCRIBERS streams are open in this process (the
+#     browser then gives up and the page keeps the prices it was drawn
+#     with)
+# ---------------------------------------------------------------------------
+@route("/stream", methods=["GET"])
+@login_required
+def stream():
+    """Stream price updates for the user's holdings."""
+    if not current_app.config["LIVE_PRICES"]:
+        return jsonify(error = "live prices are turned off"), 404
+    symbols = [row["symbol"] for row in db.portfolio(session["user_id"])
+                if row["symbol"] != USD_sentinel]
+    first = {symbol : quote["price"] for symbol, quote in lookup_many(symbols).items()
+                if quote != None}
+    # (the real poller, not the proxy: the body outlives the app context)
+    poller = pricestream._get_current_object()
+    subscription = poller.subscribe(symbols)
+    if subscription == None:
+        return jsonify(error = "too many live price streams open"), 503
+    return Response(events(poller, subscription, first,
+                           current_app.config["STREAM_KEEPALIVE"]),
+                    mimetype = "text/event-stream",
+                    headers = {"Cache-Control" : "no-cache",
+                               "X-Accel-Buffering" : "no"})
+
+# ---------------------------------------------------------------------------
+#   Desc.:      {MyWebsite}/ORDERS
+#   Purpose:    Buys and sells many stocks in one JSON request
+#   Author:     Joel Tannas
+#   Date:       
+#
+#   Bugs, Limitations, and Other Notes:
+#   - takes {"orders": [{"action": "buy"|"sell", "symbol": "AAPL",
+#     "units": 3}, ...], "mode": "atomic"|"best_effort"}; a sell may give
+#     "units": "all" to sell the whole holding
+#   - atomic (the default) executes every order or none of them
+#   - one batched quote lookup, one balance read and one commit for the
+#     whole batch (see executeorders)
+#   - answers 400 if the request itself is malformed, otherwise 200 with
+#     ok (every order executed), cash afterwards, and a result per order
+# ---------------------------------------------------------------------------
+@route("/orders", methods=["POST"])
+@login_required
+def orders():
+    """Execute a batch of buy and sell orders."""
+    
+    # --- Section 010: Validate the batch
+    payload = request.get_json(silent = True)
+    if not isinstance(payload, dict) or not isinstance(payload.get("orders"), list):
+        return jsonify(error = "expected a JSON object with a list of orders"), 400
+    if len(payload["orders"]) > ORDERS_MAX:
+        return jsonify(error = "at most {} orders per batch".format(ORDERS_MAX)), 400
+    mode = payload.get("mode", "atomic")
+    if mode not in ["atomic", "best_effort"]:
+        return jsonify(error = "mode must be 'atomic' or 'best_effort'"), 400
+    
+    # --- Section 020: Validate each order
+    batch = []
+    for order in payload["orders"]:
+        order = order if isinstance(order, dict) else {}
+        action = order.get("action")
+        symbol = order.get("symbol")
+        units = order.get("units")
+        parsed = {
+                "action" : action,
+                "symbol" : symbol.upper() if isinstance(symbol, str) else symbol,
+                "units" : None if units == "all" else units
+                }
+        if action not in ["buy", "sell"]:
+            parsed["error"] = "action must be 'buy' or 'sell'"
+        elif not isinstance(symbol, str) or not symbol:
+            parsed["error"] = "Please provide a stock symbol"
+        elif action == "buy" and not listedsymbol(symbol):
+            parsed["error"] = "Unable to find stock: {}".format(symbol)
+        elif units == "all" and action == "buy":
+            parsed["error"] = "Only a sell can be for all units"
+        elif units != "all" and (not isinstance(units, int) or isinstance(units, bool)
+                                 or units <= 0):
+            parsed["error"] = "units must be a positive whole number"
+        batch.append(parsed)
+    
+    # --- Section 030: Price everything at once and execute
+    quotes = lookup_many([order["symbol"] for order in batch 
+                            if order.get("error") == None])
+    results, cash = executeorders(db, session["user_id"], batch, quotes, 
+                                  atomic = mode == "atomic")
+    return jsonify(ok = all(result["ok"] for result in results),
+                   mode = mode, cash = cash, orders = results)
+
+# ---------------------------------------------------------------------------
+#   Desc.:      {MyWebsite}/LIMITORDERS
+#   Purpose:    Places, lists and cancels resting limit and stop orders
+#   Author:     Joel Tannas
+#   Date:       
+#
+#   Bugs, Limitations, and Other Notes:
+#   - POST {"side": "buy"|"sell", "kind": "limit"|"stop", "symbol": "AAPL",
+#     "units": 3, "price": 120.5} stores an open order; the matching
+#     engine fills it at the quote that first reaches its price (see
+#     matching.py and settlefills)
+#   - a limit buy fills at or below its price, a limit sell at or above;
+#     a stop buy fills once the price rises to it, a stop sell once it
+#     falls to it
+#   - nothing is set aside when the order is placed; the cash or stock is
+#     checked when it fills, and the order is rejected if it isn't there
+#   - GET lists the newest LIMIT_ORDERS_LISTED orders of any status;
+#     DELETE /limitorders/<id> cancels one that is still open
+# ---------------------------------------------------------------------------
+@route("/limitorders", methods=["GET", "POST"])
+@login_required
+def limitorders():
+    """List the user's limit and stop orders, or place a new one."""
+    
+    if request.method == "GET":
+        return jsonify(orders = [dict(row) for row in 
+                        db.userorders(session["user_id"], LIMIT_ORDERS_LISTED)])
+    
+    # --- Section 010: Validate the order
+    order = request.get_json(silent = True)
+    if not isinstance(order, dict):
+        return jsonify(error = "expected a JSON object"), 400
+    units, price = order.get("units"), order.get("price")
+    if order.get("side") not in ORDER_SIDES:
+        return jsonify(error = "side must be 'buy' or 'sell'"), 400
+    if order.get("kind") not in ORDER_KINDS:
+        return jsonify(error = "kind must be 'limit' or 'stop'"), 400
+    if not isinstance(units, int) or isinstance(units, bool) or units <= 0:
+        return jsonify(error = "units must be a positive whole number"), 400
+    if (not isinstance(price, (int, float)) or isinstance(price, bool) 
+            or not price > 0 or price == float("inf")):
+        return jsonify(error = "price must be a positive number"), 400
+    
+    # --- Section 020: Check the stock exists, then store the order
+    symbol = order.get("symbol")
+    if order["side"] == "buy" and isinstance(symbol, str) and not listedsymbol(symbol):
+        return jsonify(error = "Unable to find stock: {}".format(symbol)), 400
+    quote = lookup(symbol.upper()) if isinstance(symbol, str) else None
+    if quote == None:
+        return jsonify(error = "Unable to find stock: {}".format(symbol)), 400
+    order_id = db.placeorder(session["user_id"], quote["symbol"], order["side"],
+                             order["kind"], units, float(price))
+    return jsonify(id = order_id, status = "open", symbol = quote["symbol"]), 201
+
+@route("/limitorders/<int:order_id>", methods=["DELETE"])
+@login_required
+def cancellimitorder(order_id):
+    """Cancel one of the user's open orders."""
+    if not db.cancelorder(session["user_id"], order_id):
+        return jsonify(error = "no open order {}".format(order_id)), 404
+    return jsonify(id = order_id, status = "cancelled")
+
+# ---------------------------------------------------------------------------
+#   Desc.:      {MyWebsite}/PERFORMANCE
+#   Purpose:    Shows the user's account value over time
+#   Author:     Joel Tannas
+#   Date:       
+#
+#   Bugs, Limitations, and Other Notes:
+#   - reads only the stored snapshots (see 'flask snapshot'), never the
+#     quote provider
+#   - ?days=N picks how far back to go; ?format=json returns the series as
+#     JSON instead of a page
+# ---------------------------------------------------------------------------
+@route("/performance", methods=["GET"])
+@login_required
+def performance():
+    """Show the value of the user's account over time."""
+    
+    # --- Section 010: Read the snapshots in the requested window
+    try:
+        days = max(1, int(request.args.get("days", PERFORMANCE_DAYS)))
+    except ValueError:
+        days = PERFORMANCE_DAYS
+    since = time.time() - days * 86400
+    snapshots = [{
+                "taken" : row["taken"],
+                "cash" : row["cash"],
+                "stocks" : row["stocks"],
+                "total" : row["cash"] + row["stocks"]
+                } for row in db.snapshots(session["user_id"], since)]
+    
+    # --- Section 020: Serve them as JSON or as a table
+    if request.args.get("format") == "json":
+        return jsonify(days = days, snapshots = snapshots)
+    
+    for snapshot in snapshots:
+        snapshot["time"] = time.strftime("%Y-%m-%d %H:%M", 
+                                         time.gmtime(snapshot["taken"]))
+    return render_template("performance.html", snapshots = snapshots, days = days)
+
+# ---------------------------------------------------------------------------
+#   Desc.:      {MyWebsite}/ANALYTICS
+#   Purpose:    Reports cost basis, profit and loss, daily returns and
+#               volatility for the user's account as JSON
+#   Author:     Joel Tannas
+#   Date:       
+#
+#   Bugs, Limitations, and Other Notes:
+#   - see analytics.py; the ledger is read in one query and processed
+#     with NumPy, so it stays quick for very long ledgers
+#   - analytics.py (and so NumPy) is imported by the first request here
+#     rather than when a worker starts
+#   - one batched lookup for the current prices of the stocks still held
+#   - returns come from portfolio_snapshots ('flask snapshot')
+# ---------------------------------------------------------------------------
+@route("/analytics", methods=["GET"])
+@login_required
+def analytics():
+    """Return the user's portfolio analytics as JSON."""
+    from analytics import portfolioanalytics
+    
+    ledger = db.ledger(session["user_id"], USD_sentinel)
+    holdings = [row["symbol"] for row in db.portfolio(session["user_id"])
+                if row["symbol"] != USD_sentinel]
+    snapshots = [(row["taken"], row["cash"] + row["stocks"]) 
+                 for row in db.snapshots(session["user_id"], 0)]
+    return jsonify(portfolioanalytics(ledger, lookup_many(holdings), snapshots))
+
+# ---------------------------------------------------------------------------
+#   Desc.:      {MyWebsite}/LEADERBOARD
+#   Purpose:    Ranks every account by its value
+#   Author:     Joel Tannas
+#   Date:       
+#
+#   Bugs, Limitations, and Other Notes:
+#   - read from the leaderboard table, which trades keep up to date; only
+#     when its prices are over LEADERBOARD_TTL old is anything fetched,
+#     and then it is one batched lookup for every held symbol (see
+#     repriceleaderboard)
+#   - the top is a walk down the leaderboard_value index and the user's
+#     own rank a count over it, however many accounts there are
+#   - ?size=N picks how many accounts to show; ?format=json returns JSON
+# ---------------------------------------------------------------------------
+@route("/leaderboard", methods=["GET"])
+@login_required
+def leaderboard():
+    """Show the most valuable accounts and where the user stands."""
+    
+    # --- Section 010: Reprice the accounts if the prices are out of date
+    if time.time() - db.leaderboardpriced() >= LEADERBOARD_TTL:
+        repriceleaderboard(db)
+    
+    # --- Section 020: Read the top of the table and the user's place
+    size = request.args.get("size", LEADERBOARD_SIZE, type = int)
+    size = max(1, min(size, LEADERBOARD_SIZE_MAX))
+    leaders = [{
+            "rank" : rank,
+            "username" : row["username"],
+            "value" : row["value"]
+            } for rank, row in enumerate(db.leaderboard(size), start = 1)]
+    mine = db.leaderboardrank(session["user_id"])
+    you = {"rank" : mine["rank"], "value" : mine["value"]} if mine != None else None
+    cash, stocks = markettotals(db.heldtotals())
+    
+    # --- Section 030: Serve them as JSON or as a table
+    if request.args.get("format") == "json":
+        return jsonify(leaders = leaders, you = you, cash = cash, stocks = stocks,
+                       priced = db.leaderboardpriced())
+    return render_template("leaderboard.html", leaders = leaders, you = you,
+                           cash = cash, stocks = stocks)
+
 # ---------------------------------------------------------------------------
 #   Desc.:      {MyWebsite}/LOGIN
 #   Purpose:    Logs user in
@@ -299,12 +1115,14 @@ def intro():
 #   Bugs, Limitations, and Other Notes:
 #   - 
 # ---------------------------------------------------------------------------
-@app.route("/login", methods=["GET", "POST"])
+@route("/login", methods=["GET", "POST"])
 def login():
     """Log user in."""
 
-    # forget any user_id
-    session.clear()
+    # forget any user_id (without touching the session store if there
+    # was nothing to forget)
+    if len(session) != 0:
+        session.clear()
 
     # if user reached route via POST (as by submitting a form via POST)
     if request.method == "POST":
@@ -318,17 +1136,21 @@ def login():
             return apology("must provide password")
 
         # query database for username
-        rows = db.execute("SELECT * "
-                        + "FROM users "
-                        + "WHERE username = :username", 
-                        username=request.form.get("username"))
+        user = db.user_by_name(request.form.get("username"))
 
         # ensure username exists and password is correct
-        if len(rows) != 1 or not pwd_context.verify(request.form.get("password"), rows[0]["password"]):
+        if user == None:
+            return apology("invalid username and/or password")
+        ok, replacement = checkpassword(request.form.get("password"), user["password"])
+        if not ok:
             return apology("invalid username and/or password")
+        
+        # store a fresh hash if the hash cost has changed since the last login
+        if replacement != None:
+            db.set_password(user["id"], replacement)
 
         # remember which user has logged in
-        session["user_id"] = rows[0]["id"]
+        session["user_id"] = user["id"]
 
         # redirect user to home page
         return redirect(url_for("index"))
@@ -346,7 +1168,7 @@ def login():
 #   Bugs, Limitations, and Other Notes:
 #   - 
 # ---------------------------------------------------------------------------
-@app.route("/logout")
+@route("/logout")
 def logout():
     """Log user out."""
 
@@ -365,22 +1187,18 @@ def logout():
 #   Bugs, Limitations, and Other Notes:
 #   - http://docs.cs50.net/problems/finance/finance.html#code-quote-code
 # ---------------------------------------------------------------------------
-@app.route("/quote", methods=["GET", "POST"])
+@route("/quote", methods=["GET", "POST"])
 @login_required
+@staticpage
 def quote():
     """Get stock quote."""
 
     if request.method == "POST":
         
         # --- Section 010: Pre-lookup validation
-        symbol = request.form.get("symbol")
-        try:
-            units = int(request.form.get("units"))
-        except ValueError:
-            return apology("That is not a valid stock amount")
-        
-        if not symbol or not units:
-            return apology("Please provide a stock symbol and number of stocks")
+        symbol, units, problem = quoteform()
+        if problem != None:
+            return problem
         
         # --- Section 020: Lookup the current information on the stock
         quote = lookup(symbol)
@@ -389,33 +1207,77 @@ def quote():
             
         # --- Section 030: Get the cash balance for comparison
         balance = stockbalance(db, session["user_id"], USD_sentinel)
-        value = units * quote["price"]
-        if balance == None:
-            user_message = "Error: Could not retrieve your cash balance"
-        else:
-            user_message = "Your cash balance is" + usd(balance)
-        
-        return render_template("quoted.html", 
-                                quote = quote, 
-                                amount = "{:,.2f}".format(units),
-                                value = usd(value),
-                                user_message = user_message)
+        return quotedpage(quote, units, balance)
     else:
         return render_template("quote.html")
+
+# ---------------------------------------------------------------------------
+#   Desc.:      quoteform() / quotedpage(quote, units, balance)
+#   Purpose:    Reads the quote form, and renders the quote
+#   Author:     Joel Tannas
+#   Date:       
+#
+#   Bugs, Limitations, and Other Notes:
+#   - shared with the async quote in asgi.py
+# ---------------------------------------------------------------------------
+def quoteform():
+    """Validates the quote form, as buyform() does."""
+    symbol = request.form.get("symbol")
+    try:
+        units = int(request.form.get("units"))
+    except ValueError:
+        return symbol, None, apology("That is not a valid stock amount")
+    
+    if not symbol or not units:
+        return symbol, units, apology("Please provide a stock symbol and number of stocks")
+    if not listedsymbol(symbol):
+        return symbol, units, apology("Unable to find stock: {}".format(symbol))
+    return symbol, units, None
+
+def quotedpage(quote, units, balance):
+    """Renders a quote for 'units' shares beside the cash balance."""
+    value = units * quote["price"]
+    if balance == None:
+        user_message = "Error: Could not retrieve your cash balance"
+    else:
+        user_message = "Your cash balance is" + usd(balance)
+    
+    return render_template("quoted.html", 
+                            quote = quote, 
+                            amount = "{:,.2f}".format(units),
+                            value = usd(value),
+                            user_message = user_message)
         
 # ---------------------------------------------------------------------------
-#   Desc.:      {MyWebsite}/QUOTED
-#   Purpose:    Displays a stock quote for the user
+#   Desc.:      {MyWebsite}/SYMBOLS
+#   Purpose:    Autocomplete for the symbol boxes
 #   Author:     Joel Tannas
 #   Date:       
 #
 #   Bugs, Limitations, and Other Notes:
-#   - http://docs.cs50.net/problems/finance/finance.html#code-quote-code
+#   - ?q=<prefix> returns up to SYMBOL_MATCHES listed symbols whose symbol
+#     or company name starts with it, from the local symbol directory
 # ---------------------------------------------------------------------------
-@app.route("/quote", methods=["GET", "POST"])
+@route("/symbols", methods=["GET"])
 @login_required
-def quoted():
-    return render_template("quoted.html")
+def symbols():
+    """Suggest symbols matching the start of a query."""
+    return jsonify(quotes().symbols.search(request.args.get("q", "")))
+
+# ---------------------------------------------------------------------------
+#   Desc.:      {MyWebsite}/QUOTECACHE
+#   Purpose:    Reports the quote cache counters for tuning
+#   Author:     Joel Tannas
+#   Date:       
+#
+#   Bugs, Limitations, and Other Notes:
+#   - hit/miss/eviction counts are since the process started (per worker)
+# ---------------------------------------------------------------------------
+@route("/quotecache", methods=["GET"])
+@login_required
+def quotecachestats():
+    """Show the quote cache counters as JSON."""
+    return jsonify(quotes().cache.stats())
 
 # ---------------------------------------------------------------------------
 #   Desc.:      {MyWebsite}/REGISTER
@@ -427,7 +1289,8 @@ def quoted():
 #   - http://docs.cs50.net/problems/finance/finance.html#code-register-code
 #   - inspired by the login method made by CS50 (above)
 # ---------------------------------------------------------------------------
-@app.route("/register", methods=["GET", "POST"])
+@route("/register", methods=["GET", "POST"])
+@staticpage
 def register():
     """Register user."""
 
@@ -438,8 +1301,8 @@ def register():
         
         # get the inputs
         username = request.form.get("username")
-        password1 = pwd_context.encrypt(request.form.get("password"))
-        password2 = pwd_context.encrypt(request.form.get("password2"))
+        password1 = request.form.get("password")
+        password2 = request.form.get("password2")
         
         # ensure username was submitted
         if not username:
@@ -450,38 +1313,26 @@ def register():
             return apology("must provide a password in both fields")
             
         # ensure that the passwords match
-        elif not pwd_context.verify(request.form.get("password"), password2):
+        elif password1 != password2:
             return apology("passwords do not match each other")
 
         # --- Section 020: Prevent duplicate users ---
-        rows = db.execute("SELECT * "
-                        + "FROM users " 
-                        + "WHERE username = :username", 
-                        username = username)
-        if len(rows) != 0:
+        if db.user_by_name(username) != None:
             return apology("username has already been taken")
 
         # --- Section 030: Add the user to the database
-        # add the user
-        db.execute("INSERT INTO users(username, password) "
-                + "VALUES (:username, :password)", 
-                username = username, 
-                password = password1)
-            
-        # retrieve the newly created user_id
-        rows = db.execute("SELECT * "
-                        + "FROM users "
-                        + "WHERE username = :username", 
-                        username = username)
-        if len(rows) != 1:
-            return apology("failed to create new user in database")
+        # add the user and retrieve the newly created user_id
+        # (the unique index catches a racing registration of the same name)
+        user_id = db.create_user(username, hashpassword(password1))
+        if user_id == None:
+            return apology("username has already been taken")
         
         # add the starting funds
-        stockmove(db, rows[0]["id"], USD_sentinel, 10000)
+        stockmove(db, user_id, USD_sentinel, 10000)
             
         # --- Section 040: Login the new user & direct to the index 
         session.clear()
-        session["user_id"] = rows[0]["id"]
+        session["user_id"] = user_id
         return redirect(url_for("index"))
 
     # GET request procedure
@@ -497,53 +1348,33 @@ def register():
 #   Bugs, Limitations, and Other Notes:
 #   - http://docs.cs50.net/problems/finance/finance.html#code-sell-code
 # ---------------------------------------------------------------------------
-@app.route("/sell", methods=["GET", "POST"])
+@route("/sell", methods=["GET", "POST"])
 @login_required
+@staticpage
 def sell():
     """Sell shares of stock."""
     if request.method == "POST":
         
         # --- Section 010: Pre-transaction validation
-        # Ensure a stock and # of stocks has been provided
-        symbol = request.form.get("symbol")
-        units = request.form.get("units")
-        if units != "Sell All":
-            try:
-                units = int(request.form.get("units"))
-                if units < 0:
-                    return apology("Use the buy webpage to buy stocks")
-            except ValueError:
-                return apology("That is not a valid stock amount")
-        
-        if not symbol or not units:
-            return apology("Please provide a stock symbol and number of stocks")
+        symbol, units, problem = sellform()
+        if problem != None:
+            return problem
         
         # --- Section 020: Lookup the current information on the stock
         quote = lookup(symbol)
         if quote == None:
             return apology("Unable to find stock: {}".format(symbol))
             
-        # --- Section 025: Check for sufficient stock to sell
-        balance = stockbalance(db, session["user_id"], symbol)
-        if balance == None:
-            return apology("Error getting your stock balance")
-
+        # --- Section 030: Check the holding, remove the stock and add the money
         if units == "Sell All":
-            units = balance
-        elif units < balance:
-            return apology("Insufficient stocks to complete this transaction")
-        
-        # --- Section 030: Remove the stock and add the money
-        value = units * quote["price"]
-        stockmove(db, session["user_id"], USD_sentinel, value)
-        stockmove(db, session["user_id"], quote["symbol"], -1 * units)
+            trade = executetrade(db, session["user_id"], quote["symbol"], 
+                                    0, quote["price"], sellall = True)
+        else:
+            trade = executetrade(db, session["user_id"], quote["symbol"], 
+                                    -1 * units, quote["price"])
         
         # --- Section 040: Render the transaction confirmation
-        flash("Transaction Complete")     
-        return render_template("confirmation.html",
-                                action = "sold",
-                                quote = quote, 
-                                amount = "{:,.2f}".format(units))
+        return tradepage(trade, quote)
     
     # GET request procedure        
     else:
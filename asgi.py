@@ -0,0 +1,398 @@
+# ---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+#   Desc.:      Async serving
+#   Purpose:    Serves the finance app on an ASGI server, with the routes
+#               that wait on quotes (index, quote, buy, sell) as async views
+#               so one process can hold hundreds of requests in flight
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Usage:
+#   uvicorn --factory asgi:create_asgi_app
+#   hypercorn 'asgi:create_asgi_app()'
+#
+#   Licensing Info:
+#   ?
+# ---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+
+# Imports:
+import asyncio
+import contextvars
+import functools
+import inspect
+import io
+import sys
+import threading
+
+from application import (buyform, create_app, db, indexversion, portfoliopage,
+                         quotedpage, quoteform, sellform, tradepage)
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app, render_template, request_started, session
+from flask.ctx import RequestContext
+from helpers import (USD_sentinel, apology, executetrade, login_required,
+                     lookup_async, lookup_many_async, stockbalance)
+from pagecache import userpage
+from werkzeug.exceptions import HTTPException
+
+# 'Constants'
+ASGI_DB_THREADS = 16        # threads running the async views' database calls
+ASGI_WSGI_THREADS = 32      # threads running every other (sync) route
+_unset = object()
+
+# ---------------------------------------------------------------------------
+#   Desc.:      FinanceASGI(app)
+#   Purpose:    The ASGI application wrapped around a create_app() app
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - a request for one of ASYNC_VIEWS (by endpoint and method) runs as a
+#     coroutine on the server's event loop, inside the Flask request
+#     context as usual (Flask keeps it in context variables, which each
+#     asyncio task has its own copy of); its quote lookups are awaited
+#     on the provider loop and its database calls run on ASGI_DB_THREADS
+#     threads, so a slow upstream only holds up the requests waiting on it
+#   - every other request runs the ordinary Flask app on one of
+#     ASGI_WSGI_THREADS threads, streaming its body back as it is made;
+#     an open /stream holds one of them, as it holds a thread under WSGI
+#     (only with LIVE_PRICES on, and at most STREAM_SUBSCRIBERS at once)
+#   - while a sync response is being sent, a task listens for the
+#     client's http.disconnect (some servers' send() quietly does nothing
+#     once the client has gone); the response is then closed at its next
+#     chunk, which for /stream is at most STREAM_KEEPALIVE seconds away,
+#     giving back the thread and the price subscription
+#   - nothing that can block runs on the loop: for an async view the
+#     session is opened, and the hooks run, on the database threads too:
+#       - before_request: instrument's startrequest, and startmatching
+#         (which starts the matching engine on the first request)
+#       - request_started: no receivers in this app
+#       - after_request: instrument's finishrequest, and nocache
+#       - saving the session (a sqlite write with that backend)
+#     the context variables those hooks set are copied back to the task
+#   - what is left on the loop is pushing the request context, error
+#     handlers and teardown (abandonrequest), none of which do I/O; an
+#     error while finishing a request is handled (and the session saved)
+#     on the loop, as Flask has no other way to answer it
+#   - async requests are never sampled by the profiler, since their
+#     hooks start and stop it on different threads
+#   - async responses are sent whole, since they are all rendered pages
+# ---------------------------------------------------------------------------
+class FinanceASGI:
+    """ASGI front for the finance app, with async hot routes."""
+
+    def __init__(self, app):
+        self.app = app
+        self.database = ThreadPoolExecutor(
+                max_workers = app.config.get("ASGI_DB_THREADS", ASGI_DB_THREADS),
+                thread_name_prefix = "asgi-db")
+        self.wsgi = ThreadPoolExecutor(
+                max_workers = app.config.get("ASGI_WSGI_THREADS", ASGI_WSGI_THREADS),
+                thread_name_prefix = "asgi-wsgi")
+        app.extensions["asgi"] = self
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+
+        # --- Section 010: Read the whole request body
+        body = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+        environ = wsgienviron(scope, b"".join(body))
+
+        # --- Section 020: Run it as an async view, or on a thread
+        try:
+            endpoint = self.app.url_map.bind_to_environ(environ).match()[0]
+        except HTTPException:
+            endpoint = None
+        view, methods = ASYNC_VIEWS.get(endpoint, (None, []))
+        if environ["REQUEST_METHOD"] in methods:
+            await self.dispatch(environ, view, send)
+        else:
+            loop = asyncio.get_running_loop()
+            disconnected = threading.Event()
+            watcher = asyncio.ensure_future(self.watch(receive, disconnected))
+            try:
+                await loop.run_in_executor(self.wsgi, self.runwsgi, environ, send,
+                                           loop, disconnected)
+            finally:
+                watcher.cancel()
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type" : "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.close()
+                await send({"type" : "lifespan.shutdown.complete"})
+                return
+
+    def close(self):
+        """Stops the thread pools."""
+        self.database.shutdown(wait = False)
+        self.wsgi.shutdown(wait = False)
+
+    async def dispatch(self, environ, view, send):
+        """Flask's request handling, awaiting the view and its hooks."""
+        app = self.app
+        loop = asyncio.get_running_loop()
+        environ["finance.profile"] = False
+        request = app.request_class(environ)
+        request.json_module = app.json
+        opened = await loop.run_in_executor(self.database, self.opensession, request)
+        context = RequestContext(app, environ, request = request, session = opened)
+        error = None
+        try:
+            try:
+                context.push()
+                rv = await self.hook(self.preprocess)
+                if rv == None:
+                    rv = view(**request.view_args)
+                    if inspect.isawaitable(rv):
+                        rv = await rv
+            except Exception as e:
+                rv = app.handle_user_exception(e)
+            response = await self.hook(app.finalize_request, rv)
+        except Exception as e:
+            error = e
+            response = app.handle_exception(e)
+        finally:
+            context.pop(error)
+
+        chunks, status, headers = response.get_wsgi_response(environ)
+        await send(startmessage(status, headers))
+        await send({"type" : "http.response.body", "body" : b"".join(chunks)})
+
+    async def hook(self, function, *args):
+        """Runs request hooks on the database threads, keeping the context
+        variables they set."""
+        context = contextvars.copy_context()
+        loop = asyncio.get_running_loop()
+        rv = await loop.run_in_executor(self.database, context.run, function, *args)
+        for variable, value in context.items():
+            if variable.get(_unset) is not value:
+                variable.set(value)
+        return rv
+
+    def opensession(self, request):
+        """The request's session, as RequestContext.push() would open it."""
+        interface = self.app.session_interface
+        opened = interface.open_session(self.app, request)
+        if opened == None:
+            opened = interface.make_null_session(self.app)
+        return opened
+
+    def preprocess(self):
+        request_started.send(self.app)
+        return self.app.preprocess_request()
+
+    async def watch(self, receive, disconnected):
+        """Sets 'disconnected' once the client goes away."""
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                disconnected.set()
+                return
+
+    def runwsgi(self, environ, send, loop, disconnected):
+        """Runs the Flask app on this thread, sending its body to 'send'
+        until the client goes away."""
+        started = []
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, headers]
+        def push(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        chunks = self.app(environ, start_response)
+        try:
+            sent = False
+            for chunk in chunks:
+                if disconnected.is_set():
+                    return
+                if not sent:
+                    push(startmessage(*started))
+                    sent = True
+                if chunk:
+                    push({"type" : "http.response.body", "body" : chunk,
+                          "more_body" : True})
+            if not sent:
+                push(startmessage(*started))
+            push({"type" : "http.response.body", "body" : b""})
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+
+# ---------------------------------------------------------------------------
+#   Desc.:      create_asgi_app(config)
+#   Purpose:    create_app(), ready for an ASGI server
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - 'config' goes to create_app(); ASGI_DB_THREADS and ASGI_WSGI_THREADS
+#     in it size the thread pools
+#   - one process is meant to serve many requests at once, so run fewer
+#     workers than with gunicorn's sync workers (one per core is plenty)
+# ---------------------------------------------------------------------------
+def create_asgi_app(config=None):
+    """Returns the finance app as an ASGI application."""
+    return FinanceASGI(create_app(config))
+
+# ---------------------------------------------------------------------------
+#   Desc.:      wsgienviron(scope, body) / startmessage(status, headers)
+#   Purpose:    Translate between ASGI messages and WSGI
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - as in the ASGI spec's WSGI compatibility notes: paths and headers
+#     are latin-1 strings, repeated headers are joined with commas
+#   - the body has been read already, so CONTENT_LENGTH is its length
+#     (a chunked upload has no Content-Length header of its own)
+# ---------------------------------------------------------------------------
+def wsgienviron(scope, body):
+    """The WSGI environ for an http scope and its request body."""
+    root = scope.get("root_path", "")
+    path = scope["path"][len(root):] if scope["path"].startswith(root) else scope["path"]
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD" : scope["method"],
+        "SCRIPT_NAME" : root.encode("utf8").decode("latin1"),
+        "PATH_INFO" : path.encode("utf8").decode("latin1"),
+        "QUERY_STRING" : scope.get("query_string", b"").decode("ascii"),
+        "SERVER_NAME" : server[0],
+        "SERVER_PORT" : str(server[1] or 80),
+        "SERVER_PROTOCOL" : "HTTP/{}".format(scope.get("http_version", "1.1")),
+        "REMOTE_ADDR" : scope["client"][0] if scope.get("client") else "",
+        "wsgi.version" : (1, 0),
+        "wsgi.url_scheme" : scope.get("scheme", "http"),
+        "wsgi.input" : io.BytesIO(body),
+        "wsgi.errors" : sys.stderr,
+        "wsgi.multithread" : True,
+        "wsgi.multiprocess" : True,
+        "wsgi.run_once" : False
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin1").upper().replace("-", "_")
+        if name not in ["CONTENT_LENGTH", "CONTENT_TYPE"]:
+            name = "HTTP_" + name
+        value = value.decode("latin1")
+        environ[name] = environ[name] + "," + value if name in environ else value
+    environ["CONTENT_LENGTH"] = str(len(body))
+    return environ
+
+def startmessage(status, headers):
+    """The http.response.start message for a WSGI status and headers."""
+    return {
+        "type" : "http.response.start",
+        "status" : int(status.split(" ", 1)[0]),
+        "headers" : [(name.lower().encode("latin1"), value.encode("latin1"))
+                        for name, value in headers]
+    }
+
+# ---------------------------------------------------------------------------
+#   Desc.:      asyncview(endpoint, methods) / blocking(function, ...)
+#   Purpose:    Registers an async view, and runs blocking calls for one
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - an async view replaces the sync view of the same endpoint for the
+#     given methods only; the GET pages of buy, sell and quote are cached
+#     (see staticpage) and left to the sync views
+#   - blocking() runs function(*args, **kwargs) on the database threads
+#     with the request's context, and awaits it
+# ---------------------------------------------------------------------------
+ASYNC_VIEWS = {}
+
+def asyncview(endpoint, methods):
+    """Decorator serving 'endpoint' with a coroutine under ASGI."""
+    def decorator(function):
+        ASYNC_VIEWS[endpoint] = (function, methods)
+        return function
+    return decorator
+
+async def blocking(function, *args, **kwargs):
+    """Awaits a blocking call run on the database threads."""
+    loop = asyncio.get_running_loop()
+    call = functools.partial(contextvars.copy_context().run, function, *args, **kwargs)
+    return await loop.run_in_executor(current_app.extensions["asgi"].database, call)
+
+# ---------------------------------------------------------------------------
+#   Desc.:      {MyWebsite} Index Page, /QUOTE, /BUY and /SELL (async)
+#   Purpose:    The async versions of the views in application.py
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - the same steps as the sync views, sharing their form checks and
+#     pages; only the lookups and database calls are awaited
+# ---------------------------------------------------------------------------
+async def indexlatest():
+    return indexversion(await blocking(db.latesttransaction, session["user_id"]))
+
+@asyncview("index", ["GET"])
+@login_required
+@userpage(indexlatest)
+async def index():
+    """Show the user's stocks, awaiting their quotes."""
+    rows = await blocking(db.portfolio, session["user_id"])
+    if len(rows) == 0:
+        return render_template("index.html")
+    quotes = await lookup_many_async([row["symbol"] for row in rows
+                                        if row["symbol"] != USD_sentinel])
+    return portfoliopage(rows, quotes)
+
+@asyncview("quote", ["POST"])
+@login_required
+async def quote():
+    """Get stock quote."""
+    symbol, units, problem = quoteform()
+    if problem != None:
+        return problem
+    quote = await lookup_async(symbol)
+    if quote == None:
+        return apology("Unable to find stock: {}".format(symbol))
+    balance = await blocking(stockbalance, db, session["user_id"], USD_sentinel)
+    return quotedpage(quote, units, balance)
+
+@asyncview("buy", ["POST"])
+@login_required
+async def buy():
+    """Buy shares of stock."""
+    symbol, units, problem = buyform()
+    if problem != None:
+        return problem
+    quote = await lookup_async(symbol)
+    if quote == None:
+        return apology("Unable to find stock: {}".format(symbol))
+    trade = await blocking(executetrade, db, session["user_id"], quote["symbol"],
+                           units, quote["price"])
+    return tradepage(trade, quote)
+
+@asyncview("sell", ["POST"])
+@login_required
+async def sell():
+    """Sell shares of stock."""
+    symbol, units, problem = sellform()
+    if problem != None:
+        return problem
+    quote = await lookup_async(symbol)
+    if quote == None:
+        return apology("Unable to find stock: {}".format(symbol))
+    if units == "Sell All":
+        trade = await blocking(executetrade, db, session["user_id"], quote["symbol"],
+                               0, quote["price"], sellall = True)
+    else:
+        trade = await blocking(executetrade, db, session["user_id"], quote["symbol"],
+                               -1 * units, quote["price"])
+    return tradepage(trade, quote)
@@ -0,0 +1,782 @@
+# ---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+#   Desc.:      Benchmarks
+#   Purpose:    Measures how fast the finance hot paths run
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Usage:
+#   python benchmark.py queries [--users N] [--rows N] [--iterations N]
+#   python benchmark.py routes [--users N] [--rows N] [--requests N]
+#                              [--concurrency N] [--mode test|server|both]
+#   python benchmark.py sessions [--users N] [--rows N] [--requests N]
+#                                [--concurrency N]
+#   python benchmark.py matching [--users N] [--rows N] [--orders N]
+#                                [--symbols N] [--ticks N]
+#   python benchmark.py startup [--users N] [--rows N] [--runs N]
+#   python benchmark.py asgi [--users N] [--rows N] [--requests N]
+#                            [--concurrency N] [--latency SECONDS]
+#   python benchmark.py compare old.json new.json
+#
+#   Every command takes --output FILE to save its results as JSON.
+#   'queries' also times cs50.SQL if requirements-dev.txt is installed.
+#
+#   Licensing Info:
+#   ?
+# ---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+
+# Imports:
+import argparse
+import datetime
+import http.cookiejar
+import json
+import logging
+import os
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+from database import Database
+from schema import migrate
+
+# 'Constants'
+USD_sentinel = "cash_USD"
+SYMBOLS = ["AAPL", "AMZN", "GOOG", "IBM", "INTC", "MSFT", "NFLX", "NVDA",
+           "ORCL", "TSLA"]
+
+# ---------------------------------------------------------------------------
+#   Desc.:      seed(path, users, rows)
+#   Purpose:    Builds a finance database full of made-up trading activity
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - every user is 'userN' with password 'password'
+#   - 'rows' is the ledger size per user; each trade is two rows (cash and
+#     stock), and the positions table (and the aggregates built on it) is
+#     rebuilt to match at the end
+#   - uses a fixed random seed so runs are comparable between commits
+# ---------------------------------------------------------------------------
+def seed(path, users, rows, password="password"):
+    """Creates a database at path with users and ledger rows."""
+    if os.path.exists(path):
+        os.remove(path)
+    migrate(path)
+
+    from passwords import PasswordHasher
+    hashed = PasswordHasher().hash(password)
+
+    rng = random.Random(50)
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.executemany("INSERT INTO users(id, username, password) "
+                            + "VALUES (?, ?, ?)",
+                            [(user, "user{}".format(user), hashed)
+                                for user in range(1, users + 1)])
+        for user in range(1, users + 1):
+            ledger = [(user, USD_sentinel, 10000000, None)]
+            for trade in range(rows // 2):
+                units = rng.randint(1, 20)
+                ledger.append((user, USD_sentinel, -units * 10, None))
+                ledger.append((user, rng.choice(SYMBOLS), units, 10))
+            connection.executemany("INSERT INTO transactions(user_id, symbol, amount, price) "
+                                + "VALUES (?, ?, ?, ?)", ledger)
+    connection.close()
+    Database(path).rebuildpositions()
+
+# ---------------------------------------------------------------------------
+#   Desc.:      timeit(function, iterations)
+#   Purpose:    Times repeated calls and summarises them
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - returns latencies in microseconds
+# ---------------------------------------------------------------------------
+def timeit(function, iterations):
+    """Calls function() repeatedly and returns latency statistics."""
+    samples = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        function(i)
+        samples.append((time.perf_counter() - start) * 1e6)
+    return summarise(samples)
+
+def summarise(samples):
+    """Mean and percentiles of a list of latencies."""
+    samples = sorted(samples)
+    def percentile(p):
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+    return {
+            "count" : len(samples),
+            "mean" : statistics.fmean(samples),
+            "p50" : percentile(50),
+            "p95" : percentile(95),
+            "p99" : percentile(99)
+            }
+
+# ---------------------------------------------------------------------------
+#   Desc.:      benchqueries(path, users, iterations)
+#   Purpose:    Compares per-query latency of database.py and cs50.SQL
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - the cs50.SQL side runs the queries the app used before database.py
+#     (ledger SUM included) and is skipped if cs50 isn't installed
+# ---------------------------------------------------------------------------
+def benchqueries(path, users, iterations):
+    """Times the hot queries through both data access paths."""
+    rng = random.Random(7)
+    user = lambda i: rng.randint(1, users)
+    results = {}
+
+    db = Database(path)
+    results["database.py"] = {
+        "login" : timeit(lambda i: db.user_by_name("user{}".format(user(i))), iterations),
+        "balance" : timeit(lambda i: db.balance(user(i), USD_sentinel), iterations),
+        "portfolio" : timeit(lambda i: db.portfolio(user(i)), iterations),
+        "history page" : timeit(lambda i: db.history(user(i), 2 ** 63 - 1, 51), iterations),
+        "stockmove" : timeit(lambda i: db.move(user(i), USD_sentinel, 0), iterations),
+    }
+
+    try:
+        from cs50 import SQL
+    except ImportError:
+        return results
+
+    sql = SQL("sqlite:///" + path)
+    results["cs50.SQL"] = {
+        "login" : timeit(lambda i: sql.execute(
+                        "SELECT * FROM users WHERE username = :username",
+                        username = "user{}".format(user(i))), iterations),
+        "balance" : timeit(lambda i: sql.execute(
+                        "SELECT symbol, SUM(amount) AS amount FROM transactions "
+                        + "WHERE user_id=:user_id AND symbol=:symbol GROUP BY symbol",
+                        user_id = user(i), symbol = USD_sentinel), iterations),
+        "portfolio" : timeit(lambda i: sql.execute(
+                        "SELECT symbol, SUM(amount) AS amount FROM transactions "
+                        + "WHERE user_id=:user_id GROUP BY symbol "
+                        + "HAVING SUM(amount) != 0",
+                        user_id = user(i)), iterations),
+        "history page" : timeit(lambda i: sql.execute(
+                        "SELECT * FROM transactions WHERE user_id=:user_id "
+                        + "ORDER BY id DESC LIMIT 51",
+                        user_id = user(i)), iterations),
+        "stockmove" : timeit(lambda i: sql.execute(
+                        "INSERT INTO transactions(user_id, symbol, amount) "
+                        + "VALUES (:user_id, :symbol, 0)",
+                        user_id = user(i), symbol = USD_sentinel), iterations),
+    }
+    return results
+
+# ---------------------------------------------------------------------------
+#   Desc.:      ROUTES
+#   Purpose:    The requests the route benchmark makes, by name
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - each is (method, path, form data maker); the maker gets a random
+#     generator so the symbols vary from request to request
+# ---------------------------------------------------------------------------
+ROUTES = {
+    "index" : ("GET", "/", None),
+    "quote" : ("POST", "/quote",
+                lambda rng: {"symbol" : rng.choice(SYMBOLS), "units" : "1"}),
+    "buy" : ("POST", "/buy",
+                lambda rng: {"symbol" : rng.choice(SYMBOLS), "units" : "1"}),
+    "sell" : ("POST", "/sell",
+                lambda rng: {"symbol" : rng.choice(SYMBOLS), "units" : "1"}),
+    "history" : ("GET", "/history", None),
+    "analytics" : ("GET", "/analytics", None),
+    "leaderboard" : ("GET", "/leaderboard", None),
+}
+
+# ---------------------------------------------------------------------------
+#   Desc.:      loadapp(path, config)
+#   Purpose:    Builds the finance app against a benchmark database
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - uses the offline LocalProvider as the stub quote source, and a
+#     private in-memory quote cache so earlier runs don't warm it up
+#   - 'config' adds to (or overrides) those settings
+# ---------------------------------------------------------------------------
+def loadapp(path, config=None):
+    """Returns a finance Flask app, pointed at the database at path."""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from application import create_app
+
+    return create_app(dict(appconfig(path), **(config or {})))
+
+def appconfig(path):
+    """The create_app() settings every benchmark runs the app with."""
+    return {
+        "DATABASE" : path,
+        "ARCHIVE_DATABASE" : os.path.join(os.path.dirname(path), "archive.db"),
+        "PRICE_HISTORY_DIR" : os.path.join(os.path.dirname(path), "prices"),
+        "QUOTE_PROVIDER" : "local",
+        "QUOTE_CACHE_BACKEND" : "memory",
+        "MATCHING_ENGINE" : "off"
+    }
+
+# ---------------------------------------------------------------------------
+#   Desc.:      benchtestclient(app, users, requests)
+#   Purpose:    Drives each route through Flask's test client
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - one request at a time, so this measures the cost of the route code
+#     itself without any server or socket overhead
+# ---------------------------------------------------------------------------
+def benchtestclient(app, users, requests):
+    """Returns per-route latency (ms) and throughput via the test client."""
+    rng = random.Random(10)
+    clients = []
+    for user in range(1, min(users, 10) + 1):
+        client = app.test_client()
+        client.post("/login", data = {"username" : "user{}".format(user),
+                                      "password" : "password"})
+        clients.append(client)
+
+    results = {}
+    for name, (method, path, form) in ROUTES.items():
+        samples = []
+        start = time.perf_counter()
+        for i in range(requests):
+            client = clients[i % len(clients)]
+            data = form(rng) if form != None else None
+            began = time.perf_counter()
+            client.open(path, method = method, data = data)
+            samples.append((time.perf_counter() - began) * 1e3)
+        results[name] = summarise(samples)
+        results[name]["throughput"] = requests / (time.perf_counter() - start)
+    return results
+
+# ---------------------------------------------------------------------------
+#   Desc.:      benchserver(app, users, requests, concurrency)
+#   Purpose:    Drives each route through a real threaded WSGI server
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - werkzeug's threaded server on a free local port; 'concurrency'
+#     client threads, each logged in as its own user, share the requests
+# ---------------------------------------------------------------------------
+def benchserver(app, users, requests, concurrency):
+    """Returns per-route latency (ms) and throughput over HTTP."""
+    base, stop = wsgiserver(app, threaded = True)
+    try:
+        openers = login(base, users, concurrency)
+        return drive(base, openers, ROUTES, requests)
+    finally:
+        stop()
+
+# ---------------------------------------------------------------------------
+#   Desc.:      wsgiserver(app, threaded) / asgiserver(application)
+#   Purpose:    Serve an app on a free local port for the HTTP benchmarks
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - both return (base URL, stop function)
+#   - threaded = False is werkzeug handling one request at a time, as a
+#     gunicorn sync worker does
+#   - asgiserver runs uvicorn on a thread (ImportError if it isn't there)
+# ---------------------------------------------------------------------------
+def wsgiserver(app, threaded):
+    """Starts werkzeug's server for app."""
+    from werkzeug.serving import make_server
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app, threaded = threaded)
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    return "http://127.0.0.1:{}".format(server.server_port), server.shutdown
+
+def asgiserver(application):
+    """Starts uvicorn for an ASGI application."""
+    import socket
+    import uvicorn
+
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    server = uvicorn.Server(uvicorn.Config(application, log_level = "error",
+                                           backlog = 4096))
+    thread = threading.Thread(target = server.run, kwargs = {"sockets" : [listener]},
+                              daemon = True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    def stop():
+        server.should_exit = True
+        thread.join()
+    return "http://127.0.0.1:{}".format(listener.getsockname()[1]), stop
+
+# ---------------------------------------------------------------------------
+#   Desc.:      login(base, users, concurrency) / drive(base, openers,
+#               routes, requests, seed)
+#   Purpose:    Log client threads in, then time routes with all of them
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - one opener (cookie jar) per client thread, each logged in as its own
+#     user; the cookies don't depend on the port, so the openers can be
+#     reused against another server for the same app
+#   - drive() hits each route from all the threads at once; 'seed' varies
+#     the random form data between runs
+# ---------------------------------------------------------------------------
+def login(base, users, concurrency):
+    """Returns 'concurrency' logged-in URL openers."""
+    openers = []
+    for worker in range(concurrency):
+        opener = urllib.request.build_opener(
+                    urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        form = urllib.parse.urlencode({"username" : "user{}".format(worker % users + 1),
+                                       "password" : "password"}).encode()
+        opener.open(base + "/login", form).read()
+        openers.append(opener)
+    return openers
+
+def drive(base, openers, routes, requests, seed=0):
+    """Returns per-route latency (ms) and throughput over HTTP."""
+    concurrency = len(openers)
+    results = {}
+    for name, (method, path, form) in routes.items():
+        samples = []
+        def work(worker):
+            rng = random.Random(seed * concurrency + worker)
+            for i in range(worker, requests, concurrency):
+                data = None
+                if form != None:
+                    data = urllib.parse.urlencode(form(rng)).encode()
+                began = time.perf_counter()
+                openers[worker].open(base + path, data).read()
+                samples.append((time.perf_counter() - began) * 1e3)
+
+        threads = [threading.Thread(target = work, args = (worker,))
+                    for worker in range(concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        results[name] = summarise(samples)
+        results[name]["throughput"] = len(samples) / (time.perf_counter() - start)
+    return results
+
+# ---------------------------------------------------------------------------
+#   Desc.:      benchsessions(app, users, requests, concurrency)
+#   Purpose:    Compares the session backends on the same routes
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - switches the app between each of sessions.SESSION_BACKENDS and runs
+#     the route benchmark over HTTP against it, logging in afresh each time
+#   - logging in (the one request that writes a session) is left out: it
+#     is dominated by password hashing
+# ---------------------------------------------------------------------------
+def benchsessions(app, users, requests, concurrency):
+    """Returns {backend: {route: stats}} over HTTP."""
+    import sessions
+
+    results = {}
+    for backend in sessions.SESSION_BACKENDS:
+        sessions.init_app(app, backend)
+        results[backend] = benchserver(app, users, requests, concurrency)
+    return results
+
+# ---------------------------------------------------------------------------
+#   Desc.:      benchstartup(path, runs)
+#   Purpose:    Times a fresh worker from import to its first responses
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - every run is a new Python process, as a gunicorn worker forked or
+#     recycled without --preload would be, running STARTUP below
+#   - 'import' is importing application.py and all it pulls in, 'create'
+#     is create_app(), 'first page' the first GET /login and 'first
+#     portfolio' the first logged-in GET / (which opens and migrates the
+#     database and prices the holdings); 'process' is the whole run from
+#     launching the interpreter, as the parent sees it
+#   - also prints which of the heavy modules were loaded by the end, to
+#     show that they stay unloaded until a route needs them
+# ---------------------------------------------------------------------------
+STARTUP = """
+import json, sys, time
+started = time.perf_counter()
+import application
+imported = time.perf_counter()
+app = application.create_app(json.loads(sys.argv[1]))
+created = time.perf_counter()
+client = app.test_client()
+client.get("/login")
+page = time.perf_counter()
+with client.session_transaction() as session:
+    session["user_id"] = 1
+client.get("/")
+portfolio = time.perf_counter()
+print(json.dumps({
+    "import" : imported - started,
+    "create" : created - imported,
+    "first page" : page - created,
+    "first portfolio" : portfolio - page,
+    "loaded" : [name for name in ["numpy", "passlib", "aiohttp", "flask_session"]
+                    if name in sys.modules]
+}))
+"""
+
+def benchstartup(path, runs):
+    """Returns the time (ms) each stage of a worker's startup takes."""
+    samples = {"import" : [], "create" : [], "first page" : [],
+               "first portfolio" : [], "process" : []}
+    loaded = set()
+    for run in range(runs):
+        start = time.perf_counter()
+        finished = subprocess.run([sys.executable, "-c", STARTUP,
+                                   json.dumps(appconfig(path))],
+                                  capture_output = True, text = True, check = True,
+                                  cwd = os.path.dirname(os.path.abspath(__file__)))
+        samples["process"].append((time.perf_counter() - start) * 1e3)
+        timings = json.loads(finished.stdout.strip().splitlines()[-1])
+        loaded.update(timings.pop("loaded"))
+        for stage, seconds in timings.items():
+            samples[stage].append(seconds * 1e3)
+
+    print("{} runs; heavy modules loaded by the first portfolio: {}".format(
+            runs, ", ".join(sorted(loaded)) or "none"))
+    return {"startup" : {stage : summarise(times) for stage, times in samples.items()}}
+
+# ---------------------------------------------------------------------------
+#   Desc.:      benchasgi(path, users, requests, concurrency, latency)
+#   Purpose:    Compares the async (ASGI) mode with the sync deployment
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - one process each time, serving ASGI_ROUTES from 'concurrency' client
+#     threads: werkzeug one request at a time (a gunicorn sync worker),
+#     werkzeug with a thread per request, and asgi.py under uvicorn
+#   - the LocalProvider waits 'latency' seconds before every answer, and
+#     quote and buy ask for a symbol nobody has asked for before, so each
+#     of those requests waits on the "upstream" as a cold lookup would;
+#     index and sell use the seeded stocks, whose quotes are soon cached,
+#     so they mostly measure the database reads and the trade itself
+#   - the asgi run is skipped if uvicorn isn't installed
+# ---------------------------------------------------------------------------
+ASGI_ROUTES = {
+    "index" : ("GET", "/", None),
+    "quote" : ("POST", "/quote",
+                lambda rng: {"symbol" : "Q{:07d}".format(rng.randrange(10 ** 7)),
+                             "units" : "1"}),
+    "buy" : ("POST", "/buy",
+                lambda rng: {"symbol" : "B{:07d}".format(rng.randrange(10 ** 7)),
+                             "units" : "1"}),
+    "sell" : ("POST", "/sell",
+                lambda rng: {"symbol" : rng.choice(SYMBOLS), "units" : "1"}),
+}
+
+def benchasgi(path, users, requests, concurrency, latency):
+    """Returns {deployment: {route: stats}} over HTTP."""
+    from asgi import FinanceASGI
+    from helpers import makeprovider
+
+    app = loadapp(path, {"SYMBOL_CHECK" : False})
+    app.extensions["quotes"].provider = makeprovider("local", latency = latency)
+
+    deployments = [("wsgi, one at a time", lambda: wsgiserver(app, threaded = False)),
+                   ("wsgi, threaded", lambda: wsgiserver(app, threaded = True)),
+                   ("asgi", lambda: asgiserver(FinanceASGI(app)))]
+    results = {}
+    openers = None
+    for seed, (name, start) in enumerate(deployments):
+        try:
+            base, stop = start()
+        except ImportError as error:
+            print("{} skipped: {}".format(name, error))
+            continue
+        try:
+            if openers == None:
+                openers = login(base, users, concurrency)
+            app.extensions["quotes"].cache.clear()
+            results[name] = drive(base, openers, ASGI_ROUTES, requests, seed)
+        finally:
+            stop()
+    return results
+
+# ---------------------------------------------------------------------------
+#   Desc.:      seedorders(path, users, orders, symbols)
+#   Purpose:    Adds open limit and stop orders to a benchmark database
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - 'symbols' made-up symbols (SYM0000...), all starting at a price of
+#     100; every user is given 1000 of each so that sells can fill
+#   - each order's price is a few percent on the far side of 100 from
+#     where it fires, so a random walk sets them off gradually
+# ---------------------------------------------------------------------------
+def seedorders(path, users, orders, symbols):
+    """Fills the orders table with open orders; returns the symbols."""
+    rng = random.Random(21)
+    names = ["SYM{:04d}".format(i) for i in range(symbols)]
+    rows = []
+    for i in range(orders):
+        side, kind = rng.choice(["buy", "sell"]), rng.choice(["limit", "stop"])
+        away = abs(rng.gauss(0, 0.05))
+        falling = (side == "buy") == (kind == "limit")
+        rows.append((rng.randint(1, users), rng.choice(names), side, kind,
+                     rng.randint(1, 10), 100 * (1 - away if falling else 1 + away)))
+
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.executemany("INSERT INTO transactions(user_id, symbol, amount, price) "
+                            + "VALUES (?, ?, 1000, 100)",
+                            [(user, name) for user in range(1, users + 1)
+                                for name in names])
+        connection.executemany("INSERT INTO orders(user_id, symbol, side, kind, units, price) "
+                            + "VALUES (?, ?, ?, ?, ?, ?)", rows)
+    connection.close()
+    Database(path).rebuildpositions()
+    return names
+
+# ---------------------------------------------------------------------------
+#   Desc.:      benchmatching(path, users, orders, symbols, ticks)
+#   Purpose:    Times the matching engine over a large book of open orders
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - prices come from a stub that moves every symbol it is asked for by
+#     a 1% random walk and counts its calls, to show that each tick is
+#     one batched fetch however many orders there are
+#   - 'load' is reading every open order into the books; 'tick' is one
+#     engine tick: new orders, fetch, match, and settling the fills
+# ---------------------------------------------------------------------------
+def benchmatching(path, users, orders, symbols, ticks):
+    """Returns load and tick latency (ms) for the matching engine."""
+    from helpers import settlefills
+    from matching import MatchingEngine
+
+    names = seedorders(path, users, orders, symbols)
+    rng = random.Random(22)
+    prices = {name : 100.0 for name in names}
+    fetches = []
+    def fetch(wanted):
+        fetches.append(len(wanted))
+        for symbol in wanted:
+            prices[symbol] *= 1 + rng.gauss(0, 0.01)
+        return {symbol : {"symbol" : symbol, "price" : prices[symbol]} for symbol in wanted}
+
+    db = Database(path)
+    engine = MatchingEngine(db.openorders, fetch, lambda fills: settlefills(db, fills),
+                            resync = ticks + 1)
+    start = time.perf_counter()
+    engine.sync()
+    load = (time.perf_counter() - start) * 1e3
+
+    samples = []
+    outcomes = []
+    for tick in range(ticks):
+        start = time.perf_counter()
+        outcomes.extend(engine.tick())
+        samples.append((time.perf_counter() - start) * 1e3)
+
+    filled = len([outcome for outcome in outcomes if outcome["status"] == "filled"])
+    print("{} orders on {} symbols: {} filled, {} rejected, {} still open".format(
+            orders, symbols, filled, len(outcomes) - filled, len(engine)))
+    print("{} quote fetches in {} ticks, at most {} symbols each".format(
+            len(fetches), ticks, max(fetches, default = 0)))
+    return {"matching" : {"load" : summarise([load]), "tick" : summarise(samples)}}
+
+# ---------------------------------------------------------------------------
+#   Desc.:      compare(old, new)
+#   Purpose:    Shows how two saved benchmark runs differ
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - prints p50, p95 and throughput side by side with the change in %
+# ---------------------------------------------------------------------------
+def compare(old, new):
+    """Prints the differences between two results files."""
+    print("old: {commit} {time}".format(**old["run"]))
+    print("new: {commit} {time}".format(**new["run"]))
+    for group, rows in new["results"].items():
+        print(group)
+        for name, stats in rows.items():
+            before = old["results"].get(group, {}).get(name)
+            if before == None:
+                continue
+            line = "    {:<16}".format(name)
+            for key in ["p50", "p95", "throughput"]:
+                if key in stats and key in before and before[key] != 0:
+                    change = (stats[key] - before[key]) / before[key] * 100
+                    line += "  {} {:>9.2f} -> {:>9.2f} ({:+.0f}%)".format(
+                                key, before[key], stats[key], change)
+            print(line)
+
+def save(path, args, results):
+    """Writes results to a JSON file along with what produced them."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                                capture_output = True, text = True,
+                                cwd = os.path.dirname(os.path.abspath(__file__))
+                                ).stdout.strip()
+    except OSError:
+        commit = "unknown"
+    run = {
+        "commit" : commit or "unknown",
+        "time" : datetime.datetime.now().isoformat(timespec = "seconds"),
+        "args" : {key : value for key, value in vars(args).items()
+                    if key not in ["output"]}
+    }
+    with open(path, "w") as output:
+        json.dump({"run" : run, "results" : results}, output, indent = 2)
+
+# ---------------------------------------------------------------------------
+#   Desc.:      report(results)
+#   Purpose:    Prints benchmark results as a table
+#   Author:     Joel Tannas
+#   Date:
+# ---------------------------------------------------------------------------
+def report(results, unit="us"):
+    """Prints {group: {name: stats}} as aligned columns."""
+    for group, rows in results.items():
+        print(group)
+        for name, stats in rows.items():
+            line = ("    {:<16} mean {:>10.1f}{u}  p50 {:>10.1f}{u}  "
+                    "p95 {:>10.1f}{u}  p99 {:>10.1f}{u}".format(
+                    name, stats["mean"], stats["p50"], stats["p95"],
+                    stats["p99"], u = unit))
+            if "throughput" in stats:
+                line += "  {:>8.1f} req/s".format(stats["throughput"])
+            print(line)
+
+# ---------------------------------------------------------------------------
+#   Desc.:      main()
+#   Purpose:    Command line entry point
+#   Author:     Joel Tannas
+#   Date:
+# ---------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description = "Finance benchmarks")
+    commands = parser.add_subparsers(dest = "command", required = True)
+
+    queries = commands.add_parser("queries", help = "per-query latency")
+    queries.add_argument("--users", type = int, default = 100)
+    queries.add_argument("--rows", type = int, default = 2000,
+                         help = "ledger rows per user")
+    queries.add_argument("--iterations", type = int, default = 2000)
+
+    routes = commands.add_parser("routes", help = "per-route latency and throughput")
+    routes.add_argument("--users", type = int, default = 20)
+    routes.add_argument("--rows", type = int, default = 2000,
+                        help = "ledger rows per user")
+    routes.add_argument("--requests", type = int, default = 500,
+                        help = "requests per route")
+    routes.add_argument("--concurrency", type = int, default = 8)
+    routes.add_argument("--mode", choices = ["test", "server", "both"],
+                        default = "both")
+
+    sessioned = commands.add_parser("sessions", help = "session backend comparison")
+    sessioned.add_argument("--users", type = int, default = 20)
+    sessioned.add_argument("--rows", type = int, default = 200,
+                           help = "ledger rows per user")
+    sessioned.add_argument("--requests", type = int, default = 500,
+                           help = "requests per route")
+    sessioned.add_argument("--concurrency", type = int, default = 8)
+
+    matcher = commands.add_parser("matching", help = "matching engine throughput")
+    matcher.add_argument("--users", type = int, default = 100)
+    matcher.add_argument("--rows", type = int, default = 0,
+                         help = "ledger rows per user")
+    matcher.add_argument("--orders", type = int, default = 100000)
+    matcher.add_argument("--symbols", type = int, default = 500)
+    matcher.add_argument("--ticks", type = int, default = 20)
+
+    startup = commands.add_parser("startup", help = "worker import-to-first-response time")
+    startup.add_argument("--users", type = int, default = 20)
+    startup.add_argument("--rows", type = int, default = 200,
+                         help = "ledger rows per user")
+    startup.add_argument("--runs", type = int, default = 20)
+
+    asynced = commands.add_parser("asgi", help = "async (ASGI) mode against the sync app")
+    asynced.add_argument("--users", type = int, default = 20)
+    asynced.add_argument("--rows", type = int, default = 200,
+                         help = "ledger rows per user")
+    asynced.add_argument("--requests", type = int, default = 200,
+                         help = "requests per route")
+    asynced.add_argument("--concurrency", type = int, default = 64)
+    asynced.add_argument("--latency", type = float, default = 0.05,
+                         help = "seconds the stub quote provider takes to answer")
+
+    for command in [queries, routes, sessioned, matcher, startup, asynced]:
+        command.add_argument("--output", help = "save results to this JSON file")
+
+    differ = commands.add_parser("compare", help = "compare two saved runs")
+    differ.add_argument("old")
+    differ.add_argument("new")
+
+    args = parser.parse_args()
+    if args.command == "compare":
+        with open(args.old) as old, open(args.new) as new:
+            compare(json.load(old), json.load(new))
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "finance.db")
+        seed(path, args.users, args.rows)
+
+        if args.command == "queries":
+            results = benchqueries(path, args.users, args.iterations)
+            report(results)
+
+        elif args.command == "routes":
+            app = loadapp(path)
+            results = {}
+            if args.mode in ["test", "both"]:
+                results["test client"] = benchtestclient(app, args.users, args.requests)
+            if args.mode in ["server", "both"]:
+                results["wsgi server"] = benchserver(app, args.users,
+                                                     args.requests, args.concurrency)
+            report(results, unit = "ms")
+
+        elif args.command == "sessions":
+            results = benchsessions(loadapp(path), args.users,
+                                    args.requests, args.concurrency)
+            report(results, unit = "ms")
+
+        elif args.command == "matching":
+            results = benchmatching(path, args.users, args.orders,
+                                    args.symbols, args.ticks)
+            report(results, unit = "ms")
+
+        elif args.command == "startup":
+            results = benchstartup(path, args.runs)
+            report(results, unit = "ms")
+
+        elif args.command == "asgi":
+            results = benchasgi(path, args.users, args.requests,
+                                args.concurrency, args.latency)
+            report(results, unit = "ms")
+
+    if args.output:
+        save(args.output, args, results)
+
+if __name__ == "__main__":
+    main()
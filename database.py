@@ -0,0 +1,561 @@
+# ---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+#   Desc.:      Data access layer
+#   Purpose:    All of the SQL used by finance, behind typed methods, on
+#               pooled and tuned SQLite connections
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Licensing Info:
+#   ?
+# ---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+
+# Imports:
+import json
+import sqlite3
+import threading
+
+from contextlib import contextmanager
+from instrument import span
+from schema import attacharchive
+
+# 'Constants'
+HISTORY_COLUMNS = ["id", "symbol", "amount", "price", "timestamp"]
+
+# ---------------------------------------------------------------------------
+#   Desc.:      PRAGMAS
+#   Purpose:    Settings applied to every connection when it is opened
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - WAL lets readers carry on while a trade is being written
+#   - synchronous=NORMAL is safe in WAL mode; a power cut can lose the last
+#     few commits but never corrupts the file
+#   - cache_size is negative so it is in KiB (64 MiB), mmap_size in bytes
+# ---------------------------------------------------------------------------
+PRAGMAS = {
+    "journal_mode" : "WAL",
+    "synchronous" : "NORMAL",
+    "cache_size" : -65536,
+    "mmap_size" : 268435456,
+    "temp_store" : "MEMORY",
+    "busy_timeout" : 5000
+}
+
+# ---------------------------------------------------------------------------
+#   Desc.:      STATEMENTS
+#   Purpose:    Every SQL statement the app runs, by name
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - the text of each statement never changes, so sqlite3's per-connection
+#     statement cache prepares each one once and reuses it afterwards
+# ---------------------------------------------------------------------------
+STATEMENTS = {
+    "user_by_id" :
+        "SELECT * FROM users WHERE id = :user_id",
+    "user_by_name" :
+        "SELECT * FROM users WHERE username = :username",
+    "create_user" :
+        "INSERT INTO users(username, password) VALUES (:username, :password)",
+    "set_password" :
+        "UPDATE users SET password = :password WHERE id = :user_id",
+
+    "balance" :
+        "SELECT amount FROM positions WHERE user_id = :user_id AND symbol = :symbol",
+    "balances" :
+        "SELECT symbol, amount FROM positions "
+        + "WHERE user_id = :user_id AND symbol IN (:first, :second)",
+    "portfolio" :
+        "SELECT symbol, amount FROM positions "
+        + "WHERE user_id = :user_id AND amount != 0",
+    "latest_transaction" :
+        "SELECT MAX(id) AS id FROM transactions WHERE user_id = :user_id",
+    "history" :
+        "SELECT " + ", ".join(HISTORY_COLUMNS) + " FROM transactions "
+        + "WHERE user_id = :user_id AND id < :before AND checkpoint IS NULL "
+        + "UNION ALL "
+        + "SELECT " + ", ".join(HISTORY_COLUMNS) + " FROM archive.transactions "
+        + "WHERE user_id = :user_id AND id < :before "
+        + "ORDER BY id DESC LIMIT :limit",
+    "history_all" :
+        "SELECT " + ", ".join(HISTORY_COLUMNS) + " FROM transactions "
+        + "WHERE user_id = :user_id AND checkpoint IS NULL "
+        + "UNION ALL "
+        + "SELECT " + ", ".join(HISTORY_COLUMNS) + " FROM archive.transactions "
+        + "WHERE user_id = :user_id "
+        + "ORDER BY id DESC",
+    "ledger" :
+        "SELECT symbol, amount, price FROM transactions "
+        + "WHERE user_id = :user_id AND symbol != :cash ORDER BY id",
+
+    "all_positions" :
+        "SELECT user_id, symbol, amount FROM positions WHERE amount != 0",
+    "snapshots" :
+        "SELECT taken, cash, stocks FROM portfolio_snapshots "
+        + "WHERE user_id = :user_id AND taken >= :since ORDER BY taken",
+
+    "ledger_insert" :
+        "INSERT INTO transactions(user_id, symbol, amount, price) "
+        + "VALUES (:user_id, :symbol, :amount, :price)",
+    "position_add" :
+        "INSERT INTO positions(user_id, symbol, amount) "
+        + "VALUES (:user_id, :symbol, :amount) "
+        + "ON CONFLICT(user_id, symbol) "
+        + "DO UPDATE SET amount = amount + excluded.amount",
+    "trade_ledger_insert" :
+        "INSERT INTO transactions(user_id, symbol, amount, price) "
+        + "VALUES (:user_id, :cash, :value, NULL), (:user_id, :symbol, :units, :price)",
+    "trade_position_add" :
+        "INSERT INTO positions(user_id, symbol, amount) "
+        + "VALUES (:user_id, :cash, :value), (:user_id, :symbol, :units) "
+        + "ON CONFLICT(user_id, symbol) "
+        + "DO UPDATE SET amount = amount + excluded.amount",
+
+    "total_add" :
+        "INSERT INTO holdings_totals(symbol, amount) VALUES (:symbol, :amount) "
+        + "ON CONFLICT(symbol) DO UPDATE SET amount = amount + excluded.amount",
+    "leaderboard_add" :
+        "INSERT INTO leaderboard(user_id, value) "
+        + "VALUES (:user_id, :amount * COALESCE((SELECT price FROM leaderboard_prices "
+        + "WHERE symbol = :symbol), 0)) "
+        + "ON CONFLICT(user_id) DO UPDATE SET value = value + excluded.value",
+    "held_totals" :
+        "SELECT holdings_totals.symbol, holdings_totals.amount, leaderboard_prices.price "
+        + "FROM holdings_totals LEFT JOIN leaderboard_prices USING (symbol) "
+        + "WHERE holdings_totals.amount != 0",
+    "leaderboard_priced" :
+        "SELECT MAX(priced) AS priced FROM leaderboard_prices",
+    "leaderboard_price_seed" :
+        "INSERT OR IGNORE INTO leaderboard_prices(symbol, price) VALUES (:symbol, :price)",
+    "leaderboard_price_set" :
+        "INSERT OR REPLACE INTO leaderboard_prices(symbol, price, priced) "
+        + "VALUES (:symbol, :price, :priced)",
+    "leaderboard_attempt" :
+        "UPDATE leaderboard_prices SET priced = :priced WHERE symbol = :cash",
+    "leaderboard_fill" :
+        "INSERT OR REPLACE INTO leaderboard(user_id, value) "
+        + "SELECT positions.user_id, SUM(positions.amount * leaderboard_prices.price) "
+        + "FROM positions JOIN leaderboard_prices USING (symbol) "
+        + "GROUP BY positions.user_id",
+    "leaderboard_top" :
+        "SELECT leaderboard.user_id, users.username, leaderboard.value "
+        + "FROM leaderboard JOIN users ON users.id = leaderboard.user_id "
+        + "ORDER BY leaderboard.value DESC LIMIT :limit",
+    "leaderboard_rank" :
+        "SELECT value, (SELECT COUNT(*) FROM leaderboard AS ahead "
+        + "             WHERE ahead.value > leaderboard.value) + 1 AS rank "
+        + "FROM leaderboard WHERE user_id = :user_id",
+
+    "snapshot_insert" :
+        "INSERT OR REPLACE INTO portfolio_snapshots(user_id, taken, cash, stocks) "
+        + "VALUES (:user_id, :taken, :cash, :stocks)",
+
+    "order_insert" :
+        "INSERT INTO orders(user_id, symbol, side, kind, units, price) "
+        + "VALUES (:user_id, :symbol, :side, :kind, :units, :price)",
+    "order_cancel" :
+        "UPDATE orders SET status = 'cancelled', settled = CURRENT_TIMESTAMP "
+        + "WHERE id = :order_id AND user_id = :user_id AND status = 'open'",
+    "user_orders" :
+        "SELECT * FROM orders WHERE user_id = :user_id ORDER BY id DESC LIMIT :limit",
+    "open_orders" :
+        "SELECT id, user_id, symbol, side, kind, units, price FROM orders "
+        + "WHERE status = 'open' AND id > :after ORDER BY id",
+    "still_open" :
+        "SELECT id FROM orders WHERE status = 'open' "
+        + "AND id IN (SELECT value FROM json_each(:ids))",
+    "some_positions" :
+        "SELECT positions.user_id, positions.symbol, positions.amount "
+        + "FROM json_each(:pairs) AS pairs CROSS JOIN positions "
+        + "ON positions.user_id = json_extract(pairs.value, '$[0]') "
+        + "AND positions.symbol = json_extract(pairs.value, '$[1]')",
+    "order_settle" :
+        "UPDATE orders SET status = :status, reason = :reason, "
+        + "fill_price = :fill_price, settled = CURRENT_TIMESTAMP "
+        + "WHERE id = :id AND status = 'open'",
+
+    "compaction_cutoff" :
+        "SELECT MAX(id) AS id FROM transactions WHERE timestamp < :before",
+    "compaction_sums" :
+        "SELECT user_id, symbol, SUM(amount) AS amount, "
+        + "MAX(id) AS id, MAX(timestamp) AS timestamp, "
+        + "SUM(checkpoint IS NULL) AS raw "
+        + "FROM transactions WHERE id <= :cutoff GROUP BY user_id, symbol",
+    "compaction_legs" :
+        "SELECT user_id, symbol, amount, price FROM transactions "
+        + "WHERE id <= :cutoff AND symbol != :cash ORDER BY user_id, id",
+    "archive_copy" :
+        "INSERT OR IGNORE INTO archive.transactions"
+        + "(id, user_id, symbol, amount, price, timestamp) "
+        + "SELECT id, user_id, symbol, amount, price, timestamp FROM transactions "
+        + "WHERE id <= :cutoff AND checkpoint IS NULL",
+    "compaction_delete" :
+        "DELETE FROM transactions WHERE id <= :cutoff",
+    "checkpoint_insert" :
+        "INSERT INTO transactions(id, user_id, symbol, amount, price, timestamp, checkpoint) "
+        + "VALUES (:id, :user_id, :symbol, :amount, :price, :timestamp, :checkpoint)",
+
+    "positions_drift" :
+        "SELECT user_id, symbol, "
+        + "SUM(ledger) AS ledger, SUM(position) AS position "
+        + "FROM (SELECT user_id, symbol, amount AS ledger, 0 AS position "
+        + "      FROM transactions "
+        + "      UNION ALL "
+        + "      SELECT user_id, symbol, 0 AS ledger, amount AS position "
+        + "      FROM positions) "
+        + "GROUP BY user_id, symbol "
+        + "HAVING ABS(SUM(ledger) - SUM(position)) > 1e-9 "
+        + "ORDER BY user_id, symbol",
+    "positions_clear" :
+        "DELETE FROM positions",
+    "positions_fill" :
+        "INSERT INTO positions(user_id, symbol, amount) "
+        + "SELECT user_id, symbol, SUM(amount) "
+        + "FROM transactions "
+        + "GROUP BY user_id, symbol",
+    "totals_clear" :
+        "DELETE FROM holdings_totals",
+    "totals_fill" :
+        "INSERT INTO holdings_totals(symbol, amount) "
+        + "SELECT symbol, SUM(amount) FROM positions GROUP BY symbol",
+}
+
+# ---------------------------------------------------------------------------
+#   Desc.:      Database(path, archive)
+#   Purpose:    The finance database, one connection per thread
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - connections are opened on first use in each thread and then kept, so
+#     a worker thread pays the connect and PRAGMA cost once
+#   - connections are in autocommit mode; use 'with db.transaction():' to
+#     group statements. Transactions nest (only the outermost one commits)
+#     and start with BEGIN IMMEDIATE so the write lock is taken up front.
+#   - rows come back as sqlite3.Row, which supports row["column"]
+#   - every write to positions also goes through aggregate(), in the same
+#     transaction, so holdings_totals and the leaderboard never lag it
+#   - 'archive' is the file 'flask compact' moves old ledger rows into; it
+#     is attached to every connection, and the history queries read it
+#     along with the live table (None attaches an empty one in memory)
+# ---------------------------------------------------------------------------
+class Database:
+    """Pooled SQLite connections with named statements."""
+
+    def __init__(self, path, pragmas=PRAGMAS, archive=None):
+        self.path = path
+        self.pragmas = pragmas
+        self.archive = archive
+        self._local = threading.local()
+
+    # --- Connections and statements
+
+    def connect(self):
+        """Opens a new tuned connection (not shared with other threads)."""
+        connection = sqlite3.connect(self.path,
+                                     isolation_level = None,
+                                     check_same_thread = False,
+                                     cached_statements = len(STATEMENTS) + 32)
+        connection.row_factory = sqlite3.Row
+        for pragma, value in self.pragmas.items():
+            connection.execute("PRAGMA {} = {}".format(pragma, value))
+        attacharchive(connection, self.archive or ":memory:")
+        return connection
+
+    @property
+    def connection(self):
+        """This thread's connection, opened on first use."""
+        connection = getattr(self._local, "connection", None)
+        if connection == None:
+            connection = self._local.connection = self.connect()
+            self._local.depth = 0
+        return connection
+
+    def close(self):
+        """Closes this thread's connection, if it has one."""
+        connection = getattr(self._local, "connection", None)
+        if connection != None:
+            connection.close()
+            self._local.connection = None
+
+    def query(self, name, **params):
+        """Runs a named SELECT and returns all of its rows."""
+        with span("db"):
+            return self.connection.execute(STATEMENTS[name], params).fetchall()
+
+    def execute(self, name, **params):
+        """Runs a named statement and returns the last inserted row id."""
+        with span("db"):
+            return self.connection.execute(STATEMENTS[name], params).lastrowid
+
+    def executemany(self, name, rows):
+        """Runs a named statement once per dict in rows."""
+        with span("db"):
+            self.connection.executemany(STATEMENTS[name], rows)
+
+    @contextmanager
+    def transaction(self):
+        """Groups the statements in a with block into one transaction."""
+        connection = self.connection
+        if self._local.depth == 0:
+            connection.execute("BEGIN IMMEDIATE")
+        self._local.depth += 1
+        try:
+            yield self
+        except:
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                connection.execute("ROLLBACK")
+            raise
+        self._local.depth -= 1
+        if self._local.depth == 0:
+            connection.execute("COMMIT")
+
+    # --- Users
+
+    def user_by_id(self, user_id):
+        """Returns the user row, or None."""
+        rows = self.query("user_by_id", user_id = user_id)
+        return rows[0] if len(rows) == 1 else None
+
+    def user_by_name(self, username):
+        """Returns the user row, or None."""
+        rows = self.query("user_by_name", username = username)
+        return rows[0] if len(rows) == 1 else None
+
+    def create_user(self, username, password):
+        """Adds a user and returns their id (None if the name is taken)."""
+        try:
+            return self.execute("create_user", username = username, password = password)
+        except sqlite3.IntegrityError:
+            return None
+
+    def set_password(self, user_id, password):
+        """Replaces a user's password hash."""
+        self.execute("set_password", user_id = user_id, password = password)
+
+    # --- Holdings
+
+    def balance(self, user_id, symbol):
+        """Returns how much of a symbol the user holds, or None."""
+        rows = self.query("balance", user_id = user_id, symbol = symbol)
+        return rows[0]["amount"] if len(rows) == 1 else None
+
+    def balances(self, user_id, first, second):
+        """Returns {symbol: amount} for two symbols the user holds."""
+        rows = self.query("balances", user_id = user_id, first = first, second = second)
+        return {row["symbol"] : row["amount"] for row in rows}
+
+    def portfolio(self, user_id):
+        """Returns the user's non-zero holdings as (symbol, amount) rows."""
+        return self.query("portfolio", user_id = user_id)
+
+    def move(self, user_id, symbol, amount, price=None):
+        """Adds one ledger row and applies it to positions; returns its id."""
+        with self.transaction():
+            rowid = self.execute("ledger_insert", user_id = user_id,
+                                    symbol = symbol, amount = amount, price = price)
+            self.execute("position_add", user_id = user_id,
+                            symbol = symbol, amount = amount)
+            self.aggregate([(user_id, symbol, amount, price)])
+        return rowid
+
+    def trade(self, user_id, cash, value, symbol, units, price):
+        """Writes both legs of a trade (call inside a transaction)."""
+        legs = dict(user_id = user_id, cash = cash, value = value,
+                    symbol = symbol, units = units, price = price)
+        self.execute("trade_ledger_insert", **legs)
+        self.execute("trade_position_add", **legs)
+        self.aggregate([(user_id, cash, value, None), (user_id, symbol, units, price)])
+
+    def tradelegs(self, user_id, legs):
+        """Writes many (symbol, amount, price) legs (call inside a transaction)."""
+        totals = {}
+        for symbol, amount, price in legs:
+            totals[symbol] = totals.get(symbol, 0) + amount
+        self.executemany("ledger_insert", [
+                {"user_id" : user_id, "symbol" : symbol, "amount" : amount, "price" : price}
+                for symbol, amount, price in legs])
+        self.executemany("position_add", [
+                {"user_id" : user_id, "symbol" : symbol, "amount" : amount}
+                for symbol, amount in totals.items()])
+        self.aggregate([(user_id, symbol, amount, price) for symbol, amount, price in legs])
+
+    def aggregate(self, legs):
+        """Applies (user_id, symbol, amount, price) legs to the aggregates."""
+        self.executemany("total_add", [{"symbol" : symbol, "amount" : amount}
+                                       for user_id, symbol, amount, price in legs])
+        self.executemany("leaderboard_price_seed", [{"symbol" : symbol, "price" : price}
+                                       for user_id, symbol, amount, price in legs
+                                       if price != None])
+        self.executemany("leaderboard_add", [
+                {"user_id" : user_id, "symbol" : symbol, "amount" : amount}
+                for user_id, symbol, amount, price in legs])
+
+    def positionsdrift(self):
+        """Lists the holdings where positions and the ledger disagree."""
+        return self.query("positions_drift")
+
+    def rebuildpositions(self):
+        """Replaces the positions table with sums over the ledger."""
+        with self.transaction():
+            self.execute("positions_clear")
+            self.execute("positions_fill")
+            self.execute("totals_clear")
+            self.execute("totals_fill")
+            self.execute("leaderboard_fill")
+
+    def allpositions(self):
+        """Returns every user's non-zero holdings as (user_id, symbol, amount)."""
+        return self.query("all_positions")
+
+    def ledger(self, user_id, cash):
+        """Returns every non-cash leg as plain (symbol, amount, price) tuples."""
+        with span("db"):
+            cursor = self.connection.cursor()
+            cursor.row_factory = None
+            return cursor.execute(STATEMENTS["ledger"],
+                                  {"user_id" : user_id, "cash" : cash}).fetchall()
+
+    # --- Leaderboard
+
+    def heldtotals(self):
+        """Returns (symbol, total held by all users, leaderboard price) rows."""
+        return self.query("held_totals")
+
+    def leaderboardpriced(self):
+        """Returns when a repricing was last tried (0 for never)."""
+        return self.query("leaderboard_priced")[0]["priced"] or 0
+
+    def repriceleaderboard(self, prices, priced, cash):
+        """Stores {symbol: price} and revalues every account at them."""
+        with self.transaction():
+            # (the cash row's time is the last attempt, priced or not)
+            self.execute("leaderboard_attempt", priced = priced, cash = cash)
+            if len(prices) == 0:
+                return
+            self.executemany("leaderboard_price_set", [
+                    {"symbol" : symbol, "price" : price, "priced" : priced}
+                    for symbol, price in prices.items()])
+            self.execute("leaderboard_fill")
+
+    def leaderboard(self, limit):
+        """Returns the 'limit' most valuable accounts, most valuable first."""
+        return self.query("leaderboard_top", limit = limit)
+
+    def leaderboardrank(self, user_id):
+        """Returns the user's (value, rank) row, or None."""
+        rows = self.query("leaderboard_rank", user_id = user_id)
+        return rows[0] if len(rows) == 1 else None
+
+    # --- Snapshots
+
+    def addsnapshots(self, snapshots):
+        """Stores account values given as dicts of user_id, taken, cash, stocks."""
+        with self.transaction():
+            self.executemany("snapshot_insert", snapshots)
+
+    def snapshots(self, user_id, since):
+        """Returns the user's snapshots taken at or after 'since', oldest first."""
+        return self.query("snapshots", user_id = user_id, since = since)
+
+    # --- Limit and stop orders
+
+    def placeorder(self, user_id, symbol, side, kind, units, price):
+        """Stores a new open order and returns its id."""
+        return self.execute("order_insert", user_id = user_id, symbol = symbol,
+                            side = side, kind = kind, units = units, price = price)
+
+    def cancelorder(self, user_id, order_id):
+        """Cancels one of the user's open orders; False if it wasn't open."""
+        with span("db"):
+            return self.connection.execute(STATEMENTS["order_cancel"],
+                        {"user_id" : user_id, "order_id" : order_id}).rowcount == 1
+
+    def userorders(self, user_id, limit):
+        """Returns the user's newest orders, whatever their status."""
+        return self.query("user_orders", user_id = user_id, limit = limit)
+
+    def openorders(self, after=0):
+        """Returns every open order with an id above 'after', oldest first."""
+        return self.query("open_orders", after = after)
+
+    def stillopen(self, order_ids):
+        """Returns the set of the given order ids that are still open."""
+        rows = self.query("still_open", ids = json.dumps(list(order_ids)))
+        return {row["id"] for row in rows}
+
+    def somepositions(self, pairs):
+        """Returns {(user_id, symbol): amount} for many (user_id, symbol) pairs."""
+        rows = self.query("some_positions", pairs = json.dumps(list(pairs)))
+        return {(row["user_id"], row["symbol"]) : row["amount"] for row in rows}
+
+    def settleorders(self, legs, outcomes):
+        """Writes many users' legs and order outcomes (call inside a transaction)."""
+        totals = {}
+        for user_id, symbol, amount, price in legs:
+            totals[(user_id, symbol)] = totals.get((user_id, symbol), 0) + amount
+        self.executemany("ledger_insert", [
+                {"user_id" : user_id, "symbol" : symbol, "amount" : amount, "price" : price}
+                for user_id, symbol, amount, price in legs])
+        self.executemany("position_add", [
+                {"user_id" : user_id, "symbol" : symbol, "amount" : amount}
+                for (user_id, symbol), amount in totals.items()])
+        self.executemany("order_settle", outcomes)
+        self.aggregate(legs)
+
+    # --- Compaction
+
+    def compactioncutoff(self, before):
+        """Returns the newest ledger id older than 'before' (or None)."""
+        return self.query("compaction_cutoff", before = before)[0]["id"]
+
+    def compactionsums(self, cutoff):
+        """Returns per user and symbol sums of the ledger up to 'cutoff'."""
+        return self.query("compaction_sums", cutoff = cutoff)
+
+    def compactionlegs(self, cutoff, cash):
+        """Returns the non-cash legs up to 'cutoff' as tuples, by user then id."""
+        with span("db"):
+            cursor = self.connection.cursor()
+            cursor.row_factory = None
+            return cursor.execute(STATEMENTS["compaction_legs"],
+                                  {"cutoff" : cutoff, "cash" : cash}).fetchall()
+
+    def compact(self, cutoff, checkpoints):
+        """Swaps the ledger up to 'cutoff' for checkpoints (inside a transaction)."""
+        self.execute("archive_copy", cutoff = cutoff)
+        self.execute("compaction_delete", cutoff = cutoff)
+        self.executemany("checkpoint_insert", checkpoints)
+
+    # --- History
+
+    def latesttransaction(self, user_id):
+        """Returns the id of the user's newest transaction (or None)."""
+        return self.query("latest_transaction", user_id = user_id)[0]["id"]
+
+    def history(self, user_id, before, limit):
+        """Returns up to 'limit' transactions older than id 'before'."""
+        return self.query("history", user_id = user_id, before = before, limit = limit)
+
+    def iterhistory(self, user_id, batch=500):
+        """Yields all of a user's transactions as dicts, newest first."""
+
+        # A connection of its own, so the cursor can stay open while the
+        # response streams without getting in the way of other queries
+        connection = self.connect()
+        try:
+            cursor = connection.execute(STATEMENTS["history_all"],
+                                        {"user_id" : user_id})
+            while True:
+                rows = cursor.fetchmany(batch)
+                if len(rows) == 0:
+                    break
+                for row in rows:
+                    yield dict(zip(HISTORY_COLUMNS, row))
+        finally:
+            connection.close()
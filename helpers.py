@@ -11,11 +11,51 @@
 # ---------------------------------------------------------------------------
 
 # Imports:
+import asyncio
 import csv
-import urllib.request
+import io
+import itertools
+import json
+import math
+import threading
+import time
 
-from flask import redirect, render_template, request, session, url_for
+from database import HISTORY_COLUMNS
+from flask import current_app, redirect, render_template, request, session, url_for
 from functools import wraps
+from instrument import span
+from providers import LocalProvider, YahooProvider, acall, call
+from quotecache import QuoteCache
+from symbols import SYMBOL_FILE, SymbolDirectory
+
+# 'Constants'
+USD_sentinel = "cash_USD"
+
+LOOKUP_TIMEOUT = 5.0    # seconds allowed for a quote request
+
+HISTORY_PAGE = 50              # transactions per history page
+HISTORY_PAGE_MAX = 500          # largest page a user may ask for
+HISTORY_NEWEST = 2 ** 63 - 1    # 'before' id meaning the newest page
+
+ORDERS_MAX = 100                # most orders in one /orders batch
+LIMIT_ORDERS_LISTED = 100       # newest limit/stop orders /limitorders shows
+
+LEADERBOARD_TTL = 60            # seconds between leaderboard repricings
+LEADERBOARD_SIZE = 20           # accounts the leaderboard shows by default
+LEADERBOARD_SIZE_MAX = 100      # most accounts one request may ask for
+
+SNAPSHOT_INTERVAL = 3600       # seconds between portfolio snapshots
+PERFORMANCE_DAYS = 30           # days of snapshots shown by default
+
+PRICE_HISTORY_DAYS = 1          # days of prices /history/<symbol> returns
+                                # by default
+PRICE_HISTORY_POINTS = 5000     # most raw prices one request returns
+
+QUOTE_CACHE_TTL = 60            # seconds a quote is considered fresh
+QUOTE_CACHE_SIZE = 1024         # most symbols kept in memory
+QUOTE_CACHE_NEGATIVE_TTL = 300  # seconds an unknown symbol is remembered
+QUOTE_CACHE_STALE_TTL = 0       # seconds a stale quote may be served while
+                                # it is refreshed in the background (0 = off)
 
 # ---------------------------------------------------------------------------
 #   Desc.:      APOLOGY(top_text, bottom_text)
@@ -64,47 +104,200 @@ def login_required(f):
 
 # ---------------------------------------------------------------------------
 #   Desc.:      LOOKUP(stock_symbol)
-#   Purpose:    Looks up a quote for a stock from Yahoo Finance
+#   Purpose:    Looks up a quote for a stock from the quote provider
 #   Author:     CS50
 #   Date:       ?
 #
 #   Bugs, Limitations, and Other Notes:
 #   - returns none on failure to retrieve stock
-#   - Yahoo csv format is [SYMBOL, NAME, PRICE]
+#   - answers from the quote cache when it can (see quotecache.py)
 # ---------------------------------------------------------------------------
 def lookup(symbol):
     """Look up quote for symbol."""
 
-    # reject symbol if it starts with caret
-    if symbol.startswith("^"):
+    # reject symbol if it starts with caret or contains comma
+    if not validsymbol(symbol):
         return None
 
-    # reject symbol if it contains comma
-    if "," in symbol:
-        return None
+    return lookup_many([symbol])[symbol]
 
-    # query Yahoo for quote
-    # http://stackoverflow.com/a/21351911
-    try:
-        url = "http://download.finance.yahoo.com/d/quotes.csv?f=snl1&s={}".format(symbol)
-        webpage = urllib.request.urlopen(url)
-        datareader = csv.reader(webpage.read().decode("utf-8").splitlines())
-        row = next(datareader)
-    except:
-        return None
+# ---------------------------------------------------------------------------
+#   Desc.:      LOOKUP_MANY(stock_symbols, timeout)
+#   Purpose:    Looks up quotes for several stocks at once
+#   Author:     Joel Tannas
+#   Date:       
+#
+#   Bugs, Limitations, and Other Notes:
+#   - returns a dict of {requested symbol: quote or None}
+#   - only the symbols missing from the quote cache are fetched, in one
+#     call to the provider (see providers.py for how each one batches)
+#   - 'timeout' is the deadline for the whole call; anything not back in
+#     time is reported as None
+#   - uses the current app's Quotes (see below), so it needs an app
+#     context; threads without one are handed Quotes.lookup_many instead
+# ---------------------------------------------------------------------------
+def lookup_many(symbols, timeout=LOOKUP_TIMEOUT):
+    """Look up quotes for many symbols concurrently."""
+    return quotes().lookup_many(symbols, timeout)
 
-    # ensure stock exists
-    try:
-        price = float(row[2])
-    except:
+# ---------------------------------------------------------------------------
+#   Desc.:      lookup_async(symbol) / lookup_many_async(symbols, timeout)
+#   Purpose:    lookup() and lookup_many() for the async views
+#   Author:     Joel Tannas
+#   Date:       
+#
+#   Bugs, Limitations, and Other Notes:
+#   - coroutines with the same results; waiting on the provider (and on
+#     another request fetching the same symbol) is awaited, so the event
+#     loop serves other requests meanwhile (see asgi.py)
+# ---------------------------------------------------------------------------
+async def lookup_async(symbol):
+    """Look up quote for symbol without blocking the event loop."""
+    if not validsymbol(symbol):
         return None
+    return (await lookup_many_async([symbol]))[symbol]
+
+async def lookup_many_async(symbols, timeout=LOOKUP_TIMEOUT):
+    """Look up quotes for many symbols without blocking the event loop."""
+    return await quotes().lookup_many_async(symbols, timeout)
+
+# ---------------------------------------------------------------------------
+#   Desc.:      validsymbol(symbol) / listedsymbol(symbol) / openhistory()
+#   Purpose:    Symbol checks, and the current app's price history
+#   Author:     Joel Tannas
+#   Date:       
+#
+#   Bugs, Limitations, and Other Notes:
+#   - validsymbol() only turns away symbols Yahoo would reject, so stocks
+#     already held are always looked up; listedsymbol() also checks the
+#     symbol directory (see symbols.py) when the app's SYMBOL_CHECK is on,
+#     and is what new buys and quotes go through
+#   - openhistory() is None when the app keeps no price history
+# ---------------------------------------------------------------------------
+def validsymbol(symbol):
+    """Checks that a symbol can be sent to Yahoo."""
+    return bool(symbol) and not symbol.startswith("^") and "," not in symbol
 
-    # return stock's name (as a str), price (as a float), and (uppercased) symbol (as a str)
-    return {
-        "name": row[1],
-        "price": price,
-        "symbol": row[0].upper()
-    }
+def listedsymbol(symbol):
+    """Checks a symbol for a new buy or quote (listed, if that is enforced)."""
+    return quotes().listed(symbol)
+
+def openhistory():
+    """The current app's PriceHistory, or None when it keeps none."""
+    return quotes().openhistory()
+
+# ---------------------------------------------------------------------------
+#   Desc.:      Quotes(provider, cache, symbols, strict, history)
+#   Purpose:    One app's quote provider, quote cache, symbol directory
+#               and price history, which the lookups above go through
+#   Author:     Joel Tannas
+#   Date:       
+#
+#   Bugs, Limitations, and Other Notes:
+#   - create_app() makes one for each app and keeps it in
+#     app.extensions["quotes"]; quotes() is the current app's
+#   - fetch() and fetch_async() bypass the cache, and are what the cache
+#     calls on a miss
+#   - network failures leave the symbol out of the result so that only
+#     genuinely unknown symbols get cached as None
+#   - 'strict' refuses new buys and quotes of symbols missing from
+#     'symbols' (see listed())
+#   - every quote fetched from the provider is appended to the price
+#     history (see pricehistory.py) under the 'history' directory, unless
+#     it is None; a failed write never fails the lookup, and the async
+#     lookups write it from a thread so the event loop never waits on it
+#   - the price history (and NumPy with it) is only loaded by the first
+#     fetch or /history/<symbol> request, through openhistory()
+# ---------------------------------------------------------------------------
+class Quotes:
+    """Where one app's quotes come from and are kept."""
+    
+    def __init__(self, provider, cache=None, symbols=None, strict=False, history=None):
+        self.provider = provider
+        self.cache = cache if cache != None else QuoteCache(
+                                ttl = QUOTE_CACHE_TTL,
+                                maxsize = QUOTE_CACHE_SIZE,
+                                negative_ttl = QUOTE_CACHE_NEGATIVE_TTL,
+                                stale_ttl = QUOTE_CACHE_STALE_TTL)
+        self.symbols = symbols if symbols != None else SymbolDirectory(SYMBOL_FILE)
+        self.strict = strict
+        self.historydirectory = history
+        self._history = None
+        self._lock = threading.Lock()
+    
+    def listed(self, symbol):
+        """Checks a symbol is valid (and listed, when strict)."""
+        return validsymbol(symbol) and (not self.strict or symbol in self.symbols)
+    
+    def lookup_many(self, symbols, timeout=LOOKUP_TIMEOUT):
+        """lookup_many() for this app, usable from any thread."""
+        
+        # Drop duplicates and symbols Yahoo would reject
+        quotes = {symbol : None for symbol in symbols}
+        wanted = [symbol for symbol in quotes if validsymbol(symbol)]
+        if len(wanted) == 0:
+            return quotes
+        
+        with span("lookup"):
+            quotes.update(self.cache.get_many(wanted, 
+                            lambda missing: self.fetch(missing, timeout)))
+        return quotes
+    
+    async def lookup_many_async(self, symbols, timeout=LOOKUP_TIMEOUT):
+        """lookup_many_async() for this app."""
+        quotes = {symbol : None for symbol in symbols}
+        wanted = [symbol for symbol in quotes if validsymbol(symbol)]
+        if len(wanted) == 0:
+            return quotes
+        
+        with span("lookup"):
+            quotes.update(await self.cache.get_many_async(wanted, 
+                            lambda missing: self.fetch_async(missing, timeout)))
+        return quotes
+    
+    def fetch(self, symbols, timeout):
+        """Fetches several quotes from the provider, skipping the cache."""
+        try:
+            quotes = call(self.provider.fetch(symbols), timeout)
+        except Exception:
+            return {}
+        return self.record(quotes)
+    
+    async def fetch_async(self, symbols, timeout):
+        try:
+            quotes = await acall(self.provider.fetch(symbols), timeout)
+        except Exception:
+            return {}
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.record, quotes)
+    
+    def record(self, quotes):
+        """Appends fetched quotes to the price history, if it is kept."""
+        history = self.openhistory()
+        if history != None:
+            try:
+                history.ingest(quotes, time.time())
+            except OSError:
+                pass
+        return quotes
+    
+    def openhistory(self):
+        """The PriceHistory for the history directory, or None when off."""
+        if self._history == None and self.historydirectory != None:
+            with self._lock:
+                if self._history == None:
+                    from pricehistory import PriceHistory
+                    self._history = PriceHistory(self.historydirectory)
+        return self._history
+
+def quotes():
+    """The current app's Quotes."""
+    return current_app.extensions["quotes"]
+
+def makeprovider(name, **options):
+    """A quote provider by name ('yahoo' or 'local'), with its options."""
+    providers = {"yahoo" : YahooProvider, "local" : LocalProvider}
+    return providers[name](**options)
 
 # ---------------------------------------------------------------------------
 #   Desc.:      USD(Dollar_Amount)
@@ -128,15 +321,13 @@ def usd(value):
 #   Date:       
 #
 #   Bugs, Limitations, and Other Notes:
-#   - 
+#   - also applies the amount to the user's row in the positions table,
+#     inside the same database transaction, so the two never disagree
+#   - and to the aggregates behind the leaderboard (see Database.aggregate)
 # ---------------------------------------------------------------------------
 def stockmove(db, user_id, symbol, amount):
     """Inserts a record into the transactions table"""
-    return db.execute("INSERT INTO transactions(user_id, symbol, amount) " 
-                    + "VALUES (:user_id, :symbol, :units)", 
-                    user_id = user_id, 
-                    symbol = symbol, 
-                    units = amount)
+    return db.move(user_id, symbol, amount)
             
 # ---------------------------------------------------------------------------
 #   Desc.:      stockbalance(db, user_id, symbol)
@@ -145,19 +336,411 @@ def stockmove(db, user_id, symbol, amount):
 #   Date:       
 #
 #   Bugs, Limitations, and Other Notes:
-#   - 
+#   - reads the positions table rather than summing the whole ledger
 # ---------------------------------------------------------------------------
 def stockbalance(db, user_id, symbol):
     """ Gets the balance for a user's individual stock"""
+    return db.balance(user_id, symbol)
+
+# ---------------------------------------------------------------------------
+#   Desc.:      executetrade(db, user_id, symbol, units, price, sellall)
+#   Purpose:    Buys (units > 0) or sells (units < 0) a stock for a user
+#   Author:     Joel Tannas
+#   Date:       
+#
+#   Bugs, Limitations, and Other Notes:
+#   - the balance check, the cash leg and the stock leg all happen inside
+#     one BEGIN IMMEDIATE transaction, so two concurrent trades can't both
+#     spend the same cash, and each trade costs a single commit
+#   - both legs go into the ledger with one multi-row INSERT, and into
+#     positions with one multi-row upsert
+#   - 'sellall' sells whatever the user holds, read inside the transaction
+#   - returns a dict: ok, error (None if ok), action, symbol, units (always
+#     positive), price, value and the user's cash balance afterwards
+# ---------------------------------------------------------------------------
+def executetrade(db, user_id, symbol, units, price, sellall=False):
+    """Runs both legs of a trade in a single transaction."""
     
-    rows = db.execute("SELECT symbol, SUM(amount) AS amount "
-                    + "FROM transactions "
-                    + "WHERE user_id=:user_id AND symbol=:symbol "
-                    + "GROUP BY symbol", 
-                     user_id = user_id, 
-                     symbol = symbol)
-                     
-    if len(rows) != 1:
-        return None
-    else:
-        return rows[0]["amount"]
\ No newline at end of file
+    result = {
+            "ok" : False,
+            "error" : None,
+            "action" : "sold" if sellall or units < 0 else "bought",
+            "symbol" : symbol,
+            "units" : abs(units),
+            "price" : price,
+            "value" : 0,
+            "cash" : None
+            }
+    
+    with db.transaction():
+        
+        # --- Section 010: Read both balances under the write lock
+        balances = db.balances(user_id, USD_sentinel, symbol)
+        cash = balances.get(USD_sentinel, 0)
+        held = balances.get(symbol, 0)
+        result["cash"] = cash
+        
+        # --- Section 020: Check the trade can go ahead
+        if sellall:
+            units = -held
+            result["units"] = held
+        value = units * price
+        result["value"] = abs(value)
+        
+        if units == 0:
+            result["error"] = "You have no {} stock to sell".format(symbol)
+        elif units > 0 and cash < value:
+            result["error"] = "Insufficient funds to complete this transaction"
+        elif units < 0 and held < -units:
+            result["error"] = "Insufficient stocks to complete this transaction"
+        if result["error"] != None:
+            return result
+        
+        # --- Section 030: Move the money and the stock
+        db.trade(user_id, USD_sentinel, -value, symbol, units, price)
+    
+    result["ok"] = True
+    result["cash"] = cash - value
+    return result
+
+# ---------------------------------------------------------------------------
+#   Desc.:      executeorders(db, user_id, orders, quotes, atomic)
+#   Purpose:    Runs a batch of buys and sells for a user in one go
+#   Author:     Joel Tannas
+#   Date:       
+#
+#   Bugs, Limitations, and Other Notes:
+#   - orders are dicts of action ('buy' or 'sell'), symbol, units (> 0, or
+#     None to sell the whole holding) and optionally error (already
+#     rejected while parsing); quotes is one batched lookup_many result
+#   - balances are read once, inside one BEGIN IMMEDIATE transaction.
+#     Sells are checked before buys so their proceeds can pay for them,
+#     each against the running balances, which makes the cash check for
+#     the whole batch a single pass.
+#   - atomic: any failed order fails the batch and nothing is written.
+#     Otherwise the orders that can go ahead do, and the rest report why.
+#   - every leg goes in with one executemany, so the whole batch is one
+#     commit however many orders it holds
+#   - returns (results, cash): one executetrade style dict per order, in
+#     the order given, and the cash balance afterwards
+# ---------------------------------------------------------------------------
+def executeorders(db, user_id, orders, quotes, atomic=True):
+    """Checks and applies a batch of orders in a single transaction."""
+    
+    results = [{
+            "ok" : False,
+            "error" : order.get("error"),
+            "action" : {"buy" : "bought", "sell" : "sold"}.get(order["action"]),
+            "symbol" : order["symbol"],
+            "units" : order["units"],
+            "price" : None,
+            "value" : 0
+            } for order in orders]
+    
+    with db.transaction():
+        
+        # --- Section 010: Read every balance once, under the write lock
+        holdings = {row["symbol"] : row["amount"] for row in db.portfolio(user_id)}
+        cash = holdings.get(USD_sentinel, 0)
+        
+        # --- Section 020: Check each order against the running balances
+        legs = []
+        for index in sorted(range(len(orders)), 
+                            key = lambda index: orders[index]["action"] != "sell"):
+            result = results[index]
+            if result["error"] != None:
+                continue
+            quote = quotes.get(result["symbol"])
+            if quote == None:
+                result["error"] = "Unable to find stock: {}".format(result["symbol"])
+                continue
+            
+            symbol = quote["symbol"]
+            held = holdings.get(symbol, 0)
+            units = held if result["units"] == None else result["units"]
+            if result["action"] == "sold":
+                units = -units
+            value = units * quote["price"]
+            result.update(symbol = symbol, units = abs(units), 
+                          price = quote["price"], value = abs(value))
+            
+            if units == 0:
+                result["error"] = "You have no {} stock to sell".format(symbol)
+            elif units > 0 and cash < value:
+                result["error"] = "Insufficient funds to complete this transaction"
+            elif units < 0 and held < -units:
+                result["error"] = "Insufficient stocks to complete this transaction"
+            if result["error"] != None:
+                continue
+            
+            cash -= value
+            holdings[symbol] = held + units
+            legs.append((USD_sentinel, -value, None))
+            legs.append((symbol, units, quote["price"]))
+            result["ok"] = True
+        
+        # --- Section 030: All or nothing?
+        if atomic and not all(result["ok"] for result in results):
+            for result in results:
+                if result["ok"]:
+                    result["ok"] = False
+                    result["error"] = "Not executed: another order in the batch failed"
+            return results, holdings.get(USD_sentinel, 0)
+        
+        # --- Section 040: Move the money and the stock for the whole batch
+        if len(legs) != 0:
+            db.tradelegs(user_id, legs)
+    
+    return results, cash
+
+# ---------------------------------------------------------------------------
+#   Desc.:      settlefills(db, fills)
+#   Purpose:    Fills the limit and stop orders set off in one engine tick
+#   Author:     Joel Tannas
+#   Date:       
+#
+#   Bugs, Limitations, and Other Notes:
+#   - fills are (order, price) pairs from the matching engine (see
+#     matching.py), oldest order first; each fills at 'price', the quote
+#     that set it off
+#   - cash and stock are not set aside when an order is placed, so each
+#     fill is checked against the owner's running balances like an
+#     /orders batch; one that can't go ahead is marked rejected
+#   - orders no longer open (cancelled, or settled by another process)
+#     are skipped; that check and every write happen in one BEGIN
+#     IMMEDIATE transaction, so an order can never fill twice
+#   - returns a dict per settled order: id, status, reason, fill_price
+# ---------------------------------------------------------------------------
+def settlefills(db, fills):
+    """Applies one tick's triggered orders in a single transaction."""
+    
+    with db.transaction():
+        
+        # --- Section 010: Read which orders are open and their owners' balances
+        stillopen = db.stillopen([order["id"] for order, price in fills])
+        balances = db.somepositions({pair for order, price in fills
+                                        for pair in [(order["user_id"], USD_sentinel),
+                                                     (order["user_id"], order["symbol"])]})
+        
+        # --- Section 020: Check each fill against the running balances
+        legs = []
+        outcomes = []
+        for order, price in fills:
+            if order["id"] not in stillopen:
+                continue
+            user_id, symbol = order["user_id"], order["symbol"]
+            units = order["units"] if order["side"] == "buy" else -order["units"]
+            value = units * price
+            cash = balances.get((user_id, USD_sentinel), 0)
+            held = balances.get((user_id, symbol), 0)
+            
+            outcome = {"id" : order["id"], "status" : "filled", 
+                       "reason" : None, "fill_price" : price}
+            if units > 0 and cash < value:
+                outcome.update(status = "rejected", fill_price = None,
+                               reason = "Insufficient funds to complete this transaction")
+            elif units < 0 and held < -units:
+                outcome.update(status = "rejected", fill_price = None,
+                               reason = "Insufficient stocks to complete this transaction")
+            else:
+                balances[(user_id, USD_sentinel)] = cash - value
+                balances[(user_id, symbol)] = held + units
+                legs.append((user_id, USD_sentinel, -value, None))
+                legs.append((user_id, symbol, units, price))
+            outcomes.append(outcome)
+        
+        # --- Section 030: Write every leg and outcome for the tick at once
+        if len(outcomes) != 0:
+            db.settleorders(legs, outcomes)
+    
+    return outcomes
+
+# ---------------------------------------------------------------------------
+#   Desc.:      compactledger(db, before)
+#   Purpose:    Rolls the ledger older than 'before' into checkpoint rows
+#               and moves the rows it replaces to the archive database
+#   Author:     Joel Tannas
+#   Date:       
+#
+#   Bugs, Limitations, and Other Notes:
+#   - 'before' is a timestamp string ('YYYY-MM-DD HH:MM:SS'); the closed
+#     period is every row up to the newest one older than it
+#   - each user's rows for each symbol become one checkpoint row holding
+#     their sum, so every balance stays exactly as it was (sums of zero
+#     leave no row at all)
+#   - a checkpoint takes the id and timestamp of the last row it sums up,
+#     so the ledger stays in id order
+#   - a stock checkpoint's price is the average cost of the units held at
+#     that point (see analytics.costbasis), so /analytics reports the same
+#     cost basis afterwards; profit realized before it is no longer counted
+#   - earlier checkpoints roll up into the new ones; only ordinary rows go
+#     to the archive, where history and export still find them
+#   - refuses to start if positions already disagree with the ledger, and
+#     rolls everything back if they would afterwards
+#   - one transaction over both files. In WAL mode SQLite commits each
+#     attached file atomically but not the two together, so a crash in
+#     the middle of the commit can leave rows in both; the archive ignores
+#     ids it already holds, so running it again tidies that up
+#   - returns (rows archived, checkpoints written)
+# ---------------------------------------------------------------------------
+def compactledger(db, before):
+    """Replaces the closed part of the ledger with checkpoint rows."""
+    from analytics import costbasis
+    
+    with db.transaction():
+        
+        # --- Section 010: Find the end of the closed period
+        if len(db.positionsdrift()) != 0:
+            raise RuntimeError("positions disagree with the ledger already; "
+                               + "run 'flask positions --rebuild' first")
+        cutoff = db.compactioncutoff(before)
+        if cutoff == None:
+            return 0, 0
+        
+        # --- Section 020: Average cost of what each user holds at the cutoff
+        costs = {}
+        legs = db.compactionlegs(cutoff, USD_sentinel)
+        for user_id, rows in itertools.groupby(legs, key = lambda leg: leg[0]):
+            rows = list(rows)
+            basis = costbasis([row[1] for row in rows], [row[2] for row in rows],
+                              [math.nan if row[3] == None else row[3] for row in rows])
+            for symbol, (held, cost, realized) in basis.items():
+                if held != 0 and math.isfinite(cost):
+                    costs[(user_id, symbol)] = cost / held
+        
+        # --- Section 030: One checkpoint per user and symbol
+        archived = 0
+        checkpoints = []
+        for row in db.compactionsums(cutoff):
+            archived += row["raw"]
+            if row["amount"] == 0:
+                continue
+            checkpoints.append({
+                    "id" : row["id"],
+                    "user_id" : row["user_id"],
+                    "symbol" : row["symbol"],
+                    "amount" : row["amount"],
+                    "price" : costs.get((row["user_id"], row["symbol"])),
+                    "timestamp" : row["timestamp"],
+                    "checkpoint" : cutoff
+                    })
+        
+        # --- Section 040: Swap them in, and make sure no balance moved
+        db.compact(cutoff, checkpoints)
+        if len(db.positionsdrift()) != 0:
+            raise RuntimeError("compaction would have changed balances; nothing was changed")
+    
+    return archived, len(checkpoints)
+
+# ---------------------------------------------------------------------------
+#   Desc.:      csvlines(rows) / ndjsonlines(rows)
+#   Purpose:    Turn ledger rows into chunks of an export file
+#   Author:     Joel Tannas
+#   Date:       
+#
+#   Bugs, Limitations, and Other Notes:
+#   - generators, so they can be handed straight to a flask Response
+# ---------------------------------------------------------------------------
+def csvlines(rows):
+    """Yields a header line and then one CSV line per row."""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames = HISTORY_COLUMNS)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+def ndjsonlines(rows):
+    """Yields one JSON object per line."""
+    for row in rows:
+        yield json.dumps(row) + "\n"
+
+EXPORT_FORMATS = {
+    "csv" : ("text/csv", csvlines),
+    "ndjson" : ("application/x-ndjson", ndjsonlines)
+}
+
+# ---------------------------------------------------------------------------
+#   Desc.:      repriceleaderboard(db, now) / markettotals(rows)
+#   Purpose:    Revalue every account for the leaderboard, and total up
+#               what all the accounts hold together
+#   Author:     Joel Tannas
+#   Date:       
+#
+#   Bugs, Limitations, and Other Notes:
+#   - the symbols to price come from holdings_totals, one row per symbol
+#     however many users hold it, and are priced with one batched lookup;
+#     every account is then revalued by a single INSERT ... SELECT
+#   - between repricings, each trade moves its user's value by the legs
+#     at the stored prices (see Database.aggregate), so the ranking stays
+#     right for trades and only lags price moves
+#   - a symbol with no price right now keeps the last one it had, which
+#     for a symbol first bought since the last repricing is its trade price
+#   - the attempt itself is what restarts the LEADERBOARD_TTL clock, so
+#     with the provider down (or nothing held) it is still only tried once
+#     a period, and nothing is revalued when no price came back
+#   - markettotals() takes heldtotals() rows: the totals held multiplied
+#     by the vector of stored prices, with no per-user work at all
+# ---------------------------------------------------------------------------
+def repriceleaderboard(db, now=None):
+    """Prices every held symbol at once and revalues all accounts."""
+    symbols = [row["symbol"] for row in db.heldtotals() if row["symbol"] != USD_sentinel]
+    quotes = lookup_many(symbols)
+    prices = {symbol : quote["price"] for symbol, quote in quotes.items() if quote != None}
+    db.repriceleaderboard(prices, int(time.time() if now == None else now), USD_sentinel)
+    return len(prices)
+
+def markettotals(rows):
+    """Returns (cash, stocks) held by all users together."""
+    cash = sum(row["amount"] for row in rows if row["symbol"] == USD_sentinel)
+    stocks = sum(row["amount"] * row["price"] for row in rows
+                    if row["symbol"] != USD_sentinel and row["price"] != None)
+    return cash, stocks
+
+# ---------------------------------------------------------------------------
+#   Desc.:      snapshotportfolios(db, interval, now)
+#   Purpose:    Records the value of every account at this moment
+#   Author:     Joel Tannas
+#   Date:       
+#
+#   Bugs, Limitations, and Other Notes:
+#   - one batched lookup for the distinct symbols held by anyone, however
+#     many users hold them
+#   - the snapshot time is rounded down to a multiple of 'interval', so
+#     running the job twice in one interval replaces rather than doubles
+#   - a user holding a stock with no price right now is skipped rather
+#     than recorded at a made-up value
+#   - returns the number of accounts recorded
+# ---------------------------------------------------------------------------
+def snapshotportfolios(db, interval=SNAPSHOT_INTERVAL, now=None):
+    """Values every account with current prices and stores the results."""
+    
+    # --- Section 010: Price every symbol anyone holds, all at once
+    rows = db.allpositions()
+    quotes = lookup_many({row["symbol"] for row in rows 
+                            if row["symbol"] != USD_sentinel})
+    
+    # --- Section 020: Total up each account
+    now = time.time() if now == None else now
+    taken = int(now // interval * interval)
+    accounts = {}
+    unpriced = set()
+    for row in rows:
+        account = accounts.setdefault(row["user_id"], {
+                "user_id" : row["user_id"], "taken" : taken, "cash" : 0, "stocks" : 0
+                })
+        if row["symbol"] == USD_sentinel:
+            account["cash"] += row["amount"]
+        elif quotes.get(row["symbol"]) != None:
+            account["stocks"] += row["amount"] * quotes[row["symbol"]]["price"]
+        else:
+            unpriced.add(row["user_id"])
+    
+    # --- Section 030: Store them in one transaction
+    snapshots = [account for user_id, account in accounts.items()
+                    if user_id not in unpriced]
+    db.addsnapshots(snapshots)
+    return len(snapshots)
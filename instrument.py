@@ -0,0 +1,286 @@
+# ---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+#   Desc.:      Instrumentation
+#   Purpose:    Times where each request spends its time (database, quote
+#               lookups, password hashing, template rendering) and reports
+#               it as Server-Timing headers, /metrics and sampled profiles
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Licensing Info:
+#   ?
+# ---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+
+# Imports:
+import bisect
+import contextvars
+import cProfile
+import heapq
+import os
+import random
+import threading
+import time
+
+from contextlib import contextmanager
+from functools import wraps
+
+# 'Constants'
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# The spans of the request being handled: {name: [seconds, calls]}
+_spans = contextvars.ContextVar("spans", default = None)
+
+# ---------------------------------------------------------------------------
+#   Desc.:      span(name) / timed(name)
+#   Purpose:    Add time spent in a block or function to the
+#               current request under 'name'
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - outside a request (or with instrumentation off) they only cost a
+#     context variable lookup
+#   - timing is also recorded into the per-name histogram for /metrics
+# ---------------------------------------------------------------------------
+@contextmanager
+def span(name):
+    """Times the with block as part of the current request."""
+    spans = _spans.get()
+    if spans == None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        total = spans.setdefault(name, [0.0, 0])
+        total[0] += elapsed
+        total[1] += 1
+        metrics.observe("finance_span_duration_seconds", {"span" : name}, elapsed)
+
+def timed(name):
+    """Decorator version of span()."""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# ---------------------------------------------------------------------------
+#   Desc.:      Metrics
+#   Purpose:    A small Prometheus-style registry of histograms and counters
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - values are per process; under several workers, scrape each one or
+#     sum them in Prometheus
+#   - render() produces the Prometheus text exposition format
+# ---------------------------------------------------------------------------
+class Metrics:
+    """Thread-safe histograms keyed by metric name and labels."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._histograms = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def observe(self, name, labels, value):
+        """Adds one observation (in seconds) to a histogram."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram == None:
+                histogram = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram[0][bisect.bisect_left(self.buckets, value)] += 1
+            histogram[1] += value
+
+    def render(self, extra=()):
+        """Returns every metric as Prometheus text."""
+        with self._lock:
+            histograms = sorted((key, [list(counts), total])
+                                for key, (counts, total) in self._histograms.items())
+        lines = []
+        described = set()
+        for (name, labels), (counts, total) in histograms:
+            if name not in described:
+                lines.append("# HELP {} {}".format(name, self._help.get(name, name)))
+                lines.append("# TYPE {} histogram".format(name))
+                described.add(name)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ["+Inf"], counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(
+                    name, _labels(labels + (("le", str(bound)),)), cumulative))
+            lines.append("{}_sum{} {}".format(name, _labels(labels), total))
+            lines.append("{}_count{} {}".format(name, _labels(labels), cumulative))
+        for name, kind, text, samples in extra:
+            lines.append("# HELP {} {}".format(name, text))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for labels, value in samples:
+                lines.append("{}{} {}".format(name, _labels(tuple(labels.items())), value))
+        return "\n".join(lines) + "\n"
+
+def _labels(pairs):
+    """Formats label pairs as {a="1",b="2"}."""
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, str(value).replace('"', '\\"'))
+                          for key, value in pairs) + "}"
+
+metrics = Metrics()
+metrics.describe("finance_request_duration_seconds", "Time to handle a request, by route.")
+metrics.describe("finance_span_duration_seconds", "Time spent in each instrumented call.")
+
+# ---------------------------------------------------------------------------
+#   Desc.:      SlowProfiler(directory, keep)
+#   Purpose:    Keeps cProfile dumps of the slowest sampled requests
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - only one request is profiled at a time; cProfile can't profile two
+#     threads at once, so a sampled request that finds it busy is skipped
+#   - the 'keep' slowest profiles are kept as <ms>-<route>-<time>.prof in
+#     'directory'; faster ones are deleted as slower ones arrive
+#   - read them with: python -m pstats <file>
+# ---------------------------------------------------------------------------
+class SlowProfiler:
+    """Samples requests with cProfile and keeps the slowest ones."""
+
+    def __init__(self, directory, keep=20):
+        self.directory = directory
+        self.keep = keep
+        self._busy = threading.Lock()
+        self._slowest = []      # min-heap of (seconds, path)
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Starts profiling this thread, or returns None if busy."""
+        if not self._busy.acquire(blocking = False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            self._busy.release()
+            return None
+        return profile
+
+    def stop(self, profile, seconds, route):
+        """Stops profiling and keeps the dump if it is slow enough."""
+        profile.disable()
+        self._busy.release()
+
+        with self._lock:
+            if len(self._slowest) >= self.keep and seconds <= self._slowest[0][0]:
+                return
+            os.makedirs(self.directory, exist_ok = True)
+            name = "{:.0f}ms-{}-{}.prof".format(seconds * 1000,
+                        route.strip("/").replace("/", "_") or "index",
+                        time.strftime("%Y%m%d%H%M%S"))
+            path = os.path.join(self.directory, name)
+            profile.dump_stats(path)
+            heapq.heappush(self._slowest, (seconds, path))
+            while len(self._slowest) > self.keep:
+                seconds, faster = heapq.heappop(self._slowest)
+                try:
+                    os.remove(faster)
+                except OSError:
+                    pass
+
+# ---------------------------------------------------------------------------
+#   Desc.:      init_app(app, extra)
+#   Purpose:    Turns instrumentation on for a Flask app
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - config: SERVER_TIMING (header on/off), PROFILE_SAMPLE_RATE (share of
+#     requests to profile, 0 = off), PROFILE_KEEP, PROFILE_DIR
+#   - template rendering is timed through Flask's template signals
+#   - a request whose environ has "finance.profile" set false is never
+#     profiled; asgi.py sets it where the hooks run on different threads
+#   - 'extra' is a function returning more metrics for /metrics, as
+#     (name, type, help, [(labels, value)]) tuples
+# ---------------------------------------------------------------------------
+def init_app(app, extra=lambda: ()):
+    """Registers the request hooks and the /metrics endpoint."""
+    from flask import (Response, before_render_template, g, request,
+                       template_rendered)
+
+    app.config.setdefault("SERVER_TIMING", True)
+    app.config.setdefault("PROFILE_SAMPLE_RATE", 0.0)
+    app.config.setdefault("PROFILE_KEEP", 20)
+    app.config.setdefault("PROFILE_DIR", os.path.join(app.instance_path, "profiles"))
+    profiler = SlowProfiler(app.config["PROFILE_DIR"], app.config["PROFILE_KEEP"])
+
+    @app.before_request
+    def startrequest():
+        g.instrument_start = time.perf_counter()
+        _spans.set({})
+        g.instrument_profile = None
+        if (request.environ.get("finance.profile", True)
+                and random.random() < app.config["PROFILE_SAMPLE_RATE"]):
+            g.instrument_profile = profiler.start()
+
+    @app.after_request
+    def finishrequest(response):
+        spans = _spans.get()
+        if spans == None:
+            return response
+        elapsed = time.perf_counter() - g.instrument_start
+        route = request.url_rule.rule if request.url_rule != None else "unmatched"
+        metrics.observe("finance_request_duration_seconds",
+                        {"route" : route, "method" : request.method}, elapsed)
+
+        if g.instrument_profile != None:
+            profiler.stop(g.instrument_profile, elapsed, route)
+            g.instrument_profile = None
+
+        if app.config["SERVER_TIMING"]:
+            timings = ['{};dur={:.2f};desc="{} call(s)"'.format(
+                            name, seconds * 1000, calls)
+                        for name, (seconds, calls) in sorted(spans.items())]
+            timings.append("total;dur={:.2f}".format(elapsed * 1000))
+            response.headers["Server-Timing"] = ", ".join(timings)
+
+        _spans.set(None)
+        return response
+
+    @app.teardown_request
+    def abandonrequest(error):
+        profile = g.pop("instrument_profile", None)
+        if profile != None:
+            profile.disable()
+            profiler._busy.release()
+
+    def startrender(sender, template, context, **extra):
+        g.instrument_render = time.perf_counter()
+
+    def finishrender(sender, template, context, **extra):
+        spans = _spans.get()
+        start = g.pop("instrument_render", None)
+        if spans != None and start != None:
+            elapsed = time.perf_counter() - start
+            total = spans.setdefault("render", [0.0, 0])
+            total[0] += elapsed
+            total[1] += 1
+            metrics.observe("finance_span_duration_seconds", {"span" : "render"}, elapsed)
+
+    before_render_template.connect(startrender, app, weak = False)
+    template_rendered.connect(finishrender, app, weak = False)
+
+    @app.route("/metrics", methods = ["GET"])
+    def prometheusmetrics():
+        """Serve the metrics in Prometheus text format."""
+        return Response(metrics.render(extra()),
+                        mimetype = "text/plain; version=0.0.4")
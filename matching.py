@@ -0,0 +1,191 @@
+# ---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+#   Desc.:      Matching engine
+#   Purpose:    Keeps the open limit and stop orders sorted by the price that
+#               sets them off, and fills every triggered order once a tick
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Licensing Info:
+#   ?
+# ---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+
+# Imports:
+import heapq
+import logging
+import threading
+
+# 'Constants'
+MATCHING_INTERVAL = 15      # seconds between ticks
+MATCHING_RESYNC = 40        # ticks between full reloads of the open orders
+ORDER_SIDES = ["buy", "sell"]
+ORDER_KINDS = ["limit", "stop"]
+
+log = logging.getLogger(__name__)
+
+# ---------------------------------------------------------------------------
+#   Desc.:      OrderBook
+#   Purpose:    The open orders for one symbol, in two heaps
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - a buy limit and a sell stop fire when the price falls to theirs or
+#     below; they sit in a max-heap so the highest is always on top
+#   - a sell limit and a buy stop fire when the price rises to theirs or
+#     above; they sit in a min-heap with the lowest on top
+#   - so matching a price only ever looks at the orders it fires, plus one
+#     that it doesn't: O(k log n) for k fills out of n orders
+#   - ties on price go to the oldest order (the lowest id)
+# ---------------------------------------------------------------------------
+class OrderBook:
+    """One symbol's open orders, sorted by trigger price."""
+
+    def __init__(self):
+        self.falling = []
+        self.rising = []
+
+    def __len__(self):
+        return len(self.falling) + len(self.rising)
+
+    def add(self, order):
+        """Adds an order (with id, side, kind and price) to the book."""
+        if (order["side"] == "buy") == (order["kind"] == "limit"):
+            heapq.heappush(self.falling, (-order["price"], order["id"], order))
+        else:
+            heapq.heappush(self.rising, (order["price"], order["id"], order))
+
+    def match(self, price):
+        """Removes and returns every order that 'price' sets off."""
+        triggered = []
+        while len(self.falling) != 0 and -self.falling[0][0] >= price:
+            triggered.append(heapq.heappop(self.falling)[2])
+        while len(self.rising) != 0 and self.rising[0][0] <= price:
+            triggered.append(heapq.heappop(self.rising)[2])
+        return triggered
+
+# ---------------------------------------------------------------------------
+#   Desc.:      MatchingEngine(load, fetch, settle, interval, resync)
+#   Purpose:    Runs the ticks: sync the books, price, match, settle
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - load(after) returns the open orders with an id above 'after', in id
+#     order; each tick only reads orders placed since the last one
+#   - fetch(symbols) is called once a tick with every symbol that has open
+#     orders (lookup_many), so 100k orders on 500 symbols cost one batched
+#     lookup of 500 symbols, not 100k quotes
+#   - settle(fills) gets every triggered (order, price) of the tick, oldest
+#     order first, and writes them in one transaction. It must skip orders
+#     that are no longer open, which is what makes cancelling work: a
+#     cancelled order stays in the books until it fires or the next full
+#     reload (every 'resync' ticks) and is then dropped.
+#   - if settling fails, the next tick reloads everything, so the orders
+#     that were taken out of the books come back
+#   - start() only takes a lock of its own, and none at all once the
+#     thread is running, so callers never wait behind a tick (which can
+#     take as long as a slow fetch); a tick that fails is logged and the
+#     next one runs as usual
+#   - safe to run in more than one process, since settle() only fills
+#     orders still open, but each one polls the quotes; run one with
+#     'flask matcher' and turn the thread off in the web workers instead
+# ---------------------------------------------------------------------------
+class MatchingEngine:
+    """Fills resting limit and stop orders as prices reach them."""
+
+    def __init__(self, load, fetch, settle, interval=MATCHING_INTERVAL,
+                 resync=MATCHING_RESYNC):
+        self.load = load
+        self.fetch = fetch
+        self.settle = settle
+        self.interval = interval
+        self.resync = resync
+        self.books = {}
+        self.loaded = 0
+        self.ticks = 0
+        self.fills = 0
+        self._stale = True
+        self._reloaded = 0
+        self._lock = threading.Lock()
+        self._starting = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return sum(len(book) for book in self.books.values())
+
+    def sync(self):
+        """Adds newly placed orders to the books (all of them when stale)."""
+        if self._stale or self.ticks - self._reloaded >= self.resync:
+            self.books = {}
+            self.loaded = 0
+            self._stale = False
+            self._reloaded = self.ticks
+        for order in self.load(self.loaded):
+            book = self.books.get(order["symbol"])
+            if book == None:
+                book = self.books[order["symbol"]] = OrderBook()
+            book.add(order)
+            self.loaded = max(self.loaded, order["id"])
+
+    def tick(self):
+        """One pass over every open order; returns what settle() returned."""
+        with self._lock:
+            self.sync()
+            self.ticks += 1
+            symbols = [symbol for symbol, book in self.books.items() if len(book) != 0]
+            if len(symbols) == 0:
+                return []
+
+            # --- Section 010: One price per symbol, and what it sets off
+            quotes = self.fetch(symbols)
+            fills = []
+            for symbol in symbols:
+                quote = quotes.get(symbol)
+                if quote != None:
+                    fills.extend((order, quote["price"])
+                                 for order in self.books[symbol].match(quote["price"]))
+                if len(self.books[symbol]) == 0:
+                    del self.books[symbol]
+            if len(fills) == 0:
+                return []
+
+            # --- Section 020: Settle the whole tick at once
+            fills.sort(key = lambda fill: fill[0]["id"])
+            try:
+                outcomes = self.settle(fills)
+            except Exception:
+                self._stale = True
+                raise
+            self.fills += len(fills)
+            return outcomes
+
+    def start(self):
+        """Runs tick() every 'interval' seconds on a daemon thread."""
+        if self._thread != None:
+            return
+        with self._starting:
+            if self._thread != None:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target = self.run,
+                                            name = "matching-engine",
+                                            daemon = True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self):
+        """The tick loop, until stop() is called."""
+        try:
+            while not self._stop.is_set():
+                try:
+                    self.tick()
+                except Exception:
+                    log.exception("matching engine tick failed")
+                self._stop.wait(self.interval)
+        finally:
+            self._thread = None
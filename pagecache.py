@@ -0,0 +1,127 @@
+# ---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+#   Desc.:      Page caching
+#   Purpose:    Renders fixed pages once, and lets browsers revalidate
+#               per-user pages with ETags so unchanged pages cost a 304
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Licensing Info:
+#   ?
+# ---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+
+# Imports:
+import hashlib
+import inspect
+import threading
+import time
+
+from flask import current_app, make_response, request, session
+from functools import wraps
+
+# ---------------------------------------------------------------------------
+#   Desc.:      staticpage(function)
+#   Purpose:    Caches a page that never changes, rendered on first use
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - only GET requests are cached; a POST to the same route runs normally
+#   - pages are kept per endpoint and per logged in / out (the navigation
+#     bar differs), in memory for the life of the app; each app has its
+#     own (see init_app), so two apps never serve each other's pages
+#   - served with an ETag (a hash of the page) and Last-Modified (when it
+#     was rendered), so a browser that already has it gets a 304
+#   - bypassed whenever flashed messages are waiting, since the page has
+#     to show (and so use up) them
+#   - the route must have no side effects on GET
+# ---------------------------------------------------------------------------
+_pages_lock = threading.Lock()
+
+def init_app(app):
+    """Gives an app its own, empty page cache."""
+    app.extensions["pages"] = {}
+
+def staticpage(function):
+    """Decorator serving a route's GET response from the page cache."""
+    @wraps(function)
+    def decorated_function(*args, **kwargs):
+        if request.method != "GET" or "_flashes" in session:
+            return function(*args, **kwargs)
+
+        pages = current_app.extensions["pages"]
+        key = (request.endpoint, session.get("user_id") is not None)
+        page = pages.get(key)
+        if page == None:
+            body = function(*args, **kwargs)
+            if not isinstance(body, str):
+                return body
+            page = (body, hashlib.sha1(body.encode()).hexdigest(), time.time())
+            with _pages_lock:
+                pages[key] = page
+
+        body, etag, rendered = page
+        response = make_response(body)
+        response.set_etag(etag)
+        response.last_modified = rendered
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+    return decorated_function
+
+def clearpages():
+    """Forgets the current app's cached pages (e.g. after a template changes)."""
+    with _pages_lock:
+        current_app.extensions["pages"].clear()
+
+# ---------------------------------------------------------------------------
+#   Desc.:      userpage(version)
+#   Purpose:    Answers 304 for a per-user page the browser already has
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - version() returns a string that changes whenever the page would;
+#     the ETag is made from it and the request's URL, so checking it is
+#     all the work done when the page is unchanged
+#   - bypassed whenever flashed messages are waiting
+#   - an async route takes an async version() too, and both are awaited
+# ---------------------------------------------------------------------------
+def userpage(version):
+    """Decorator adding version-based ETags to a per-user GET route."""
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @wraps(function)
+            async def decorated_coroutine(*args, **kwargs):
+                if request.method != "GET" or "_flashes" in session:
+                    return await function(*args, **kwargs)
+                etag = _etag(await version())
+                if request.if_none_match.contains(etag):
+                    return _tagged(make_response("", 304), etag)
+                response = make_response(await function(*args, **kwargs))
+                return _tagged(response, etag) if response.status_code == 200 else response
+            return decorated_coroutine
+
+        @wraps(function)
+        def decorated_function(*args, **kwargs):
+            if request.method != "GET" or "_flashes" in session:
+                return function(*args, **kwargs)
+            etag = _etag(version())
+            if request.if_none_match.contains(etag):
+                return _tagged(make_response("", 304), etag)
+            response = make_response(function(*args, **kwargs))
+            return _tagged(response, etag) if response.status_code == 200 else response
+        return decorated_function
+    return decorator
+
+def _etag(version):
+    """The ETag for this request's URL at a version."""
+    return hashlib.sha1("{} {}".format(request.full_path, version).encode()).hexdigest()
+
+def _tagged(response, etag):
+    """Marks a per-user response as revalidate-always with its ETag."""
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
@@ -0,0 +1,134 @@
+# ---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+#   Desc.:      Password hashing
+#   Purpose:    Hashes and checks passwords at a configurable cost, on a
+#               small bounded pool of worker threads
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Licensing Info:
+#   ?
+# ---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+
+# Imports:
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from flask import current_app
+from instrument import timed
+
+# 'Constants'
+PASSWORD_ROUNDS = 535000
+PASSWORD_WORKERS = os.cpu_count() or 2
+PASSWORD_QUEUE = 4
+PASSWORD_WAIT = 10.0
+
+class PasswordBusy(Exception):
+    """Raised when too many passwords are already waiting to be hashed."""
+
+# ---------------------------------------------------------------------------
+#   Desc.:      PasswordHasher(rounds, workers, queue)
+#   Purpose:    One app's hash cost and hashing pool
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - new hashes are sha512_crypt with exactly 'rounds' rounds. A stored
+#     hash with any other cost (or the older sha256_crypt) still verifies,
+#     and verify() hands back a replacement so login can upgrade it.
+#   - 'workers' threads do the hashing; at most 'queue' more hashes per
+#     worker may wait for one. Beyond that the call fails straight away
+#     with PasswordBusy, so a flood of logins can't tie up every request
+#     thread (or the whole CPU) hashing. A hash that takes longer than
+#     PASSWORD_WAIT fails with PasswordBusy too, but keeps its place in
+#     the pool until it finishes.
+#   - only the settings are kept at first; passlib is imported and the
+#     pool started by the first hash or check, so workers start quickly
+#   - create_app() keeps one in app.extensions["passwords"]
+# ---------------------------------------------------------------------------
+class PasswordHasher:
+    """Hashes and checks passwords on a bounded pool of threads."""
+    
+    def __init__(self, rounds=PASSWORD_ROUNDS, workers=PASSWORD_WORKERS,
+                 queue=PASSWORD_QUEUE):
+        self.rounds = rounds
+        self.workers = workers
+        self.queue = queue
+        self._context = None
+        self._pool = None
+        self._slots = None
+        self._lock = threading.Lock()
+    
+    def hash(self, password):
+        """Returns the hash to store for a new password."""
+        return self._run("hash", password)
+    
+    def verify(self, password, stored):
+        """Returns (ok, replacement hash or None) for a stored hash."""
+        return self._run("verify_and_update", password, stored)
+    
+    def _ready(self):
+        """Creates the hashing context and worker pool on first use."""
+        if self._context == None:
+            with self._lock:
+                if self._context == None:
+                    from passlib.context import CryptContext
+                    
+                    self._pool = ThreadPoolExecutor(max_workers = self.workers,
+                                                    thread_name_prefix = "password")
+                    self._slots = threading.BoundedSemaphore(self.workers * (self.queue + 1))
+                    self._context = CryptContext(
+                            schemes = ["sha512_crypt", "sha256_crypt"],
+                            default = "sha512_crypt",
+                            deprecated = ["sha256_crypt"],
+                            sha512_crypt__default_rounds = self.rounds,
+                            sha512_crypt__min_rounds = self.rounds,
+                            sha512_crypt__max_rounds = self.rounds)
+        return self._context
+    
+    def _run(self, method, *args):
+        """Runs a context method on the pool, waiting at most PASSWORD_WAIT."""
+        context = self._ready()
+        slots, pool = self._slots, self._pool
+        if not slots.acquire(blocking = False):
+            raise PasswordBusy("too many passwords waiting to be checked")
+        try:
+            future = pool.submit(getattr(context, method), *args)
+        except:
+            slots.release()
+            raise
+        
+        # the slot is held until the hash is really done (or dropped unstarted),
+        # not just until this request stops waiting for it
+        future.add_done_callback(lambda future: slots.release())
+        try:
+            return future.result(PASSWORD_WAIT)
+        except TimeoutError:
+            future.cancel()
+            raise PasswordBusy("timed out waiting for a password to be checked")
+
+# ---------------------------------------------------------------------------
+#   Desc.:      hashpassword(password) / checkpassword(password, stored)
+#   Purpose:    The only two places the app does the expensive hashing
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - checkpassword returns (ok, replacement); replacement is a new hash to
+#     store when the stored one was made at a different cost, else None
+#   - both raise PasswordBusy when the pool is full or the hash takes
+#     longer than PASSWORD_WAIT
+#   - both use the current app's PasswordHasher
+# ---------------------------------------------------------------------------
+@timed("hash")
+def hashpassword(password):
+    """Returns the hash to store for a new password."""
+    return current_app.extensions["passwords"].hash(password)
+
+@timed("hash")
+def checkpassword(password, stored):
+    """Checks a password against its stored hash."""
+    ok, replacement = current_app.extensions["passwords"].verify(password, stored)
+    return ok, replacement
@@ -0,0 +1,112 @@
+# ---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+#   Desc.:      Price history
+#   Purpose:    Keeps every price the app fetches, one append-only file of
+#               fixed-width (time, price) records per symbol
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Licensing Info:
+#   ?
+# ---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+
+# Imports:
+import os
+import re
+import numpy as np
+
+# 'Constants'
+RECORD = np.dtype([("time", "<f8"), ("price", "<f8")])
+INTERVALS = {"minute" : 60, "hour" : 3600, "day" : 86400}
+
+# ---------------------------------------------------------------------------
+#   Desc.:      PriceHistory(directory)
+#   Purpose:    The per-symbol price files in one directory
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - <directory>/<SYMBOL>.prices holds 16 byte records: the time (seconds
+#     since the epoch) and the price, both little-endian float64
+#   - append() writes all of a symbol's new records with one O_APPEND
+#     write, which the OS keeps whole even with several worker processes
+#     appending at once
+#   - reads map the file with numpy.memmap, so a range query is a binary
+#     search and a slice of the mapping; nothing is copied until the
+#     result is turned into JSON
+#   - records are in the order they were written; clocks on different
+#     workers can put neighbours a moment out of order, which the binary
+#     search tolerates (a range may include or miss a record at its edges)
+#   - a torn record at the end of a file (a crash mid-write) is ignored
+# ---------------------------------------------------------------------------
+class PriceHistory:
+    """Append-only, memory-mapped price series per symbol."""
+
+    SYMBOL = re.compile(r"^[A-Z0-9][A-Z0-9.\-]{0,15}$")
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok = True)
+
+    def path(self, symbol):
+        """The file for a symbol; ValueError for anything unsafe as a name."""
+        if not self.SYMBOL.match(symbol):
+            raise ValueError("not a symbol: {!r}".format(symbol))
+        return os.path.join(self.directory, symbol + ".prices")
+
+    def append(self, symbol, times, prices):
+        """Adds (time, price) records for one symbol."""
+        records = np.empty(len(times), dtype = RECORD)
+        records["time"] = times
+        records["price"] = prices
+        descriptor = os.open(self.path(symbol), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(descriptor, records.tobytes())
+        finally:
+            os.close(descriptor)
+
+    def ingest(self, quotes, now):
+        """Records a lookup result ({symbol: quote or None}) taken at 'now'."""
+        for symbol, quote in quotes.items():
+            if quote != None and self.SYMBOL.match(symbol):
+                self.append(symbol, [now], [quote["price"]])
+
+    def records(self, symbol):
+        """Every record for a symbol, as a read-only memory map."""
+        path = self.path(symbol)
+        try:
+            count = os.path.getsize(path) // RECORD.itemsize
+        except OSError:
+            count = 0
+        if count == 0:
+            return np.empty(0, dtype = RECORD)
+        return np.memmap(path, dtype = RECORD, mode = "r", shape = (count,))
+
+    def range(self, symbol, start, end):
+        """The records with start <= time < end (a view, not a copy)."""
+        records = self.records(symbol)
+        times = records["time"]
+        first = np.searchsorted(times, start, side = "left")
+        last = np.searchsorted(times, end, side = "left")
+        return records[first:last]
+
+    def ohlc(self, symbol, start, end, interval):
+        """Open/high/low/close bars of 'interval' seconds over a range."""
+        records = self.range(symbol, start, end)
+        if len(records) == 0:
+            return []
+        times, prices = records["time"], records["price"]
+        buckets = (times // interval).astype(np.int64)
+        starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+        ends = np.r_[starts[1:], len(records)] - 1
+        highs = np.maximum.reduceat(prices, starts)
+        lows = np.minimum.reduceat(prices, starts)
+        return [{
+            "time" : int(buckets[first] * interval),
+            "open" : float(prices[first]),
+            "high" : float(high),
+            "low" : float(low),
+            "close" : float(prices[last]),
+            "count" : int(last - first + 1)
+        } for first, last, high, low in zip(starts, ends, highs, lows)]
@@ -0,0 +1,168 @@
+# ---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+#   Desc.:      Live prices
+#   Purpose:    One background poller per process that fetches the prices
+#               every connected browser is watching and pushes them out
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Licensing Info:
+#   ?
+# ---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+
+# Imports:
+import json
+import queue
+import threading
+
+# 'Constants'
+STREAM_INTERVAL = 15        # seconds between polls
+STREAM_KEEPALIVE = 25       # seconds between keep-alive comments
+STREAM_BACKLOG = 4          # updates a slow listener may fall behind by
+STREAM_SUBSCRIBERS = 16     # most open streams per process
+
+# ---------------------------------------------------------------------------
+#   Desc.:      Subscription
+#   Purpose:    One listener's symbols and its queue of updates
+#   Author:     Joel Tannas
+#   Date:
+# ---------------------------------------------------------------------------
+class Subscription:
+    """The updates waiting for one listener."""
+
+    def __init__(self, symbols, backlog=STREAM_BACKLOG):
+        self.symbols = frozenset(symbols)
+        self.updates = queue.Queue(backlog)
+
+    def push(self, prices):
+        """Queues an update, dropping the oldest if the listener lags."""
+        while True:
+            try:
+                self.updates.put_nowait(prices)
+                return
+            except queue.Full:
+                try:
+                    self.updates.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout):
+        """Waits for the next update; None if 'timeout' passes first."""
+        try:
+            return self.updates.get(timeout = timeout)
+        except queue.Empty:
+            return None
+
+# ---------------------------------------------------------------------------
+#   Desc.:      PriceStream(fetch, interval, limit)
+#   Purpose:    Fans one poll per interval out to every subscription
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - every 'interval' seconds, fetch() is called once with the distinct
+#     symbols anyone is subscribed to (so N users holding M stocks cost at
+#     most one lookup per symbol per interval, not N x M), and each
+#     subscription is sent the prices of its symbols that changed
+#   - the poller thread starts with the first subscription and stops once
+#     there are none left
+#   - one poller per process; with several workers the quote cache's
+#     single-flight keeps upstream fetches to one per symbol anyway
+#   - at most 'limit' subscriptions at once, since each open stream holds
+#     a server thread; subscribe() returns None once they are all taken
+# ---------------------------------------------------------------------------
+class PriceStream:
+    """A shared poller pushing price changes to subscribers."""
+
+    def __init__(self, fetch, interval=STREAM_INTERVAL, limit=STREAM_SUBSCRIBERS):
+        self.fetch = fetch
+        self.interval = interval
+        self.limit = limit
+        self.polls = 0
+        self._subscriptions = set()
+        self._prices = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def subscribe(self, symbols):
+        """Starts listening for 'symbols'; returns the Subscription (or None)."""
+        subscription = Subscription(symbols)
+        with self._lock:
+            if len(self._subscriptions) >= self.limit:
+                return None
+            self._subscriptions.add(subscription)
+            if self._thread == None:
+                self._thread = threading.Thread(target = self._run,
+                                                name = "price-stream",
+                                                daemon = True)
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+            if len(self._subscriptions) == 0:
+                self._wake.set()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._subscriptions)
+
+    def _run(self):
+        """The poller loop: fetch, compare, fan out, sleep."""
+        while True:
+            with self._lock:
+                if len(self._subscriptions) == 0:
+                    self._thread = None
+                    self._prices = {}
+                    return
+                subscriptions = list(self._subscriptions)
+            symbols = set().union(*[subscription.symbols
+                                    for subscription in subscriptions])
+
+            try:
+                quotes = self.fetch(symbols)
+            except Exception:
+                quotes = {}
+            self.polls += 1
+            changed = {symbol : quote["price"] for symbol, quote in quotes.items()
+                        if quote != None and self._prices.get(symbol) != quote["price"]}
+            self._prices.update(changed)
+
+            for subscription in subscriptions:
+                update = {symbol : price for symbol, price in changed.items()
+                            if symbol in subscription.symbols}
+                if len(update) != 0:
+                    subscription.push(update)
+
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+# ---------------------------------------------------------------------------
+#   Desc.:      events(stream, subscription, first, keepalive)
+#   Purpose:    Turns a subscription into a Server-Sent Events body
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - 'first' (the current prices) is sent straight away, then each update
+#     as a 'data:' line of {symbol: price} JSON; comments keep the
+#     connection from idling out between updates
+#   - unsubscribes when the browser goes away (the generator is closed)
+# ---------------------------------------------------------------------------
+def events(stream, subscription, first, keepalive=STREAM_KEEPALIVE):
+    """Yields the text/event-stream for one subscription."""
+    try:
+        yield "retry: 5000\n\n"
+        if len(first) != 0:
+            yield "data: {}\n\n".format(json.dumps(first))
+        while True:
+            update = subscription.get(keepalive)
+            if update == None:
+                yield ": keepalive\n\n"
+            else:
+                yield "data: {}\n\n".format(json.dumps(update))
+    finally:
+        stream.unsubscribe(subscription)
@@ -0,0 +1,347 @@
+# ---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+#   Desc.:      Quote providers
+#   Purpose:    Where stock prices come from: an async HTTP client for the
+#               Yahoo csv endpoint, and a deterministic local simulation
+#               for running offline
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Licensing Info:
+#   ?
+# ---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+
+# Imports:
+import asyncio
+import csv
+import math
+import os
+import random
+import re
+import threading
+import time
+import urllib.parse
+import zlib
+
+# ---------------------------------------------------------------------------
+#   Desc.:      QuoteProvider
+#   Purpose:    The interface every quote source implements
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - fetch(symbols) is a coroutine taking uppercased symbols and returning
+#     {symbol: quote or None}. None means the symbol does not exist; a
+#     symbol left out of the dict could not be fetched right now.
+#   - quotes are dicts of name (str), price (float) and symbol (str)
+#   - call() runs a provider coroutine from ordinary (threaded) code
+# ---------------------------------------------------------------------------
+class QuoteProvider:
+    """Base class for quote sources."""
+
+    async def fetch(self, symbols):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+class ProviderError(Exception):
+    """Raised when a quote source can't be reached."""
+
+class CircuitOpenError(ProviderError):
+    """Raised instead of calling a quote source known to be down."""
+
+# ---------------------------------------------------------------------------
+#   Desc.:      call(coroutine, timeout)
+#   Purpose:    Runs a provider coroutine on the shared provider event loop
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - the loop lives in one daemon thread per process, started on first
+#     use, so HTTP connections stay open (keep-alive) between requests
+#   - raises concurrent.futures.TimeoutError if 'timeout' passes first, and
+#     cancels the coroutine
+#   - acall() is the same for code running on another event loop (the
+#     ASGI server's, see asgi.py): it awaits the result instead of
+#     blocking, so that loop keeps serving while the quotes are fetched
+#     (the provider's connections belong to the provider loop, so the
+#     coroutine still has to run there)
+# ---------------------------------------------------------------------------
+_loop = None
+_loop_lock = threading.Lock()
+
+def eventloop():
+    """Returns the provider event loop, starting its thread if needed."""
+    global _loop
+    with _loop_lock:
+        if _loop == None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target = _loop.run_forever,
+                             name = "quote-provider",
+                             daemon = True).start()
+        return _loop
+
+def call(coroutine, timeout):
+    """Runs a coroutine on the provider loop and waits for its result."""
+    future = asyncio.run_coroutine_threadsafe(coroutine, eventloop())
+    try:
+        return future.result(timeout)
+    except:
+        future.cancel()
+        raise
+
+async def acall(coroutine, timeout):
+    """Awaits a coroutine run on the provider loop, from another loop."""
+    future = asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, eventloop()))
+    return await asyncio.wait_for(future, timeout)
+
+# ---------------------------------------------------------------------------
+#   Desc.:      CircuitBreaker(failures, reset)
+#   Purpose:    Stops calling an upstream that keeps failing
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - closed: calls go through; 'failures' failures in a row opens it
+#   - open: calls fail straight away with CircuitOpenError for 'reset'
+#     seconds, then one trial call is let through (half-open)
+#   - a success closes it again, a failed trial re-opens it
+# ---------------------------------------------------------------------------
+class CircuitBreaker:
+    """Fail-fast guard around an unreliable upstream."""
+
+    def __init__(self, failures=5, reset=30):
+        self.failures = failures
+        self.reset = reset
+        self._count = 0
+        self._opened = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened == None:
+                return "closed"
+            if time.monotonic() - self._opened < self.reset:
+                return "open"
+            return "half-open"
+
+    def allow(self):
+        """Raises CircuitOpenError unless a call may go ahead."""
+        with self._lock:
+            if self._opened == None:
+                return
+            if time.monotonic() - self._opened < self.reset or self._trial:
+                raise CircuitOpenError("quote provider is unavailable")
+            self._trial = True
+
+    def success(self):
+        with self._lock:
+            self._count = 0
+            self._opened = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self._count += 1
+            if self._trial or self._count >= self.failures:
+                self._opened = time.monotonic()
+            self._trial = False
+
+# ---------------------------------------------------------------------------
+#   Desc.:      YahooProvider(url, ...)
+#   Purpose:    Fetches quotes from the Yahoo Finance csv endpoint
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - one aiohttp session per provider, so connections are kept alive and
+#     reused; 'connections' caps how many are open at once
+#   - separate connect and read timeouts, in seconds
+#   - each request is retried 'retries' times with exponential backoff and
+#     full jitter, then counts as one failure towards the circuit breaker
+#   - asks for all symbols in one request (Yahoo takes them comma separated
+#     and answers one csv row each, in order); if that fails, asks for
+#     each symbol on its own, concurrently
+#   - Yahoo csv format is [SYMBOL, NAME, PRICE]
+# ---------------------------------------------------------------------------
+class YahooProvider(QuoteProvider):
+    """Async HTTP client for Yahoo's csv quotes."""
+
+    URL = "http://download.finance.yahoo.com/d/quotes.csv?f=snl1&s={}"
+
+    def __init__(self, url=URL, connect_timeout=2.0, read_timeout=3.0,
+                 retries=2, backoff=0.1, connections=8, breaker=None):
+        self.url = url
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.connections = connections
+        self.breaker = breaker if breaker != None else CircuitBreaker()
+        self._session = None
+
+    async def fetch(self, symbols):
+        """Returns {symbol: quote or None} for the symbols it could fetch."""
+
+        # --- Section 010: Try a single batched request
+        try:
+            rows = await self._request(symbols)
+            if len(rows) == len(symbols):
+                return {symbol : parsequote(row)
+                        for symbol, row in zip(symbols, rows)}
+        except CircuitOpenError:
+            return {}
+        except ProviderError:
+            pass
+        if len(symbols) == 1:
+            return {}
+
+        # --- Section 020: Fall back to one request per symbol
+        async def single(symbol):
+            try:
+                rows = await self._request([symbol])
+                return symbol, parsequote(rows[0]) if len(rows) != 0 else None
+            except ProviderError:
+                return symbol, False
+
+        results = await asyncio.gather(*[single(symbol) for symbol in symbols])
+        return {symbol : quote for symbol, quote in results if quote is not False}
+
+    async def close(self):
+        if self._session != None:
+            await self._session.close()
+            self._session = None
+
+    async def _request(self, symbols):
+        """GETs the csv for some symbols, with retries and the breaker."""
+        import aiohttp
+
+        self.breaker.allow()
+        url = self.url.format(urllib.parse.quote(",".join(symbols), safe = ","))
+        for attempt in range(self.retries + 1):
+            try:
+                async with self._client().get(url) as response:
+                    if response.status >= 500:
+                        raise ProviderError("HTTP {}".format(response.status))
+                    text = await response.text()
+                self.breaker.success()
+                return list(csv.reader(text.splitlines()))
+            except (aiohttp.ClientError, asyncio.TimeoutError, ProviderError):
+                if attempt == self.retries:
+                    self.breaker.failure()
+                    raise ProviderError("could not reach " + url)
+                await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    def _client(self):
+        """Returns the keep-alive session, creating it on the loop."""
+        import aiohttp
+
+        if self._session == None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector = aiohttp.TCPConnector(limit = self.connections,
+                                                 keepalive_timeout = 30),
+                timeout = aiohttp.ClientTimeout(total = None,
+                                                connect = self.connect_timeout,
+                                                sock_read = self.read_timeout))
+        return self._session
+
+def parsequote(row):
+    """Converts a Yahoo csv row into a quote dict (or None)."""
+
+    # ensure stock exists
+    try:
+        price = float(row[2])
+    except (IndexError, ValueError):
+        return None
+
+    # return stock's name (as a str), price (as a float), and (uppercased) symbol (as a str)
+    return {
+        "name": row[1],
+        "price": price,
+        "symbol": row[0].upper()
+    }
+
+# ---------------------------------------------------------------------------
+#   Desc.:      LocalProvider(path, seed, volatility, interval, latency)
+#   Purpose:    Made-up but repeatable quotes, with no network at all
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - with 'path', prices come from a csv file of SYMBOL,NAME,PRICE rows
+#     and any other symbol is unknown; the file is re-read when it changes
+#   - without it, every plausible symbol (1-8 letters, digits, '.' or
+#     '-') gets a random walk: a starting price picked from the symbol
+#     and seed, moved by 'volatility' every 'interval' seconds since
+#     midnight UTC, and reset each day. The same symbol, seed and time
+#     give the same price in every process.
+#   - 'latency' seconds are waited (without blocking the loop) before each
+#     answer, to stand in for a slow upstream in benchmarks
+# ---------------------------------------------------------------------------
+class LocalProvider(QuoteProvider):
+    """Deterministic offline quote source."""
+
+    SYMBOL = re.compile(r"^[A-Z][A-Z0-9.\-]{0,7}$")
+
+    def __init__(self, path=None, seed=0, volatility=0.002, interval=60, latency=0):
+        self.path = path
+        self.seed = seed
+        self.volatility = volatility
+        self.interval = interval
+        self.latency = latency
+        self._file = (None, {})
+        self._walks = {}
+
+    async def fetch(self, symbols):
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        if self.path != None:
+            quotes = self._read()
+            return {symbol : quotes.get(symbol) for symbol in symbols}
+        now = time.time()
+        return {symbol : self.quote(symbol, now) for symbol in symbols}
+
+    def quote(self, symbol, now):
+        """The random walk quote for a symbol at a time (or None)."""
+        if not self.SYMBOL.match(symbol):
+            return None
+        return {
+            "name" : "{} (simulated)".format(symbol),
+            "price" : round(self._walk(symbol, now), 2),
+            "symbol" : symbol
+        }
+
+    def _walk(self, symbol, now):
+        """Steps the symbol's walk forward to 'now' and returns its price."""
+        day, seconds = divmod(int(now), 86400)
+        step = int(seconds // self.interval)
+        key = zlib.crc32("{}:{}".format(symbol, self.seed).encode())
+
+        walk = self._walks.get(symbol)
+        if walk == None or walk[0] != day or walk[1] > step:
+            start = 10 + (key % 49000) / 100
+            rng = random.Random(key ^ day)
+            walk = self._walks[symbol] = [day, 0, start, rng]
+
+        day, done, price, rng = walk
+        for i in range(done, step):
+            price *= math.exp(self.volatility * rng.gauss(0, 1))
+        walk[1:3] = [step, price]
+        return price
+
+    def _read(self):
+        """Loads the csv file, reusing it until it is modified."""
+        modified = os.path.getmtime(self.path)
+        if self._file[0] != modified:
+            quotes = {}
+            with open(self.path, newline = "") as listing:
+                for row in csv.reader(listing):
+                    quote = parsequote(row)
+                    if quote != None:
+                        quotes[quote["symbol"]] = quote
+            self._file = (modified, quotes)
+        return self._file[1]
@@ -0,0 +1,482 @@
+# ---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+#   Desc.:      Quote cache
+#   Purpose:    Keeps recently fetched stock quotes so that popular symbols
+#               are not fetched from Yahoo on every request
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Licensing Info:
+#   ?
+# ---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+
+# Imports:
+import asyncio
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+
+# ---------------------------------------------------------------------------
+#   Desc.:      QuoteCache(ttl, maxsize, negative_ttl, stale_ttl, backend)
+#   Purpose:    A thread-safe cache of quote dicts keyed by symbol
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - 'ttl' is how many seconds a quote is served as fresh
+#   - 'maxsize' is the most symbols held; the backend drops the rest
+#   - 'negative_ttl' is how long an unknown symbol (None) is remembered
+#   - 'stale_ttl' enables stale-while-revalidate: for that many seconds past
+#     expiry the old quote is returned straight away and a background
+#     thread fetches a new one. 0 turns it off.
+#   - 'backend' is where entries live (MemoryBackend or SQLiteBackend)
+#   - loaders take a list of (uppercased) symbols and return a dict of
+#     {symbol: quote or None}. Symbols left out of the dict, or a loader
+#     that raises, count as a failed fetch and are not cached.
+#   - misses are single-flight: whoever claims a symbol in the backend
+#     fetches it, everyone else (thread or process) waits for the result
+#   - get_many_async() is the same for a coroutine loader, for the async
+#     views (see asgi.py): the fetch and the single-flight wait are
+#     awaited, and so are the backend's calls when it does I/O (its
+#     'blocking' is True), run on the loop's default executor, so a cache
+#     file locked by another worker never stalls the event loop
+#   - each fetch claims its symbols under an owner of its own, so its
+#     claims can be released from whichever thread it ends up on
+#   - counters are per process
+# ---------------------------------------------------------------------------
+class QuoteCache:
+    """Quote cache with TTL, bounded size, single-flight and counters."""
+
+    def __init__(self, ttl=60, maxsize=1024, negative_ttl=300, stale_ttl=0,
+                 backend=None, lease=10):
+        self._lock = threading.Lock()
+        self._tasks = set()
+        self.backend = MemoryBackend()
+        self.clear()
+        self.configure(ttl, maxsize, negative_ttl, stale_ttl, backend, lease)
+
+    def configure(self, ttl=60, maxsize=1024, negative_ttl=300, stale_ttl=0,
+                  backend=None, lease=10):
+        """Changes the cache settings, and the backend if one is given."""
+        with self._lock:
+            self.ttl = ttl
+            self.maxsize = maxsize
+            self.negative_ttl = negative_ttl
+            self.stale_ttl = stale_ttl
+            self.lease = lease
+            if backend != None:
+                self.backend = backend
+            self._counters["evictions"] += self.backend.evict(maxsize)
+
+    def clear(self):
+        """Drops every entry and resets the counters."""
+        self.backend.clear()
+        with self._lock:
+            self._counters = {
+                            "hits" : 0,
+                            "negative_hits" : 0,
+                            "stale_hits" : 0,
+                            "misses" : 0,
+                            "coalesced" : 0,
+                            "evictions" : 0,
+                            "refreshes" : 0,
+                            "errors" : 0
+                            }
+
+    def stats(self):
+        """Returns a snapshot of the counters and the current size."""
+        with self._lock:
+            stats = dict(self._counters)
+        stats["size"] = len(self.backend)
+        stats["maxsize"] = self.maxsize
+        stats["backend"] = type(self.backend).__name__
+        return stats
+
+    def get(self, symbol, loader):
+        """Returns the quote for one symbol, calling loader(symbol) on a miss."""
+        return self.get_many([symbol],
+                    lambda symbols: {s : loader(s) for s in symbols})[symbol]
+
+    def get_many(self, symbols, loader):
+        """Returns {symbol: quote} for symbols, loading only the misses."""
+
+        # --- Section 010: Serve what we can from the cache
+        found, missing, stale = self._serve(symbols)
+
+        # --- Section 020: Refresh stale entries in the background
+        if len(stale) != 0:
+            threading.Thread(target = self._refresh,
+                             args = (list(stale), loader),
+                             daemon = True).start()
+        found.update(stale)
+
+        # --- Section 030: Fetch the misses now, once across all workers
+        if len(missing) != 0:
+            found.update(self._fetch(missing, loader))
+
+        return {symbol : found.get(symbol.upper()) for symbol in symbols}
+
+    async def get_many_async(self, symbols, loader):
+        """get_many() with a coroutine loader, awaiting the misses."""
+        found, missing, stale = await self._offload(self._serve, symbols)
+        if len(stale) != 0:
+            task = asyncio.ensure_future(self._refresh_async(list(stale), loader))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        found.update(stale)
+        if len(missing) != 0:
+            found.update(await self._fetch_async(missing, loader))
+        return {symbol : found.get(symbol.upper()) for symbol in symbols}
+
+    def put(self, symbol, quote):
+        """Stores a quote (or None for an unknown symbol)."""
+        self.put_many({symbol : quote})
+
+    def put_many(self, quotes):
+        """Stores a dict of {symbol: quote or None}."""
+        now = time.time()
+        entries = {}
+        for symbol, quote in quotes.items():
+            ttl = self.ttl if quote != None else self.negative_ttl
+            entries[symbol.upper()] = (quote, now + ttl)
+        evicted = self.backend.put_many(entries, self.maxsize)
+        self._count(evictions = evicted)
+
+    def _serve(self, symbols):
+        """Looks the symbols up and counts the hits, misses and stale hits."""
+        keys = list(OrderedDict.fromkeys(symbol.upper() for symbol in symbols))
+        found, missing, stale = self._classify(keys, time.time())
+        self._count(hits = sum(1 for q in found.values() if q != None),
+                    negative_hits = sum(1 for q in found.values() if q == None),
+                    misses = len(missing),
+                    stale_hits = len(stale))
+        return found, missing, stale
+
+    def _classify(self, keys, now):
+        """Splits keys into fresh quotes, misses and stale quotes."""
+        found = {}
+        missing = []
+        stale = {}
+        entries = self.backend.get_many(keys)
+        for key in keys:
+            entry = entries.get(key)
+            if entry == None or now >= entry[1] + self.stale_ttl:
+                missing.append(key)
+            elif now < entry[1]:
+                found[key] = entry[0]
+            else:
+                stale[key] = entry[0]
+        return found, missing, stale
+
+    def _fetch(self, keys, loader):
+        """Single-flight fetch: load what we claim, wait for the rest."""
+        fetched = {}
+        waited = False
+        deadline = time.time() + self.lease
+        owner = uuid.uuid4().hex
+        while len(keys) != 0:
+
+            # Whoever claims a symbol is the only one to fetch it
+            claimed = self.backend.claim(keys, self.lease, owner)
+            if len(claimed) != 0:
+                try:
+                    fetched.update(self._load(claimed, loader))
+                finally:
+                    self.backend.release(claimed, owner)
+            keys = [key for key in keys if key not in claimed]
+            if len(keys) == 0:
+                break
+
+            # Somebody else is fetching the rest; wait for their results
+            if not waited:
+                self._count(coalesced = len(keys))
+                waited = True
+            time.sleep(0.02)
+            found, keys, stale = self._classify(keys, time.time())
+            fetched.update(found)
+            fetched.update(stale)
+
+            # ...but not forever; a crashed fetcher's lease lapses anyway
+            if time.time() >= deadline:
+                fetched.update(self._load(keys, loader))
+                break
+
+        return fetched
+
+    async def _fetch_async(self, keys, loader):
+        """_fetch(), awaiting the loader and the wait for other fetchers."""
+        fetched = {}
+        waited = False
+        deadline = time.time() + self.lease
+        owner = uuid.uuid4().hex
+        while len(keys) != 0:
+            claimed = await self._offload(self.backend.claim, keys, self.lease, owner)
+            if len(claimed) != 0:
+                try:
+                    fetched.update(await self._load_async(claimed, loader))
+                finally:
+                    await self._offload(self.backend.release, claimed, owner)
+            keys = [key for key in keys if key not in claimed]
+            if len(keys) == 0:
+                break
+
+            if not waited:
+                self._count(coalesced = len(keys))
+                waited = True
+            await asyncio.sleep(0.02)
+            found, keys, stale = await self._offload(self._classify, keys, time.time())
+            fetched.update(found)
+            fetched.update(stale)
+
+            if time.time() >= deadline:
+                fetched.update(await self._load_async(keys, loader))
+                break
+
+        return fetched
+
+    def _load(self, keys, loader):
+        """Calls the loader and caches whatever it returned."""
+        try:
+            fetched = loader(keys)
+        except Exception:
+            fetched = {}
+        return self._store(keys, fetched)
+
+    async def _load_async(self, keys, loader):
+        try:
+            fetched = await loader(keys)
+        except Exception:
+            fetched = {}
+        return await self._offload(self._store, keys, fetched)
+
+    def _store(self, keys, fetched):
+        """Caches a loader's result, counting what it left out as errors."""
+        self._count(errors = len(set(keys) - set(fetched)))
+        self.put_many(fetched)
+        return fetched
+
+    def _refresh(self, keys, loader):
+        """Background half of stale-while-revalidate."""
+        owner = uuid.uuid4().hex
+        claimed = self.backend.claim(keys, self.lease, owner)
+        if len(claimed) == 0:
+            return
+        try:
+            self._load(claimed, loader)
+            self._count(refreshes = 1)
+        finally:
+            self.backend.release(claimed, owner)
+
+    async def _refresh_async(self, keys, loader):
+        owner = uuid.uuid4().hex
+        claimed = await self._offload(self.backend.claim, keys, self.lease, owner)
+        if len(claimed) == 0:
+            return
+        try:
+            await self._load_async(claimed, loader)
+            self._count(refreshes = 1)
+        finally:
+            await self._offload(self.backend.release, claimed, owner)
+
+    async def _offload(self, function, *args):
+        """Awaits function(*args) on a thread if the backend does I/O."""
+        if not self.backend.blocking:
+            return function(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(function, *args))
+
+    def _count(self, **counts):
+        """Adds to the counters."""
+        with self._lock:
+            for name, count in counts.items():
+                self._counters[name] += count
+
+# ---------------------------------------------------------------------------
+#   Desc.:      Quote cache backends
+#   Purpose:    Storage for QuoteCache entries
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - an entry is a (quote, expires) tuple, with 'expires' in time.time()
+#     seconds so that it means the same thing in every process
+#   - a backend provides:
+#       get_many(keys)          -> {key: entry} for the keys it holds
+#       put_many(entries, max)  -> stores entries, returns how many evicted
+#       evict(max)              -> shrinks to max entries, returns the count
+#       claim(keys, lease, owner)
+#                               -> the keys 'owner' may fetch; others are
+#                                  already being fetched by someone else
+#       release(keys, owner)    -> gives up the owner's claims
+#       clear(), len()
+#       blocking                -> True if the calls above do I/O
+# ---------------------------------------------------------------------------
+class MemoryBackend:
+    """Per-process LRU backend."""
+
+    blocking = False
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._claims = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_many(self, keys):
+        with self._lock:
+            entries = {}
+            for key in keys:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    entries[key] = self._entries[key]
+            return entries
+
+    def put_many(self, entries, maxsize):
+        with self._lock:
+            for key, entry in entries.items():
+                self._entries[key] = entry
+                self._entries.move_to_end(key)
+        return self.evict(maxsize)
+
+    def evict(self, maxsize):
+        with self._lock:
+            evicted = 0
+            while len(self._entries) > maxsize:
+                self._entries.popitem(last = False)
+                evicted += 1
+            return evicted
+
+    def claim(self, keys, lease, owner):
+        now = time.time()
+        with self._lock:
+            claimed = []
+            for key in keys:
+                if self._claims.get(key, (0, None))[0] <= now:
+                    self._claims[key] = (now + lease, owner)
+                    claimed.append(key)
+            return claimed
+
+    def release(self, keys, owner):
+        with self._lock:
+            for key in keys:
+                if self._claims.get(key, (0, None))[1] == owner:
+                    del self._claims[key]
+
+# ---------------------------------------------------------------------------
+#   Desc.:      SQLiteBackend(path)
+#   Purpose:    A quote cache shared by every worker process on the machine
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - lives in its own database file (normally in the instance folder) so
+#     it never contends with finance.db
+#   - claims are rows in quote_leases; INSERT OR IGNORE on the primary key
+#     means exactly one worker wins each symbol until its lease runs out
+#   - eviction drops the entries closest to expiry, not strictly LRU, so
+#     that reads never have to write
+# ---------------------------------------------------------------------------
+class SQLiteBackend:
+    """Quote cache backend kept in a SQLite file."""
+
+    blocking = True
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        with self._connect() as connection:
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS quotes (
+                    symbol TEXT PRIMARY KEY NOT NULL,
+                    quote TEXT,
+                    expires REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS quote_leases (
+                    symbol TEXT PRIMARY KEY NOT NULL,
+                    owner TEXT NOT NULL,
+                    expires REAL NOT NULL
+                );
+            """)
+
+    def _connect(self):
+        """Returns this thread's connection, opening it if needed."""
+        connection = getattr(self._local, "connection", None)
+        if connection == None:
+            connection = sqlite3.connect(self.path, timeout = 5)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM quotes").fetchone()[0]
+
+    def clear(self):
+        with self._connect() as connection:
+            connection.execute("DELETE FROM quotes")
+            connection.execute("DELETE FROM quote_leases")
+
+    def get_many(self, keys):
+        rows = self._connect().execute(
+                    "SELECT symbol, quote, expires FROM quotes "
+                    + "WHERE symbol IN ({})".format(",".join("?" * len(keys))),
+                    keys)
+        return {row[0] : (json.loads(row[1]), row[2]) for row in rows}
+
+    def put_many(self, entries, maxsize):
+        with self._connect() as connection:
+            connection.executemany(
+                    "INSERT OR REPLACE INTO quotes(symbol, quote, expires) "
+                    + "VALUES (?, ?, ?)",
+                    [(key, json.dumps(quote), expires)
+                        for key, (quote, expires) in entries.items()])
+        return self.evict(maxsize)
+
+    def evict(self, maxsize):
+        with self._connect() as connection:
+            count = connection.execute("SELECT COUNT(*) FROM quotes").fetchone()[0]
+            if count <= maxsize:
+                return 0
+            connection.execute(
+                    "DELETE FROM quotes WHERE symbol IN "
+                    + "(SELECT symbol FROM quotes ORDER BY expires LIMIT ?)",
+                    (count - maxsize,))
+            return count - maxsize
+
+    def claim(self, keys, lease, owner):
+        now = time.time()
+        connection = self._connect()
+        with connection:
+            connection.execute("DELETE FROM quote_leases WHERE expires <= ?", (now,))
+            connection.executemany(
+                    "INSERT OR IGNORE INTO quote_leases(symbol, owner, expires) "
+                    + "VALUES (?, ?, ?)",
+                    [(key, owner, now + lease) for key in keys])
+            rows = connection.execute(
+                    "SELECT symbol FROM quote_leases WHERE owner = ? "
+                    + "AND symbol IN ({})".format(",".join("?" * len(keys))),
+                    [owner] + list(keys))
+            claimed = set(row[0] for row in rows)
+        return [key for key in keys if key in claimed]
+
+    def release(self, keys, owner):
+        with self._connect() as connection:
+            connection.executemany(
+                    "DELETE FROM quote_leases WHERE symbol = ? AND owner = ?",
+                    [(key, owner) for key in keys])
@@ -0,0 +1,278 @@
+# ---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+#   Desc.:      Database schema
+#   Purpose:    Creates finance.db if needed and migrates it to the current
+#               version, including the indexes the hot queries rely on
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Licensing Info:
+#   ?
+# ---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+
+# Imports:
+import os
+import re
+import sqlite3
+
+# ---------------------------------------------------------------------------
+#   Desc.:      MIGRATIONS
+#   Purpose:    The ordered list of schema changes
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - the database's PRAGMA user_version counts how many have been applied
+#   - only ever append to this list; never edit an entry once released
+#   - the first entries use IF NOT EXISTS because databases made before
+#     this module existed already have those tables at user_version 0
+# ---------------------------------------------------------------------------
+MIGRATIONS = [
+
+    # 1: the original users and transactions tables
+    [
+    "CREATE TABLE IF NOT EXISTS users ("
+        + "id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, "
+        + "username TEXT NOT NULL, "
+        + "password TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS transactions ("
+        + "id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, "
+        + "user_id INTEGER NOT NULL, "
+        + "symbol TEXT NOT NULL, "
+        + "amount NUMERIC NOT NULL, "
+        + "timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)",
+    ],
+
+    # 2: running balances per user and symbol, filled from the ledger
+    [
+    "CREATE TABLE IF NOT EXISTS positions ("
+        + "user_id INTEGER NOT NULL, "
+        + "symbol TEXT NOT NULL, "
+        + "amount NUMERIC NOT NULL DEFAULT 0, "
+        + "PRIMARY KEY (user_id, symbol))",
+    "INSERT INTO positions(user_id, symbol, amount) "
+        + "SELECT user_id, symbol, SUM(amount) "
+        + "FROM transactions "
+        + "WHERE NOT EXISTS (SELECT 1 FROM positions) "
+        + "GROUP BY user_id, symbol",
+    ],
+
+    # 3: indexes for the per-user ledger queries and for logging in
+    [
+    "CREATE INDEX IF NOT EXISTS transactions_user_symbol "
+        + "ON transactions(user_id, symbol)",
+    "CREATE INDEX IF NOT EXISTS transactions_user_id "
+        + "ON transactions(user_id, id DESC)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS users_username "
+        + "ON users(username)",
+    ],
+
+    # 4: account value over time, one row per user per snapshot
+    [
+    "CREATE TABLE IF NOT EXISTS portfolio_snapshots ("
+        + "user_id INTEGER NOT NULL, "
+        + "taken INTEGER NOT NULL, "
+        + "cash REAL NOT NULL, "
+        + "stocks REAL NOT NULL, "
+        + "PRIMARY KEY (user_id, taken)) WITHOUT ROWID",
+    ],
+
+    # 5: the price each stock leg was traded at (NULL for cash legs and for
+    # trades made before this)
+    [
+    "ALTER TABLE transactions ADD COLUMN price REAL",
+    ],
+
+    # 6: resting limit and stop orders, filled by the matching engine; the
+    # partial index holds only the open ones, which is all the engine reads
+    [
+    "CREATE TABLE IF NOT EXISTS orders ("
+        + "id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, "
+        + "user_id INTEGER NOT NULL, "
+        + "symbol TEXT NOT NULL, "
+        + "side TEXT NOT NULL, "
+        + "kind TEXT NOT NULL, "
+        + "units INTEGER NOT NULL, "
+        + "price REAL NOT NULL, "
+        + "status TEXT NOT NULL DEFAULT 'open', "
+        + "reason TEXT, "
+        + "fill_price REAL, "
+        + "placed DATETIME DEFAULT CURRENT_TIMESTAMP, "
+        + "settled DATETIME)",
+    "CREATE INDEX IF NOT EXISTS orders_open "
+        + "ON orders(id) WHERE status = 'open'",
+    "CREATE INDEX IF NOT EXISTS orders_user "
+        + "ON orders(user_id, id DESC)",
+    ],
+
+    # 7: aggregates kept up to date with every trade: the total held of
+    # each symbol across all users, and each user's account value at the
+    # prices of the last leaderboard repricing (cash always at 1), sorted
+    # by an index so the top of the leaderboard is a short index walk
+    [
+    "CREATE TABLE IF NOT EXISTS holdings_totals ("
+        + "symbol TEXT PRIMARY KEY NOT NULL, "
+        + "amount NUMERIC NOT NULL DEFAULT 0) WITHOUT ROWID",
+    "INSERT INTO holdings_totals(symbol, amount) "
+        + "SELECT symbol, SUM(amount) FROM positions GROUP BY symbol",
+    "CREATE TABLE IF NOT EXISTS leaderboard_prices ("
+        + "symbol TEXT PRIMARY KEY NOT NULL, "
+        + "price REAL NOT NULL, "
+        + "priced INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID",
+    "INSERT INTO leaderboard_prices(symbol, price) VALUES ('cash_USD', 1)",
+    "CREATE TABLE IF NOT EXISTS leaderboard ("
+        + "user_id INTEGER PRIMARY KEY NOT NULL, "
+        + "value REAL NOT NULL DEFAULT 0)",
+    "INSERT INTO leaderboard(user_id, value) "
+        + "SELECT user_id, amount FROM positions WHERE symbol = 'cash_USD'",
+    "CREATE INDEX IF NOT EXISTS leaderboard_value "
+        + "ON leaderboard(value DESC)",
+    ],
+
+    # 8: checkpoint rows left by 'flask compact' in place of the rows it
+    # archived; NULL for every ordinary ledger row
+    [
+    "ALTER TABLE transactions ADD COLUMN checkpoint INTEGER",
+    ],
+]
+
+# ---------------------------------------------------------------------------
+#   Desc.:      ARCHIVE_SCHEMA
+#   Purpose:    The tables of the archive database, attached as 'archive'
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - archive.transactions holds ledger rows moved out of finance.db by
+#     'flask compact', with their original ids, so they interleave with
+#     the live rows by id
+#   - created on attach if missing; it only ever gains rows
+# ---------------------------------------------------------------------------
+ARCHIVE_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS archive.transactions ("
+        + "id INTEGER PRIMARY KEY NOT NULL, "
+        + "user_id INTEGER NOT NULL, "
+        + "symbol TEXT NOT NULL, "
+        + "amount NUMERIC NOT NULL, "
+        + "price REAL, "
+        + "timestamp DATETIME)",
+    "CREATE INDEX IF NOT EXISTS archive.transactions_user_id "
+        + "ON transactions(user_id, id DESC)",
+]
+
+# ---------------------------------------------------------------------------
+#   Desc.:      QUERY_PLANS
+#   Purpose:    The hot queries, and the index each one must be able to use
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - each names a statement in database.STATEMENTS, so checkplans() always
+#     checks the SQL the app really runs
+#   - checked by checkplans(), and by tests/test_schema.py
+# ---------------------------------------------------------------------------
+QUERY_PLANS = [
+    ("history", "transactions_user_id"),
+    ("history_all", "transactions_user_id"),
+    ("latest_transaction", "transactions_user_id"),
+    ("ledger", "transactions_user_id"),
+    ("user_by_name", "users_username"),
+    ("portfolio", "sqlite_autoindex_positions_1"),
+    ("balance", "sqlite_autoindex_positions_1"),
+    ("balances", "sqlite_autoindex_positions_1"),
+    ("snapshots", "PRIMARY KEY"),
+    ("open_orders", "orders_open"),
+    ("user_orders", "orders_user"),
+    ("leaderboard_top", "leaderboard_value"),
+    ("leaderboard_rank", "leaderboard_value"),
+]
+
+# ---------------------------------------------------------------------------
+#   Desc.:      migrate(path)
+#   Purpose:    Brings the database at 'path' up to the latest version
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - creates the file if it does not exist
+#   - each migration runs in its own BEGIN IMMEDIATE transaction and
+#     re-reads the version once it holds the lock, so several workers
+#     starting at once apply each step exactly once
+#   - returns the version the database is at afterwards
+# ---------------------------------------------------------------------------
+def migrate(path):
+    """Creates or upgrades the database schema."""
+    connection = sqlite3.connect(path, timeout = 30, isolation_level = None)
+    try:
+        for version, statements in enumerate(MIGRATIONS, start = 1):
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                current = connection.execute("PRAGMA user_version").fetchone()[0]
+                if current < version:
+                    for statement in statements:
+                        connection.execute(statement)
+                    connection.execute("PRAGMA user_version = {:d}".format(version))
+            except:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        return connection.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        connection.close()
+
+# ---------------------------------------------------------------------------
+#   Desc.:      attacharchive(connection, path)
+#   Purpose:    Attaches the archive database to a connection as 'archive'
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - creates the file and its tables if needed; a path of ':memory:'
+#     gives an empty archive, so queries over it work without one
+# ---------------------------------------------------------------------------
+def attacharchive(connection, path):
+    """Attaches (and if need be creates) the archive database."""
+    if path != ":memory:":
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+    connection.execute("ATTACH DATABASE ? AS archive", (path,))
+    for statement in ARCHIVE_SCHEMA:
+        connection.execute(statement)
+
+# ---------------------------------------------------------------------------
+#   Desc.:      checkplans(path)
+#   Purpose:    Confirms the hot queries use their indexes
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - runs EXPLAIN QUERY PLAN for each of QUERY_PLANS and returns a list of
+#     problem strings; an empty list means every query is indexed
+#   - a query fails if it does not name its index, scans a table without
+#     an index, or needs a temporary b-tree to sort
+#   - every parameter is bound to NULL; the plan does not depend on values
+#   - an empty archive is attached, as the history queries read it too
+# ---------------------------------------------------------------------------
+def checkplans(path):
+    """Lists the hot queries that would fall back to table scans."""
+    from database import STATEMENTS
+    
+    problems = []
+    connection = sqlite3.connect(path)
+    try:
+        attacharchive(connection, ":memory:")
+        for name, index in QUERY_PLANS:
+            query = STATEMENTS[name]
+            params = {param : None for param in re.findall(r":(\w+)", query)}
+            plan = [row[-1] for row in
+                    connection.execute("EXPLAIN QUERY PLAN " + query, params)]
+            scans = [step for step in plan
+                    if step.startswith("SCAN") and " USING " not in step]
+            if not any(index in step for step in plan):
+                problems.append("{}: does not use {} ({})"
+                                .format(name, index, "; ".join(plan)))
+            elif len(scans) != 0 or any("TEMP B-TREE" in step for step in plan):
+                problems.append("{}: {}".format(name, "; ".join(plan)))
+    finally:
+        connection.close()
+    return problems
@@ -0,0 +1,209 @@
+# ---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+#   Desc.:      Session storage
+#   Purpose:    Chooses where logged in sessions are kept: temp files,
+#               a SQLite table, or a signed cookie
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Licensing Info:
+#   ?
+# ---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+
+# Imports:
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSessionInterface, SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+# 'Constants'
+SESSION_BACKENDS = ["filesystem", "sqlite", "cookie"]
+SESSION_PRUNE_INTERVAL = 300
+
+# ---------------------------------------------------------------------------
+#   Desc.:      SQLiteSession
+#   Purpose:    A session dict that remembers whether it was changed
+#   Author:     Joel Tannas
+#   Date:
+# ---------------------------------------------------------------------------
+class SQLiteSession(CallbackDict, SessionMixin):
+    """Server-side session data, keyed by a random session id."""
+
+    def __init__(self, initial=None, sid=None, expires=0, new=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.expires = expires
+        self.new = new
+        self.modified = False
+
+# ---------------------------------------------------------------------------
+#   Desc.:      SQLiteSessionInterface(path, prune)
+#   Purpose:    Keeps sessions in one SQLite table instead of temp files
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - a request only writes its session back if it changed it, or if more
+#     than half of the session's lifetime (PERMANENT_SESSION_LIFETIME) has
+#     gone by and it needs extending; most requests just do one read
+#   - expired sessions are ignored when read, and deleted all at once by
+#     a single DELETE at most every 'prune' seconds per process
+#   - an unknown or expired session id from the browser is never reused;
+#     the visitor gets a fresh random one
+#   - values are stored with Flask's tagged JSON, so flashed (category,
+#     message) tuples come back as tuples
+# ---------------------------------------------------------------------------
+class SQLiteSessionInterface(SessionInterface):
+    """Flask session interface backed by a SQLite table."""
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, path, prune=SESSION_PRUNE_INTERVAL):
+        self.path = path
+        self.prune = prune
+        self._pruned = 0
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        with self._connect() as connection:
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    sid TEXT PRIMARY KEY NOT NULL,
+                    data TEXT NOT NULL,
+                    expires REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS sessions_expires ON sessions(expires);
+            """)
+
+    def _connect(self):
+        """Returns this thread's connection, opening it if needed."""
+        connection = getattr(self._local, "connection", None)
+        if connection == None:
+            connection = sqlite3.connect(self.path, timeout = 5)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def open_session(self, app, request):
+        """Loads the session named by the request's cookie, or a new one."""
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            row = self._connect().execute(
+                    "SELECT data, expires FROM sessions "
+                    + "WHERE sid = ? AND expires > ?", (sid, time.time())).fetchone()
+            if row != None:
+                return SQLiteSession(self.serializer.loads(row[0]), sid, row[1])
+        return SQLiteSession(sid = secrets.token_urlsafe(32), new = True)
+
+    def save_session(self, app, session, response):
+        """Writes the session back only if it changed or is due to expire."""
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        now = time.time()
+        self.expire(now)
+
+        # --- Section 010: An emptied session is deleted, cookie and all
+        if len(session) == 0:
+            if not session.new:
+                with self._connect() as connection:
+                    connection.execute("DELETE FROM sessions WHERE sid = ?", (session.sid,))
+            if session.modified:
+                response.delete_cookie(name, domain = domain, path = path)
+            return
+
+        # --- Section 020: Store it if it changed or needs extending
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        extend = session.expires - now < lifetime / 2
+        if session.modified or extend:
+            session.expires = now + lifetime
+            with self._connect() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO sessions(sid, data, expires) "
+                    + "VALUES (?, ?, ?)",
+                    (session.sid, self.serializer.dumps(dict(session)), session.expires))
+
+        # --- Section 030: The cookie only needs sending when it changes
+        if session.new or (extend and session.permanent):
+            response.set_cookie(name, session.sid,
+                                expires = self.get_expiration_time(app, session),
+                                httponly = self.get_cookie_httponly(app),
+                                domain = domain, path = path,
+                                secure = self.get_cookie_secure(app),
+                                samesite = self.get_cookie_samesite(app))
+        response.vary.add("Cookie")
+
+    def expire(self, now=None):
+        """Deletes every expired session, at most once per 'prune' seconds."""
+        now = time.time() if now == None else now
+        if now - self._pruned < self.prune:
+            return 0
+        self._pruned = now
+        with self._connect() as connection:
+            return connection.execute("DELETE FROM sessions WHERE expires <= ?",
+                                      (now,)).rowcount
+
+# ---------------------------------------------------------------------------
+#   Desc.:      init_app(app, backend)
+#   Purpose:    Points the app's sessions at one of SESSION_BACKENDS
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - filesystem: Flask-Session temp files, one per session (the original
+#     setup)
+#   - sqlite: SQLiteSessionInterface on instance/sessions.db
+#   - cookie: Flask's signed cookie; the session (just user_id and any
+#     pending flashes) travels with each request and nothing is stored on
+#     the server. Needs a SECRET_KEY shared by every worker: it comes from
+#     FINANCE_SECRET_KEY, or is generated once into instance/secret_key.
+#   - can be called again to switch backends (the benchmark does)
+# ---------------------------------------------------------------------------
+def init_app(app, backend):
+    """Installs the session interface for 'backend'."""
+    if backend == "filesystem":
+        from flask_session import Session
+        from tempfile import gettempdir
+
+        app.config["SESSION_FILE_DIR"] = gettempdir()
+        app.config["SESSION_TYPE"] = "filesystem"
+        Session(app)
+
+    elif backend == "sqlite":
+        app.session_interface = SQLiteSessionInterface(
+                os.path.join(app.instance_path, "sessions.db"),
+                app.config.get("SESSION_PRUNE_INTERVAL", SESSION_PRUNE_INTERVAL))
+
+    elif backend == "cookie":
+        if not app.secret_key:
+            app.secret_key = os.environ.get("FINANCE_SECRET_KEY") or secretkey(
+                    os.path.join(app.instance_path, "secret_key"))
+        app.session_interface = SecureCookieSessionInterface()
+
+    else:
+        raise ValueError("unknown session backend: {}".format(backend))
+    app.config["SESSION_BACKEND"] = backend
+
+def secretkey(path):
+    """Reads the key at path, creating it first if it does not exist."""
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    try:
+        with open(path, "x") as keyfile:
+            keyfile.write(secrets.token_hex(32))
+    except FileExistsError:
+        pass
+    with open(path) as keyfile:
+        return keyfile.read().strip()
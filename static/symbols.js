@@ -0,0 +1,23 @@
+// Suggests symbols as the user types, from the local symbol directory
+// (/symbols?q=...), by filling the input's <datalist>
+$(function() {
+    var list = $("#symbols");
+    var timer = null;
+    var last = "";
+    $("input[list=symbols]").on("input", function() {
+        var query = $.trim($(this).val());
+        clearTimeout(timer);
+        if (query === "" || query === last) {
+            return;
+        }
+        timer = setTimeout(function() {
+            last = query;
+            $.getJSON(list.data("source"), {q: query}, function(matches) {
+                list.empty();
+                $.each(matches, function(i, match) {
+                    $("<option>").val(match.symbol).text(match.name).appendTo(list);
+                });
+            });
+        }, 150);
+    });
+});
@@ -0,0 +1,124 @@
+# ---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+#   Desc.:      Symbol directory
+#   Purpose:    The stock symbols that exist, from a listing file, for
+#               autocomplete and for rejecting typos without a network call
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Licensing Info:
+#   ?
+# ---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+
+# Imports:
+import bisect
+import os
+import threading
+
+# 'Constants'
+SYMBOL_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "data", "symbols.txt")
+SYMBOL_MATCHES = 10     # most matches a search returns
+
+# ---------------------------------------------------------------------------
+#   Desc.:      SymbolDirectory(paths)
+#   Purpose:    Sorted arrays of symbols and names with prefix search
+#   Author:     Joel Tannas
+#   Date:
+#
+#   Bugs, Limitations, and Other Notes:
+#   - 'paths' is one or more pipe separated listing files with a header
+#     row, in the format of NASDAQ Trader's nasdaqlisted.txt (Symbol) or
+#     otherlisted.txt (ACT Symbol), so those can be used as they are; the
+#     bundled data/symbols.txt only has the Symbol and Security Name columns
+#   - test issues and the trailing 'File Creation Time' line are skipped
+#   - nothing is read until the first lookup, so startup stays fast
+#   - the symbols are one sorted list searched with bisect: membership and
+#     prefix search are O(log n); a second sorted list of lowercased names
+#     lets searches match company names by prefix too
+# ---------------------------------------------------------------------------
+class SymbolDirectory:
+    """Every known symbol, loaded from listing files on first use."""
+
+    def __init__(self, paths=SYMBOL_FILE):
+        self.paths = [paths] if isinstance(paths, str) else list(paths)
+        self._symbols = None
+        self._names = None
+        self._byname = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._load()[0])
+
+    def __contains__(self, symbol):
+        symbols = self._load()[0]
+        index = bisect.bisect_left(symbols, symbol.upper())
+        return index < len(symbols) and symbols[index] == symbol.upper()
+
+    def name(self, symbol):
+        """The security name for a symbol, or None."""
+        symbols, names = self._load()[:2]
+        index = bisect.bisect_left(symbols, symbol.upper())
+        if index < len(symbols) and symbols[index] == symbol.upper():
+            return names[index]
+        return None
+
+    def search(self, query, limit=SYMBOL_MATCHES):
+        """Symbols starting with 'query', then names starting with it."""
+        symbols, names, byname = self._load()
+        query = query.strip()
+        if not query:
+            return []
+
+        # --- Section 010: Symbols with the prefix, in order
+        start = bisect.bisect_left(symbols, query.upper())
+        stop = bisect.bisect_left(symbols, query.upper() + "\uffff", start)
+        found = list(range(start, min(stop, start + limit)))
+
+        # --- Section 020: Then names with the prefix
+        if len(found) < limit:
+            start = bisect.bisect_left(byname, (query.lower(),))
+            for lowered, index in byname[start:]:
+                if len(found) == limit or not lowered.startswith(query.lower()):
+                    break
+                if index not in found:
+                    found.append(index)
+
+        return [{"symbol" : symbols[index], "name" : names[index]} for index in found]
+
+    def _load(self):
+        """Reads the listing files the first time they are needed."""
+        if self._symbols == None:
+            with self._lock:
+                if self._symbols == None:
+                    listing = {}
+                    for path in self.paths:
+                        listing.update(readlisting(path))
+                    symbols = sorted(listing)
+                    names = [listing[symbol] for symbol in symbols]
+                    self._byname = sorted((name.lower(), index)
+                                          for index, name in enumerate(names))
+                    self._names = names
+                    self._symbols = symbols
+        return self._symbols, self._names, self._byname
+
+def readlisting(path):
+    """Returns {symbol: name} from one pipe separated listing file."""
+    listing = {}
+    with open(path, encoding = "utf-8") as lines:
+        header = next(lines).rstrip("\n").split("|")
+        column = next(i for i, heading in enumerate(header)
+                        if heading in ["Symbol", "ACT Symbol"])
+        name = header.index("Security Name")
+        test = header.index("Test Issue") if "Test Issue" in header else None
+        for line in lines:
+            fields = line.rstrip("\n").split("|")
+            if line.startswith("File Creation Time"):
+                continue
+            if len(fields) != len(header) or not fields[column]:
+                continue
+            if test != None and fields[test] == "Y":
+                continue
+            listing[fields[column].upper()] = fields[name]
+    return listing
@@ -0,0 +1,13 @@
+import pytest
+
+from database import Database
+from schema import migrate
+
+
+@pytest.fixture
+def db(tmp_path):
+    path = str(tmp_path / "finance.db")
+    migrate(path)
+    database = Database(path, archive = str(tmp_path / "archive.db"))
+    yield database
+    database.close()
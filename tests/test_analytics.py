@@ -0,0 +1,73 @@
+import math
+import random
+
+import pytest
+
+from analytics import EPSILON, costbasis
+
+
+def loopbasis(symbols, units, prices):
+    """costbasis() the slow way, one ledger row at a time."""
+    held, cost, realized = {}, {}, {}
+    for symbol, change, price in zip(symbols, units, prices):
+        before = held.get(symbol, 0.0)
+        if abs(before) < EPSILON:
+            before, cost[symbol] = 0.0, 0.0
+        held[symbol] = before + change
+        realized.setdefault(symbol, 0.0)
+        if change > 0:
+            cost[symbol] += change * price
+        else:
+            average = cost[symbol] / before
+            realized[symbol] += (price - average) * -change
+            if abs(held[symbol]) < EPSILON:
+                cost[symbol] = 0.0
+            else:
+                cost[symbol] *= held[symbol] / before
+    return {symbol : (held[symbol], cost[symbol], realized[symbol]) for symbol in held}
+
+
+def randomledger(rng, rows, symbols, sellout):
+    """Random buys and sells that never sell more than is held."""
+    held = {}
+    ledger = []
+    for i in range(rows):
+        symbol = rng.choice(symbols)
+        price = round(rng.uniform(1, 500), 2)
+        units = held.get(symbol, 0)
+        if units > 0 and rng.random() < sellout:
+            change = -units
+        elif units > 0 and rng.random() < 0.4:
+            change = -rng.randint(1, units)
+        else:
+            change = rng.randint(1, 100)
+        held[symbol] = units + change
+        ledger.append((symbol, change, price))
+    return [list(column) for column in zip(*ledger)]
+
+
+def assertsame(ledger):
+    expected = loopbasis(*ledger)
+    actual = costbasis(*ledger)
+    assert sorted(actual) == sorted(expected)
+    for symbol, values in expected.items():
+        assert actual[symbol] == pytest.approx(values, rel = 1e-9, abs = 1e-6)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_costbasis_matches_a_plain_loop(seed):
+    rng = random.Random(seed)
+    assertsame(randomledger(rng, rng.randint(1, 300), ["AAPL", "MSFT", "NFLX"], 0.2))
+
+
+def test_costbasis_holds_over_a_long_ledger_with_many_sellouts():
+    rng = random.Random(15)
+    assertsame(randomledger(rng, 100000, ["AAPL"], 0.3))
+
+
+def test_costbasis_without_a_price_is_unknown_until_sold_out():
+    basis = costbasis(["AAPL", "AAPL", "AAPL", "AAPL"], [10, -10, 5, 5],
+                      [math.nan, 20.0, 30.0, 40.0])
+    held, cost, realized = basis["AAPL"]
+    assert (held, cost) == pytest.approx((10.0, 350.0))
+    assert math.isnan(realized)
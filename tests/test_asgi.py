@@ -0,0 +1,156 @@
+import asyncio
+import threading
+import urllib.parse
+
+import pytest
+from flask import abort, session
+
+import asgi
+from asgi import blocking
+from sessions import SQLiteSessionInterface
+
+
+class Client:
+    """Drives an ASGI app in process, keeping its cookies."""
+
+    def __init__(self, app):
+        self.app = app
+        self.cookies = {}
+
+    def request(self, method, path, form=None, disconnect=None):
+        """The response as a dict; 'disconnect(response)' says when to hang up."""
+        return asyncio.run(asyncio.wait_for(
+                    self.send(method, path, form, disconnect), timeout = 10))
+
+    async def send(self, method, path, form, disconnect):
+        headers = [(b"host", b"test"),
+                   (b"content-type", b"application/x-www-form-urlencoded")]
+        if len(self.cookies) != 0:
+            headers.append((b"cookie", "; ".join("{}={}".format(name, value)
+                                for name, value in self.cookies.items()).encode()))
+        scope = {"type" : "http", "method" : method, "path" : path,
+                 "query_string" : b"", "headers" : headers}
+        body = urllib.parse.urlencode(form or {}).encode()
+        gone = asyncio.Event()
+        requested = []
+
+        async def receive():
+            if len(requested) == 0:
+                requested.append(True)
+                return {"type" : "http.request", "body" : body}
+            await gone.wait()
+            return {"type" : "http.disconnect"}
+
+        response = {"status" : None, "headers" : {}, "body" : b""}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                for name, value in message["headers"]:
+                    response["headers"][name.decode()] = value.decode()
+                    if name == b"set-cookie":
+                        name, _, value = value.decode().split(";")[0].partition("=")
+                        self.cookies[name] = value
+            else:
+                response["body"] += message.get("body", b"")
+            if disconnect != None and disconnect(response):
+                gone.set()
+
+        await self.app(scope, receive, send)
+        return response
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    finance = asgi.create_asgi_app({
+            "DATABASE" : str(tmp_path / "finance.db"),
+            "ARCHIVE_DATABASE" : str(tmp_path / "archive.db"),
+            "PRICE_HISTORY_DIR" : str(tmp_path / "prices"),
+            "QUOTE_PROVIDER" : "local",
+            "QUOTE_CACHE_BACKEND" : "memory",
+            "MATCHING_ENGINE" : "off",
+            "SESSION_BACKEND" : "cookie",
+            "SECRET_KEY" : "test",
+            "PASSWORD_ROUNDS" : 1000,
+            "LIVE_PRICES" : True,
+            "STREAM_KEEPALIVE" : 0.05})
+    finance.app.session_interface = SQLiteSessionInterface(str(tmp_path / "sessions.db"))
+
+    # async views for the tests, served the way asgi.py serves its own
+    async def visits():
+        session["visits"] = await blocking(lambda: session.get("visits", 0) + 1)
+        return str(session["visits"])
+
+    async def broken():
+        raise RuntimeError("broken view")
+
+    async def missing():
+        abort(404)
+
+    for rule, view in [("/visits", visits), ("/broken", broken), ("/missing", missing)]:
+        finance.app.add_url_rule(rule, view.__name__, lambda: "sync")
+        monkeypatch.setitem(asgi.ASYNC_VIEWS, view.__name__, (view, ["GET"]))
+
+    # where each of the request's hooks ran
+    hooks = finance.hooks = []
+    finance.app.before_request(
+            lambda: hooks.append(("before", threading.current_thread().name)))
+    finance.app.after_request(
+            lambda response: hooks.append(("after", threading.current_thread().name))
+                             or response)
+    finance.app.teardown_request(
+            lambda error: hooks.append(("teardown", type(error).__name__)))
+    yield finance
+    finance.close()
+
+
+def register(client):
+    response = client.request("POST", "/register", {"username" : "alice",
+                              "password" : "secret", "password2" : "secret"})
+    assert response["status"] == 302
+    del client.app.hooks[:]
+
+
+def test_async_view_runs_its_hooks_off_the_loop(app):
+    client = Client(app)
+    register(client)
+    response = client.request("GET", "/")
+    assert response["status"] == 200
+    assert b"EventSource" in response["body"]
+    assert "total;dur=" in response["headers"]["server-timing"]
+    assert [(hook, name.split("_")[0]) for hook, name in app.hooks] == [
+            ("before", "asgi-db"), ("after", "asgi-db"), ("teardown", "NoneType")]
+
+
+def test_async_view_not_found(app):
+    client = Client(app)
+    register(client)
+    assert client.request("GET", "/missing")["status"] == 404
+    assert client.request("GET", "/no/such/page")["status"] == 404
+
+
+def test_async_view_error_is_a_500_and_tears_down(app):
+    client = Client(app)
+    register(client)
+    assert client.request("GET", "/broken")["status"] == 500
+    assert app.hooks[-1] == ("teardown", "RuntimeError")
+    assert client.request("GET", "/visits")["status"] == 200
+
+
+def test_async_view_session_round_trip(app):
+    client = Client(app)
+    assert client.request("GET", "/visits")["body"] == b"1"
+    assert client.request("GET", "/visits")["body"] == b"2"
+    assert len(app.app.session_interface) == 1
+
+    client.cookies.clear()
+    assert client.request("GET", "/visits")["body"] == b"1"
+
+
+def test_stream_is_released_when_the_client_goes_away(app):
+    client = Client(app)
+    register(client)
+    response = client.request("GET", "/stream",
+                              disconnect = lambda response: b"retry" in response["body"])
+    assert response["status"] == 200
+    assert len(app.app.extensions["finance"].pricestream) == 0
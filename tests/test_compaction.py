@@ -0,0 +1,61 @@
+import random
+
+import pytest
+
+from analytics import costbasis
+from helpers import USD_sentinel, compactledger, executetrade
+
+
+def trade(db, rng, users, rows):
+    for i in range(rows):
+        user_id = rng.choice(users)
+        symbol = rng.choice(["AAPL", "MSFT", "NFLX"])
+        price = round(rng.uniform(10, 200), 2)
+        if rng.random() < 0.3:
+            executetrade(db, user_id, symbol, 0, price, sellall = True)
+        else:
+            executetrade(db, user_id, symbol, rng.randint(-20, 20) or 1, price)
+    db.connection.execute("UPDATE transactions SET timestamp = datetime(id * 60, 'unixepoch')")
+
+
+def state(db, user_id):
+    """What a user sees: their history, its totals, positions and cost basis
+    (cash is a float, so the totals can differ from positions in the last
+    digit)."""
+    history = list(db.iterhistory(user_id))
+    totals = {}
+    for row in history:
+        totals[row["symbol"]] = totals.get(row["symbol"], 0) + row["amount"]
+    positions = {row["symbol"] : row["amount"] for row in db.portfolio(user_id)}
+    basis = {symbol : (held, cost) for symbol, (held, cost, realized)
+                in costbasis(*zip(*db.ledger(user_id, USD_sentinel))).items()}
+    return history, {symbol : amount for symbol, amount in totals.items() if amount != 0}, \
+           positions, basis
+
+
+def assertunchanged(db, users, before):
+    expected = {user_id : state(db, user_id) for user_id in users}
+    archived, checkpoints = compactledger(db, before)
+    assert archived > 0 and checkpoints > 0
+    for user_id in users:
+        history, totals, positions, basis = state(db, user_id)
+        assert history == expected[user_id][0]
+        assert positions == expected[user_id][2]
+        assert totals == pytest.approx(positions)
+        assert sorted(basis) == sorted(expected[user_id][3])
+        for symbol, (held, cost) in basis.items():
+            assert (held, cost) == pytest.approx(expected[user_id][3][symbol])
+    assert db.positionsdrift() == []
+
+
+def test_compaction_keeps_every_balance_and_the_history(db):
+    rng = random.Random(23)
+    users = [db.create_user(name, "hash") for name in ["alice", "bob", "carol"]]
+    for user_id in users:
+        db.move(user_id, USD_sentinel, 100000)
+    trade(db, rng, users, 300)
+    assertunchanged(db, users, "1970-01-01 02:00:00")
+
+    # a second pass rolls the first one's checkpoints into its own
+    trade(db, rng, users, 100)
+    assertunchanged(db, users, "1970-01-01 06:00:00")
@@ -0,0 +1,55 @@
+import asyncio
+import threading
+
+import pytest
+
+from quotecache import MemoryBackend, QuoteCache, SQLiteBackend
+
+
+@pytest.fixture(params = ["memory", "sqlite"])
+def cache(request, tmp_path):
+    if request.param == "sqlite":
+        return QuoteCache(backend = SQLiteBackend(str(tmp_path / "quotecache.db")))
+    return QuoteCache(backend = MemoryBackend())
+
+
+def test_concurrent_async_misses_fetch_once(cache):
+    calls = []
+
+    async def loader(symbols):
+        calls.append(symbols)
+        await asyncio.sleep(0.05)
+        return {symbol : {"symbol" : symbol, "price" : 1.0} for symbol in symbols}
+
+    async def main():
+        return await asyncio.gather(*[cache.get_many_async(["aapl"], loader)
+                                        for i in range(10)])
+
+    results = asyncio.run(main())
+    assert calls == [["AAPL"]]
+    assert all(result["aapl"]["price"] == 1.0 for result in results)
+    assert cache.stats()["coalesced"] == 9
+
+
+def test_sqlite_backend_stays_off_the_event_loop(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "quotecache.db"))
+    cache = QuoteCache(backend = backend)
+    threads = set()
+    for name in ["get_many", "put_many", "claim", "release"]:
+        def spy(*args, method = getattr(backend, name)):
+            threads.add(threading.get_ident())
+            return method(*args)
+        setattr(backend, name, spy)
+
+    async def loader(symbols):
+        return {symbol : None for symbol in symbols}
+
+    async def main():
+        await cache.get_many_async(["AAPL", "MSFT"], loader)
+        await cache.get_many_async(["AAPL"], loader)
+        return threading.get_ident()
+
+    loop = asyncio.run(main())
+    assert len(threads) != 0 and loop not in threads
+    assert cache.stats()["negative_hits"] == 1
+    assert backend._connect().execute("SELECT COUNT(*) FROM quote_leases").fetchone()[0] == 0
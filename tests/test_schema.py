@@ -0,0 +1,18 @@
+from database import STATEMENTS
+from schema import MIGRATIONS, QUERY_PLANS, checkplans, migrate
+
+
+def test_migrate_reaches_latest_version(tmp_path):
+    path = str(tmp_path / "finance.db")
+    assert migrate(path) == len(MIGRATIONS)
+    assert migrate(path) == len(MIGRATIONS)
+
+
+def test_query_plans_name_real_statements():
+    assert [name for name, index in QUERY_PLANS if name not in STATEMENTS] == []
+
+
+def test_hot_queries_use_their_indexes(tmp_path):
+    path = str(tmp_path / "finance.db")
+    migrate(path)
+    assert checkplans(path) == []
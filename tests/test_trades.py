@@ -0,0 +1,105 @@
+import threading
+
+from helpers import USD_sentinel, executeorders, executetrade
+
+
+def fund(db, cash):
+    user_id = db.create_user("alice", "hash")
+    db.move(user_id, USD_sentinel, cash)
+    return user_id
+
+
+def test_trade_moves_cash_and_stock_together(db):
+    user_id = fund(db, 1000)
+    trade = executetrade(db, user_id, "AAPL", 3, 100)
+    assert (trade["ok"], trade["cash"], trade["value"]) == (True, 700, 300)
+    assert db.balances(user_id, USD_sentinel, "AAPL") == {USD_sentinel : 700, "AAPL" : 3}
+
+    trade = executetrade(db, user_id, "AAPL", 0, 120, sellall = True)
+    assert (trade["ok"], trade["units"], trade["cash"]) == (True, 3, 1060)
+    assert db.portfolio(user_id)[0]["amount"] == 1060
+    assert db.positionsdrift() == []
+
+
+def test_trade_refuses_what_the_user_cannot_afford(db):
+    user_id = fund(db, 100)
+    assert executetrade(db, user_id, "AAPL", 2, 100)["error"] == \
+        "Insufficient funds to complete this transaction"
+    assert executetrade(db, user_id, "AAPL", -1, 100)["error"] == \
+        "Insufficient stocks to complete this transaction"
+    assert executetrade(db, user_id, "AAPL", 0, 100, sellall = True)["error"] == \
+        "You have no AAPL stock to sell"
+    assert db.balances(user_id, USD_sentinel, "AAPL") == {USD_sentinel : 100}
+
+
+def test_concurrent_buys_never_overspend(db):
+    user_id = fund(db, 1000)
+    results = []
+    ready = threading.Barrier(20)
+
+    def buy():
+        ready.wait()
+        results.append(executetrade(db, user_id, "AAPL", 1, 100))
+        db.close()
+
+    threads = [threading.Thread(target = buy) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sum(result["ok"] for result in results) == 10
+    assert db.balances(user_id, USD_sentinel, "AAPL") == {USD_sentinel : 0, "AAPL" : 10}
+    assert db.positionsdrift() == []
+
+
+QUOTES = {"AAPL" : {"symbol" : "AAPL", "price" : 60},
+          "MSFT" : {"symbol" : "MSFT", "price" : 100}}
+
+
+def holdings(db, user_id):
+    return {row["symbol"] : row["amount"] for row in db.portfolio(user_id)}
+
+
+def test_orders_sell_before_buying_with_the_proceeds(db):
+    user_id = fund(db, 0)
+    db.move(user_id, "AAPL", 10)
+    results, cash = executeorders(db, user_id, [
+            {"action" : "buy", "symbol" : "MSFT", "units" : 5},
+            {"action" : "sell", "symbol" : "AAPL", "units" : None}], QUOTES)
+    assert [(result["ok"], result["symbol"], result["units"]) for result in results] == \
+        [(True, "MSFT", 5), (True, "AAPL", 10)]
+    assert cash == 100
+    assert holdings(db, user_id) == {USD_sentinel : 100, "MSFT" : 5}
+    assert db.positionsdrift() == []
+
+
+def test_orders_write_nothing_when_one_leg_fails(db):
+    user_id = fund(db, 1000)
+    latest = db.latesttransaction(user_id)
+    results, cash = executeorders(db, user_id, [
+            {"action" : "buy", "symbol" : "AAPL", "units" : 5},
+            {"action" : "sell", "symbol" : "MSFT", "units" : 1},
+            {"action" : "buy", "symbol" : "ZZZQ", "units" : 1}], QUOTES)
+    assert [result["error"] for result in results] == [
+            "Not executed: another order in the batch failed",
+            "Insufficient stocks to complete this transaction",
+            "Unable to find stock: ZZZQ"]
+    assert cash == 1000
+    assert db.latesttransaction(user_id) == latest
+    assert holdings(db, user_id) == {USD_sentinel : 1000}
+
+
+def test_orders_check_cash_across_the_whole_batch(db):
+    user_id = fund(db, 1000)
+    orders = [{"action" : "buy", "symbol" : "MSFT", "units" : 6},
+              {"action" : "buy", "symbol" : "MSFT", "units" : 6}]
+    results, cash = executeorders(db, user_id, orders, QUOTES)
+    assert [result["ok"] for result in results] == [False, False]
+    assert holdings(db, user_id) == {USD_sentinel : 1000}
+
+    results, cash = executeorders(db, user_id, orders, QUOTES, atomic = False)
+    assert [result["ok"] for result in results] == [True, False]
+    assert cash == 400
+    assert holdings(db, user_id) == {USD_sentinel : 400, "MSFT" : 6}
+    assert db.positionsdrift() == []